@@ -6,6 +6,7 @@ from collections import defaultdict
 import csv
 import time
 import re
+import ipaddress
 
 # 日志配置
 logging.basicConfig(
@@ -23,6 +24,9 @@ sys.stdout.reconfigure(line_buffering=True)
 # 常量
 INPUT_CSV = "ip.csv"
 OUTPUT_FILE = "api.txt"
+# 与 ip-filter-speedtest-api.py 相同的 IPv4 写法：允许前导零（如 001.002.003.004），规范化时去掉
+IPV4_PATTERN = re.compile(r'^(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$')
+IPV4_LEADING_ZERO_PATTERN = re.compile(r'(?:^|\.)0\d')
 
 # 国家标签和别名
 COUNTRY_LABELS = {
@@ -85,10 +89,32 @@ COUNTRY_ALIASES = {
     'NORTH KOREA': 'KP', 'KOREA, DEMOCRATIC PEOPLE\'S REPUBLIC OF': 'KP', '朝鲜': 'KP'
 }
 
+def normalize_ip(ip: str) -> str:
+    """返回 IP 的规范形式（去掉方括号和 zone，IPv6 压缩表示，IPv4 映射地址还原为 IPv4，IPv4 去掉前导零）；无效时返回空字符串
+
+    与 ip-filter-speedtest-api.py 中的 normalize_ip 行为一致，两边对同一个 ip.csv 得到相同的节点。
+    """
+    ip = ip.strip().strip('[]')
+    if IPV4_PATTERN.match(ip):
+        if IPV4_LEADING_ZERO_PATTERN.search(ip):
+            return '.'.join(str(int(part)) for part in ip.split('.'))
+        return ip
+    if ':' not in ip:
+        return ''
+    try:
+        address = ipaddress.IPv6Address(ip.split('%', 1)[0])
+    except ValueError:
+        return ''
+    if address.ipv4_mapped:
+        return str(address.ipv4_mapped)
+    return address.compressed
+
+def format_host_port(ip: str, port) -> str:
+    """格式化为 host:port，IPv6 地址加方括号"""
+    return f"[{ip}]:{port}" if ':' in ip else f"{ip}:{port}"
+
 def is_valid_ip(ip: str) -> bool:
-    ipv4_pattern = re.compile(r'^(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$')
-    ipv6_pattern = re.compile(r'^(?:[0-9a-fA-F]{0,4}:){1,7}[0-9a-fA-F]{0,4}$')
-    return bool(ipv4_pattern.match(ip) or ipv6_pattern.match(ip.strip('[]')))
+    return bool(normalize_ip(ip))
 
 def is_valid_port(port: str) -> bool:
     try:
@@ -190,8 +216,8 @@ def generate_api_txt(csv_file: str) -> int:
             for row in reader:
                 if len(row) < 2:
                     continue
-                ip, port = row[ip_col], row[port_col]
-                if not is_valid_ip(ip) or not is_valid_port(port):
+                ip, port = normalize_ip(row[ip_col]), row[port_col]
+                if not ip or not is_valid_port(port):
                     continue
                 # 提取国家信息
                 country = extract_country_from_row(row, country_col)
@@ -227,7 +253,7 @@ def generate_api_txt(csv_file: str) -> int:
 
     with open(OUTPUT_FILE, "w", encoding="utf-8-sig") as f:
         for ip, port, label in unique_nodes:
-            f.write(f"{ip}:{port}#{label}\n")
+            f.write(f"{format_host_port(ip, port)}#{label}\n")
 
     logger.info(f"生成 {OUTPUT_FILE}，{len(unique_nodes)} 个节点 (耗时: {time.time() - start_time:.2f} 秒)")
     logger.info(f"国家分布: {dict(country_count)}")
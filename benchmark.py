@@ -0,0 +1,434 @@
+import argparse
+import csv
+import gc
+import importlib.util
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Tuple
+
+# 日志配置
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)],
+    force=True
+)
+logger = logging.getLogger("benchmark")
+
+# 常量
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+MAIN_SCRIPT = "ip-filter-speedtest-api.py"
+API_SCRIPT = "api.py"
+DEFAULT_SIZES = [10000, 100000, 1000000]
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.15
+RESULTS_FILE = "bench_results.json"
+SEED = 20250426
+
+RESULT_HEADER = ['IP地址', '端口', 'TLS', '数据中心', '地区', '国际代码', '国家', '城市', '网络延迟', '下载速度MB/s']
+SOURCE_PORTS = [443, 2053, 2083, 2087, 2096, 8443, 50000, 8080, 587, 80]
+SOURCE_COUNTRIES = ['JP', 'KR', 'SG', 'TW', 'HK', 'IN', 'VN', 'TH', 'US', 'DE', 'NL', 'GB', 'FR',
+                    'Japan', 'Hong Kong', 'South Korea', 'Singapore', 'Tokyo', 'Seoul', 'NRT', 'HKG', '']
+RESULT_COLOS = [('TPE', 'TW', '台湾', '台北'), ('NRT', 'JP', '日本', '东京'), ('SIN', 'SG', '新加坡', '新加坡'),
+                ('HKG', 'HK', '香港', '香港'), ('ICN', 'KR', '韩国', '首尔'), ('LAX', 'US', '美国', '洛杉矶')]
+
+def load_script_module(name: str, script: str, workdir: str):
+    """从临时目录导入脚本
+
+    主脚本在导入时会初始化日志（覆盖 speedtest.log）并查找测速脚本，
+    因此将脚本复制到临时目录中导入，避免改动仓库中的文件。
+    """
+    shutil.copy(os.path.join(SCRIPT_DIR, script), workdir)
+    for helper in ("iptest.sh", "iptest.bat"):
+        helper_path = os.path.join(SCRIPT_DIR, helper)
+        if os.path.exists(helper_path):
+            shutil.copy(helper_path, workdir)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(workdir, script))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def random_ip(rng: random.Random) -> str:
+    return f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+
+def make_source_rows(size: int, rng: random.Random) -> List[Tuple[str, int, str]]:
+    """生成与 input.csv 类似的源数据（IP、端口、国家/城市/IATA 混合写法）"""
+    return [(random_ip(rng), rng.choice(SOURCE_PORTS), rng.choice(SOURCE_COUNTRIES)) for _ in range(size)]
+
+def make_csv_content(rows: List[Tuple[str, int, str]]) -> str:
+    lines = ["ip,port,Region,Country,City"]
+    lines.extend(f"{ip},{port},AS,{country},Unknown" for ip, port, country in rows)
+    return "\n".join(lines)
+
+def make_json_content(rows: List[Tuple[str, int, str]]) -> str:
+    return json.dumps([{"ip": ip, "port": port, "country": country} for ip, port, country in rows])
+
+def make_space_content(rows: List[Tuple[str, int, str]]) -> str:
+    return "\n".join(f"{ip} {port} {country}".rstrip() for ip, port, country in rows)
+
+def write_result_csv(path: str, size: int, rng: random.Random) -> List[str]:
+    """生成与 iptest 输出相同格式的 ip.csv，返回其中的 IP 列表"""
+    ips = []
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(RESULT_HEADER)
+        for _ in range(size):
+            ip = random_ip(rng)
+            colo, code, country, city = rng.choice(RESULT_COLOS)
+            writer.writerow([ip, rng.choice(SOURCE_PORTS), 'true', colo, '亚太', code, country, city,
+                             f"{rng.randint(20, 300)} ms", f"{rng.uniform(0, 40):.2f}"])
+            ips.append(ip)
+    return ips
+
+def build_benchmarks(main_module, api_module, workdir: str) -> Dict[str, Callable[[int], Callable[[], None]]]:
+    """返回 {名称: setup(size) -> run()}，setup 阶段的数据准备不计入耗时"""
+    rng = random.Random(SEED)
+
+    def extract(fmt: str):
+        makers = {"csv": make_csv_content, "json": make_json_content, "space": make_space_content}
+
+        def setup(size: int):
+            content = makers[fmt](make_source_rows(size, rng))
+            return lambda: main_module.extract_ip_ports_from_content(content)
+        return setup
+
+    def standardize(size: int):
+        values = [rng.choice(SOURCE_COUNTRIES) for _ in range(size)]
+        return lambda: [main_module.standardize_country(v) for v in values]
+
+    def delimiter(size: int):
+        lines = make_csv_content(make_source_rows(size, rng)).splitlines()
+        chunks = [lines[i:i + 5] for i in range(0, len(lines), 5)]
+        return lambda: [main_module.detect_delimiter(chunk) for chunk in chunks]
+
+    def country_column(size: int):
+        lines = make_csv_content(make_source_rows(size, rng)).splitlines()
+        chunks = [lines[i:i + 20] for i in range(0, len(lines), 20)]
+        return lambda: [main_module.find_country_column(chunk, ',') for chunk in chunks]
+
+    def geoip(size: int):
+        ips = [random_ip(rng) for _ in range(size)]
+        return lambda: main_module.get_countries_from_ips(ips, {})
+
+    def dedupe(size: int):
+        path = os.path.join(workdir, "bench_dedupe.csv")
+        template = os.path.join(workdir, "bench_dedupe.template.csv")
+        write_result_csv(template, size, rng)
+
+        def run():
+            shutil.copy(template, path)
+            main_module.filter_speed_and_deduplicate(path, is_github_actions=False)
+        return run
+
+    def ips_file(size: int):
+        path = os.path.join(workdir, "bench_ips.csv")
+        ips = write_result_csv(path, size, rng)
+        # 预先写入国家缓存，使 generate_ips_file 不依赖 GeoIP 数据库
+        countries = [c for c in main_module.DESIRED_COUNTRIES] or ['JP']
+        with open(main_module.COUNTRY_CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump({ip: countries[i % len(countries)] for i, ip in enumerate(ips)}, f)
+        return lambda: main_module.generate_ips_file(path, is_github_actions=False)
+
+    def api_txt(size: int):
+        path = os.path.join(workdir, "bench_api.csv")
+        write_result_csv(path, size, rng)
+        return lambda: api_module.generate_api_txt(path)
+
+    def columnar(size: int):
+        path = os.path.join(workdir, "bench_columnar.csv")
+        write_result_csv(path, size, rng)
+        with open(path, "r", encoding="utf-8") as f:
+            rows = list(csv.reader(f))[1:]
+        col_path = os.path.join(workdir, "bench.col")
+        main_module.write_columnar_results(rows, col_path)
+
+        def run():
+            # 打开文件并对延迟列求和，对应下游工具读取 ip.csv 再解析“58 ms”的场景
+            with main_module.ipcol.ColumnarResults(col_path) as results:
+                sum(results.column("latency_ms"))
+        return run
+
+    benchmarks = {
+        "extract_csv": extract("csv"),
+        "extract_json": extract("json"),
+        "extract_space": extract("space"),
+        "standardize_country": standardize,
+        "detect_delimiter": delimiter,
+        "find_country_column": country_column,
+        "filter_speed_and_deduplicate": dedupe,
+        "generate_ips_file": ips_file,
+        "api_generate_api_txt": api_txt,
+        "ipcol_scan_latency": columnar,
+    }
+    if main_module.GEOIP_DB_PATH.exists():
+        main_module.geoip_reader = main_module.open_geoip_reader(main_module.geoip_settings["mode"])
+        benchmarks["get_countries_from_ips"] = geoip
+    else:
+        logger.warning(f"未找到 {main_module.GEOIP_DB_PATH}，跳过 get_countries_from_ips 基准")
+    return benchmarks
+
+def time_benchmark(run: Callable[[], None], repeat: int) -> List[float]:
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def run_benchmarks(sizes: List[int], repeat: int, selected: List[str]) -> Dict:
+    workdir = tempfile.mkdtemp(prefix="iptest-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        main_module = load_script_module("ip_filter_speedtest_api", MAIN_SCRIPT, workdir)
+        api_module = load_script_module("api", API_SCRIPT, workdir)
+        # 被测函数的日志量很大，基准运行期间只保留警告
+        for name in (None, main_module.logger.name, api_module.logger.name):
+            logging.getLogger(name).setLevel(logging.WARNING)
+        logger.setLevel(logging.INFO)
+
+        benchmarks = build_benchmarks(main_module, api_module, workdir)
+        results = {}
+        for name, setup in benchmarks.items():
+            if selected and name not in selected:
+                continue
+            for size in sizes:
+                run = setup(size)
+                timings = time_benchmark(run, repeat)
+                median = statistics.median(timings)
+                key = f"{name}@{size}"
+                results[key] = {
+                    "benchmark": name,
+                    "rows": size,
+                    "repeat": repeat,
+                    "seconds_min": round(min(timings), 6),
+                    "seconds_median": round(median, 6),
+                    "rows_per_second": round(size / median, 1) if median > 0 else None,
+                }
+                logger.info(f"{key:<40} 中位数 {median:.4f} 秒, 最小 {min(timings):.4f} 秒, {size / median:,.0f} 行/秒")
+        return {
+            "meta": {
+                "timestamp": time.time(),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "sizes": sizes,
+                "repeat": repeat,
+            },
+            "results": results,
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def parse_thresholds(values: List[str]) -> Dict[str, float]:
+    """解析 --threshold-for 名称=比例，名称可以是基准名或 基准名@行数"""
+    thresholds = {}
+    for value in values or []:
+        name, _, ratio = value.partition("=")
+        try:
+            thresholds[name.strip()] = float(ratio)
+        except ValueError:
+            logger.error(f"无效的阈值配置: {value}")
+            sys.exit(2)
+    return thresholds
+
+def compare_with_baseline(current: Dict, baseline: Dict, default_threshold: float, thresholds: Dict[str, float]) -> List[str]:
+    """按中位耗时与基线比较，返回超出阈值的回归列表"""
+    regressions = []
+    for key, result in current["results"].items():
+        base = baseline.get("results", {}).get(key)
+        if not base or not base.get("seconds_median"):
+            logger.info(f"{key:<40} 基线中无此项，跳过比较")
+            continue
+        threshold = thresholds.get(key, thresholds.get(result["benchmark"], default_threshold))
+        ratio = result["seconds_median"] / base["seconds_median"] - 1
+        status = "回归" if ratio > threshold else "正常"
+        logger.info(f"{key:<40} {base['seconds_median']:.4f} -> {result['seconds_median']:.4f} 秒 ({ratio:+.1%}, 阈值 {threshold:.0%}) {status}")
+        if ratio > threshold:
+            regressions.append(f"{key}: {ratio:+.1%} (阈值 {threshold:.0%})")
+    return regressions
+
+def result_row(ip: str, port: int, country: str, latency: float, speed: float) -> List[str]:
+    return [ip, str(port), "true", "NRT", "Asia Pacific", country, "", "", f"{latency} ms", f"{speed}"]
+
+def write_published_nodes(module, nodes: List[Tuple[str, int, str, float, float]]):
+    """写出 ips.txt 和 ip.csv，nodes 为 [(IP, 端口, 国家代码, 延迟毫秒, 速度 MB/s)]"""
+    with open(module.FINAL_CSV, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(RESULT_HEADER)
+        writer.writerows(result_row(*node) for node in nodes)
+    with open(module.IPS_FILE, "w", encoding="utf-8-sig") as f:
+        for i, (ip, port, country, _, _) in enumerate(nodes, 1):
+            emoji, name = module.COUNTRY_LABELS[country]
+            f.write(f"{ip}:{port}#{emoji} {name}-{i}\n")
+
+def read_file_state(paths: List[str]) -> List[Tuple[bytes, int]]:
+    state = []
+    for path in paths:
+        with open(path, "rb") as f:
+            state.append((f.read(), os.stat(path).st_mtime_ns))
+    return state
+
+def check_delta_feed(module):
+    """增量发布：版本号只在有超过阈值的变化时加一，没有变化时不改写增量文件和快照"""
+    assert module.node_changed({"country": "JP", "speed": 10.0, "latency": 50.0},
+                               {"country": "KR", "speed": 10.0, "latency": 50.0}, 0.2, 20.0), "国家变化应视为变化"
+    assert not module.node_changed({"country": "JP", "speed": 10.0, "latency": 50.0},
+                                   {"country": "JP", "speed": 11.5, "latency": 65.0}, 0.2, 20.0), "阈值内的漂移不应视为变化"
+    assert module.node_changed({"country": "JP", "speed": 0.0, "latency": 50.0},
+                               {"country": "JP", "speed": 1.0, "latency": 50.0}, 0.2, 20.0), "速度从 0 变为非 0 应视为变化"
+    assert module.node_changed({"country": "JP", "speed": 10.0, "latency": None},
+                               {"country": "JP", "speed": 10.0, "latency": 50.0}, 0.2, 20.0), "延迟从无到有应视为变化"
+
+    paths = [module.DELTA_FILE, module.DELTA_SNAPSHOT_FILE]
+    nodes = [("1.0.0.1", 443, "JP", 50.0, 10.0), ("1.0.0.2", 443, "KR", 60.0, 8.0), ("1.0.0.3", 2053, "SG", 70.0, 6.0)]
+    write_published_nodes(module, nodes)
+    assert module.write_delta_feed(module.DELTA_FILE) == 1, "首次发布的版本号应为 1"
+    with open(module.DELTA_FILE, "r", encoding="utf-8") as f:
+        delta = json.load(f)
+    assert (delta["base_version"], len(delta["added"]), delta["removed"], delta["changed"]) == (0, 3, [], []), delta
+
+    state = read_file_state(paths)
+    time.sleep(0.01)
+    assert module.write_delta_feed(module.DELTA_FILE) == 1, "没有变化时版本号不应增加"
+    # 阈值内的漂移同样不算变化
+    write_published_nodes(module, [("1.0.0.1", 443, "JP", 55.0, 11.0)] + nodes[1:])
+    assert module.write_delta_feed(module.DELTA_FILE) == 1, "阈值内的漂移不应增加版本号"
+    assert read_file_state(paths) == state, "没有变化时不应改写增量文件和快照"
+
+    write_published_nodes(module, [("1.0.0.1", 443, "JP", 120.0, 11.0), nodes[1], ("1.0.0.4", 443, "HK", 40.0, 12.0)])
+    assert module.write_delta_feed(module.DELTA_FILE) == 2, "有变化时版本号应加一"
+    with open(module.DELTA_FILE, "r", encoding="utf-8") as f:
+        delta = json.load(f)
+    assert (delta["version"], delta["base_version"]) == (2, 1), delta
+    assert [n["node"] for n in delta["added"]] == ["1.0.0.4:443"], delta["added"]
+    assert delta["removed"] == ["1.0.0.3:2053"], delta["removed"]
+    assert [(n["node"], n["latency"]) for n in delta["changed"]] == [("1.0.0.1:443", 120.0)], delta["changed"]
+    with open(module.DELTA_SNAPSHOT_FILE, "r", encoding="utf-8") as f:
+        snapshot = json.load(f)
+    assert snapshot["version"] == 2 and sorted(snapshot["nodes"]) == ["1.0.0.1:443", "1.0.0.2:443", "1.0.0.4:443"], snapshot
+
+def check_checkpoint_resume(module):
+    """检查点续测：只沿用同一引擎、未过期的最新记录，跳过进程被杀时写了一半的最后一行，合并后按速度、延迟重新排序"""
+    path = module.CHECKPOINT_FILE
+    checkpoint = module.CheckpointLog(path, "iptest", append=False)
+    checkpoint.append({"ip": "1.0.0.1", "port": 443, "outcome": "ok", "row": result_row("1.0.0.1", 443, "JP", 80.0, 3.0)})
+    checkpoint.append({"ip": "1.0.0.2", "port": 443, "outcome": "failed", "row": None})
+    checkpoint.append({"ip": "1.0.0.3", "port": 443, "outcome": "ok", "row": result_row("1.0.0.3", 443, "JP", 40.0, 9.0)})
+    checkpoint.append({"ip": "1.0.0.5", "port": 443, "outcome": "ok", "row": result_row("1.0.0.5", 443, "JP", 20.0, 5.0)})
+    # 同一节点的较新记录覆盖较旧的记录
+    checkpoint.append({"ip": "1.0.0.1", "port": 443, "outcome": "ok", "row": result_row("1.0.0.1", 443, "JP", 60.0, 5.0)})
+    checkpoint.close()
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"t": time.time() - 7200, "engine": "iptest", "ip": "1.0.0.7", "port": 443, "outcome": "ok",
+                            "row": result_row("1.0.0.7", 443, "JP", 10.0, 50.0)}) + "\n")
+        f.write(json.dumps({"t": time.time(), "engine": "native", "ip": "1.0.0.8", "port": 443, "outcome": "ok"}) + "\n")
+        # 进程被杀时最后一行只写了一半
+        f.write('{"t":%.3f,"engine":"iptest","ip":"1.0.0.9","port":44' % time.time())
+
+    records = module.load_checkpoint(path, "iptest", 3600)
+    assert sorted(records) == ["1.0.0.1 443", "1.0.0.2 443", "1.0.0.3 443", "1.0.0.5 443"], sorted(records)
+    assert records["1.0.0.1 443"]["row"][9] == "5.0", "同一节点应沿用最新的记录"
+
+    # 本次 iptest 的输出与检查点中的节点重叠时以本次输出为准
+    write_published_nodes(module, [("1.0.0.4", 443, "KR", 30.0, 5.0), ("1.0.0.3", 443, "JP", 45.0, 7.0)])
+    count = module.merge_checkpoint_rows(list(records.values()), module.FINAL_CSV, include_existing=True)
+    with open(module.FINAL_CSV, "r", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        assert next(reader) == RESULT_HEADER
+        rows = list(reader)
+    assert count == len(rows) == 4, rows
+    assert [(row[0], row[8], row[9]) for row in rows] == [("1.0.0.3", "45.0 ms", "7.0"), ("1.0.0.5", "20.0 ms", "5.0"),
+                                                          ("1.0.0.4", "30.0 ms", "5.0"), ("1.0.0.1", "60.0 ms", "5.0")], rows
+
+    # 不沿用本次输出时只写出检查点中的结果
+    assert module.merge_checkpoint_rows(list(records.values()), module.FINAL_CSV, include_existing=False) == 3
+
+def run_self_checks() -> int:
+    """在临时目录中运行确定性的行为自检，每项使用独立的子目录，返回失败项数"""
+    checks = {
+        "delta_feed": check_delta_feed,
+        "checkpoint_resume": check_checkpoint_resume,
+    }
+    workdir = tempfile.mkdtemp(prefix="iptest-selfcheck-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    failures = 0
+    try:
+        module = load_script_module("ip_filter_speedtest_api", MAIN_SCRIPT, workdir)
+        logging.getLogger(module.logger.name).setLevel(logging.WARNING)
+        for name, check in checks.items():
+            check_dir = os.path.join(workdir, name)
+            os.makedirs(check_dir)
+            os.chdir(check_dir)
+            try:
+                check(module)
+                logger.info(f"自检 {name}: 通过")
+            except Exception as e:
+                failures += 1
+                logger.error(f"自检 {name}: 失败 ({type(e).__name__}: {e})")
+            finally:
+                os.chdir(workdir)
+        return failures
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="纯 Python 热点路径基准测试")
+    parser.add_argument("--sizes", type=str, default=",".join(str(s) for s in DEFAULT_SIZES), help="合成数据行数，逗号分隔 (默认: 10000,100000,1000000)")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help=f"每项重复次数，取中位数 (默认: {DEFAULT_REPEAT})")
+    parser.add_argument("--only", type=str, default="", help="只运行指定基准，逗号分隔")
+    parser.add_argument("--output", type=str, default=RESULTS_FILE, help=f"结果 JSON 输出路径 (默认: {RESULTS_FILE})")
+    parser.add_argument("--baseline", type=str, default="", help="与之比较的基线 JSON 文件")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help=f"默认回归阈值，中位耗时增加超过该比例视为回归 (默认: {DEFAULT_THRESHOLD})")
+    parser.add_argument("--threshold-for", action="append", default=[], help="单项阈值，格式 名称=比例 或 名称@行数=比例，可重复")
+    parser.add_argument("--save-baseline", type=str, default="", help="同时将本次结果保存为基线文件")
+    parser.add_argument("--self-check", action="store_true", help="只运行确定性的行为自检，不计时，有失败项时以退出码 1 结束")
+    args = parser.parse_args()
+
+    if args.self_check:
+        failures = run_self_checks()
+        if failures:
+            logger.error(f"{failures} 项自检失败")
+            sys.exit(1)
+        logger.info("全部自检通过")
+        return
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    selected = [s.strip() for s in args.only.split(",") if s.strip()]
+    current = run_benchmarks(sizes, args.repeat, selected)
+
+    for path in filter(None, [args.output, args.save_baseline]):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+        logger.info(f"已写出基准结果: {path}")
+
+    if args.baseline:
+        try:
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                baseline = json.load(f)
+        except Exception as e:
+            logger.error(f"无法加载基线文件 {args.baseline}: {e}")
+            sys.exit(2)
+        regressions = compare_with_baseline(current, baseline, args.threshold, parse_thresholds(args.threshold_for))
+        if regressions:
+            logger.error(f"发现 {len(regressions)} 项性能回归: {regressions}")
+            sys.exit(1)
+        logger.info("未发现性能回归")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        logger.info("用户中断基准测试")
+        sys.exit(1)
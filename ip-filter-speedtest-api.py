@@ -12,8 +12,8 @@ import argparse
 import platform
 import shutil
 import tarfile
-from typing import List, Tuple, Dict
-from collections import defaultdict
+from typing import List, Tuple, Dict, Iterable, Iterator
+from collections import defaultdict, deque
 from charset_normalizer import detect
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
@@ -24,6 +24,28 @@ import atexit
 import stat
 import venv
 import ast
+from contextlib import contextmanager
+import cProfile
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import socket
+import pstats
+import io
+import asyncio
+import ssl
+import errno
+import statistics
+import math
+import ipaddress
+import signal
+import hmac
+import itertools
+import random
+import bisect
+from functools import lru_cache
+import mmap
+import ipcol
 
 # 确保日志文件路径可写
 LOG_FILE = "speedtest.log"
@@ -60,9 +82,20 @@ TEMP_FILE = os.path.join(tempfile.gettempdir(), "temp_proxy.csv")
 TEMP_FILE_CACHE_DURATION = 3600
 INPUT_URL = "https://bihai.cf/CFIP/CUCC/standard.csv"
 COUNTRY_CACHE_FILE = "country_cache.json"
+PORT_STATS_FILE = "port_stats.json"
+NEGATIVE_CACHE_FILE = "negative_cache.json"
+COLO_CACHE_FILE = "colo_cache.json"
+DELTA_FILE = "ips_delta.json"
+DELTA_SNAPSHOT_FILE = "ips_snapshot.json"
+COLUMNAR_FILE = "ip.col"
+CHECKPOINT_FILE = "speedtest_checkpoint.jsonl"
 GEOIP_DB_PATH = Path("GeoLite2-Country.mmdb")
-GEOIP_DB_URL_BACKUP = "https://download.maxmind.com/app/geoip_download?edition_id=GeoLite2-Country&license_key={}&suffix=tar.gz"
+GEOIP_DB_URL_BACKUP = "https://download.maxmind.com/app/geoip_download?edition_id={}&license_key={}&suffix=tar.gz"
+GEOIP_ASN_DB_PATH = Path("GeoLite2-ASN.mmdb")
+ASN_CACHE_FILE = "asn_cache.json"
 MAXMIND_LICENSE_KEY = os.getenv("MAXMIND_LICENSE_KEY", "")
+GEOIP_READER_MODES = ["auto", "mmap_ext", "mmap", "file", "memory"]
+GEOIP_BENCHMARK_LOOKUPS = 200000
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
     "Accept-Language": "en-US,en;q=0.9",
@@ -73,6 +106,103 @@ REQUIRED_PACKAGES = ['requests', 'charset-normalizer', 'geoip2==4.8.0', 'maxmind
 CONFIG_FILE = ".gitconfig.json"
 SSH_KEY_PATH = os.path.expanduser("~/.ssh/id_ed25519")
 VENV_DIR = ".venv"
+RUN_REPORT_FILE = "run_report.json"
+PROM_TEXTFILE = "speedtest.prom"
+METRICS_PREFIX = "apac_speedtest_"
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+SPEED_BUCKETS_MBPS = (1.0, 2.0, 5.0, 8.0, 10.0, 15.0, 20.0, 30.0, 50.0, 100.0)
+PROFILE_DIR = "profile"
+SHARD_PREFIX = "ip.shard"
+COORDINATOR_BIND = "127.0.0.1:8765"
+LEASE_SIZE = 200
+LEASE_TIMEOUT = 900
+LEASE_MAX_ATTEMPTS = 3
+WORKER_POLL_INTERVAL = 5
+WORKER_MAX_FAILURES = 3
+COORDINATOR_IDLE_TIMEOUT = 1800
+COORDINATOR_MAX_BODY = 8 * 1024 * 1024
+PROFILE_TOP_N = 20
+PROBE_HOST = "speed.cloudflare.com"
+PROBE_TRACE_PATH = "/cdn-cgi/trace"
+PROBE_TIMEOUT = 3.0
+TRACE_MAX_BYTES = 4096
+AIMD_INITIAL = 32
+AIMD_MIN = 4
+AIMD_MAX = 512
+AIMD_INCREASE = 4
+AIMD_DECREASE = 0.5
+AIMD_WINDOW = 1.0
+AIMD_MIN_SAMPLES = 20
+AIMD_TIMEOUT_MARGIN = 0.1
+AIMD_RTT_TOLERANCE = 2.0
+AIMD_BASELINE_DRIFT = 0.02
+LIVE_METRICS_INTERVAL = 10
+RESULT_HEADER = ['IP地址', '端口', 'TLS', '数据中心', '地区', '国际代码', '国家', '城市', '网络延迟', '下载速度MB/s']
+DOWNLOAD_CHUNK_SIZE = 65536
+DOWNLOAD_SAMPLE_INTERVAL = 0.2
+DOWNLOAD_MIN_SECONDS = 1.0
+DOWNLOAD_STABLE_WINDOWS = 6
+DOWNLOAD_CI_FACTOR = 2.571  # 6 个窗口时 95% 置信区间的 t 分位数（自由度 5）
+DOWNLOAD_CONFIDENCE = 0.1
+DOWNLOAD_MAX_SECONDS = 10.0
+WARM_POOL_SIZE = 64
+WARM_POOL_IDLE = 60.0
+LATENCY_SAMPLES = 1
+LATENCY_SAMPLE_INTERVAL = 0.25
+LATENCY_SAMPLE_CONCURRENCY = 64
+LATENCY_STATS_HEADER = ['最低延迟ms', '延迟中位数ms', 'P90延迟ms', '抖动ms', '丢包率', '综合得分']
+# 综合得分的权重（毫秒当量，得分越低越好）：loss 为丢包率 100% 时的惩罚，speed 为每 MB/s 下载速度的奖励
+SCORE_WEIGHTS = {"median": 1.0, "p90": 0.5, "jitter": 1.0, "loss": 1000.0, "speed": -10.0}
+CIDR_SAMPLE_PER_SUBNET = 4
+CIDR_SAMPLE_PREFIX_V4 = 24
+CIDR_SAMPLE_PREFIX_V6 = 48
+CIDR_UNKNOWN_COUNTRY = "-"  # 子网查不到国家时 CIDR 抽样主机的国家标记，write_ip_list 视为无国家且不再查询
+CIDR_DEFAULT_PORTS = [443]
+CIDR_MAX_HOSTS = 100000
+WRITE_IP_LIST_CHUNK = 50000
+SEARCH_REPRESENTATIVES = 2
+SEARCH_QUOTA = 50
+PORT_DISCOVERY_PORTS = [443, 50000, 8443, 2053, 8080, 587, 2083, 2087, 2096, 80]
+PORT_DISCOVERY_CONCURRENCY = 256
+PORT_DISCOVERY_MAX_HITS = 1
+NEGATIVE_CACHE_THRESHOLD = 2
+NEGATIVE_CACHE_BASE = 6 * 3600
+NEGATIVE_CACHE_MAX = 7 * 24 * 3600
+NEGATIVE_CACHE_JITTER = 0.2
+NEGATIVE_CACHE_CANARY = 0.05
+TOP_K_PER_COUNTRY = 0
+ASN_CAP_PER_COUNTRY = 0
+WATCH_DEBOUNCE = 2.0
+WATCH_POLL_INTERVAL = 2.0
+WATCH_REFRESH = 6 * 3600
+COLO_CACHE_TTL = 24 * 3600
+COLO_TRACE_CONCURRENCY = 256
+DELTA_SPEED_THRESHOLD = 0.2
+DELTA_LATENCY_THRESHOLD = 20.0
+# 运行截止时间（--deadline）：为发布阶段（去重、生成 ips.txt、增量文件、提交推送）预留的秒数；
+# 列出的阶段最多使用当时剩余工作时间（截止时间减去预留时间）的该比例，未列出的阶段只受剩余工作时间限制
+DEADLINE_RESERVE = 120.0
+DEADLINE_STAGE_SHARES = {"geoip_init": 0.2, "fetch": 0.1, "port_discovery": 0.2, "geo_filter": 0.3,
+                         "speed_test": 0.9, "latency_samples": 1.0}
+DEADLINE_PUBLISH_STAGES = ("dedupe", "generate_ips", "delta_feed", "git_push")
+DEADLINE_PROBE_SHARE = 0.5       # 内置引擎在测速阶段中用于延迟探测的时间比例，其余留给下载测速
+DEADLINE_MIN_DOWNLOAD = 2.0      # 剩余时间少于该秒数时不再开始新的下载测速
+DEADLINE_IPTEST_MARGIN = 0.8     # 按上次的 iptest 吞吐估算节点数时留出的余量
+DEADLINE_FALLBACK_MAX_AGE = 21600  # 测速被截断且本次没有结果时，沿用旧 ip.csv 发布的最长文件年龄（秒）
+IPTEST_READER_JOIN_TIMEOUT = 5.0  # iptest 结束后等待输出读取线程的最长秒数
+CHECKPOINT_MAX_AGE = 6 * 3600
+CHECKPOINT_SYNC_INTERVAL = 1.0
+CHECKPOINT_NATIVE_FIELDS = ("ip", "port", "outcome", "latency_ms", "colo", "mbps", "stop_reason")
+
+# 本地资源耗尽（文件描述符、缓冲区、临时端口）时的错误码，内置探测引擎将其视为拥塞信号
+LOCAL_RESOURCE_ERRNOS = {errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM, errno.EADDRNOTAVAIL}
+
+# iptest 输出中的有效节点行，例如“发现有效IP 1.2.3.4 端口 443 位置信息 东京 延迟 104 毫秒”
+IPTEST_VALID_LINE_PATTERN = re.compile(r'发现有效IP\s+(\S+)\s+端口\s+(\d+).*?延迟\s+(\d+)\s*毫秒')
+IPV4_PATTERN = re.compile(r'^(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$')
+IPV4_LEADING_ZERO_PATTERN = re.compile(r'(?:^|\.)0\d')
+# IPv4 映射到 ::ffff:0:0/96，与 IPv6 共用 128 位整数键空间
+IPV4_MAPPED_PREFIX = 0xFFFF00000000
 
 # 国家代码和标签
 COUNTRY_LABELS = {
@@ -209,6 +339,384 @@ IATA_TO_COUNTRY = {
     'GIB': 'GI',
 }
 
+# 运行指标：计数器、仪表、直方图和阶段耗时，运行结束时导出为 JSON 报告和 Prometheus textfile
+metrics_lock = threading.Lock()
+run_metrics = {
+    "started_at": time.time(),
+    "status": "failed",
+    "stages": {},
+    "counters": defaultdict(float),
+    "gauges": {},
+    "histograms": {},
+}
+metrics_outputs = {"report": RUN_REPORT_FILE, "textfile": PROM_TEXTFILE}
+
+def _metric_key(name: str, labels: Dict[str, str]) -> str:
+    """生成带标签的指标键，格式与 Prometheus 一致，例如 nodes_kept_total{country="JP"}"""
+    if not labels:
+        return name
+    label_str = ",".join(f'{k}="{labels[k]}"' for k in sorted(labels))
+    return f"{name}{{{label_str}}}"
+
+def metric_inc(name: str, value: float = 1, **labels):
+    """累加计数器"""
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        run_metrics["counters"][key] += value
+
+def metric_set(name: str, value: float, **labels):
+    """设置仪表值"""
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        run_metrics["gauges"][key] = value
+
+def metric_observe(name: str, value: float, buckets: Tuple[float, ...] = HISTOGRAM_BUCKETS, **labels):
+    """记录一次直方图观测值"""
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        hist = run_metrics["histograms"].get(key)
+        if hist is None:
+            hist = {"buckets": list(buckets), "counts": [0] * len(buckets), "count": 0, "sum": 0.0}
+            run_metrics["histograms"][key] = hist
+        for i, bound in enumerate(hist["buckets"]):
+            if value <= bound:
+                hist["counts"][i] += 1
+        hist["count"] += 1
+        hist["sum"] += value
+
+def metric_value(name: str, **labels) -> float:
+    """读取计数器当前值"""
+    with metrics_lock:
+        return run_metrics["counters"].get(_metric_key(name, labels), 0.0)
+
+# 性能剖析（--profile）：默认关闭，关闭时 stage_timer 只多一次布尔判断
+# 每个阶段只保留一个合并后的 pstats.Stats，--watch 多轮运行时内存不随轮数增长
+profile_settings = {"enabled": False, "dir": PROFILE_DIR, "top": PROFILE_TOP_N}
+stage_profiles = {}
+
+# CIDR 输入设置：每个子网的抽样主机数、缺省端口、随机种子（None 表示每次运行抽样不同的主机）和展开上限，由 main() 更新
+cidr_settings = {"sample": CIDR_SAMPLE_PER_SUBNET, "ports": list(CIDR_DEFAULT_PORTS), "seed": None, "max_hosts": CIDR_MAX_HOSTS}
+
+# 端口发现设置：只有 IP 没有端口的条目按端口列表探测，由 main() 根据 --port-discovery 等参数更新
+discovery_settings = {"enabled": False, "ports": list(PORT_DISCOVERY_PORTS), "concurrency": PORT_DISCOVERY_CONCURRENCY,
+                      "max_hits": PORT_DISCOVERY_MAX_HITS}
+
+# 负缓存设置：连续失败的节点按指数退避隔离，由 main() 根据 --negative-cache 等参数更新
+negative_cache_settings = {"enabled": False, "threshold": NEGATIVE_CACHE_THRESHOLD, "base": NEGATIVE_CACHE_BASE,
+                           "max": NEGATIVE_CACHE_MAX, "canary": NEGATIVE_CACHE_CANARY}
+# 本次测速中各节点（键为 ip_key << 16 | 端口）是否有效：内置引擎记录每个探测过的节点，iptest 只记录输出中的有效节点
+probe_outcomes = {}
+# 本次 iptest 已输出“发现有效IP”的节点 {(IP, 端口): 延迟毫秒}，iptest 被时间预算截断时用来生成本次的部分结果
+iptest_latencies = {}
+
+# 探测引擎设置：iptest（外部程序）或 native（内置 asyncio 探测，AIMD 自适应并发），由 main() 根据命令行参数更新
+probe_settings = {"engine": "iptest", "timeout": PROBE_TIMEOUT, "initial": AIMD_INITIAL, "min": AIMD_MIN, "max": AIMD_MAX,
+                  "download_confidence": DOWNLOAD_CONFIDENCE, "download_max_seconds": DOWNLOAD_MAX_SECONDS,
+                  "latency_samples": LATENCY_SAMPLES, "latency_interval": LATENCY_SAMPLE_INTERVAL, "score_weights": dict(SCORE_WEIGHTS),
+                  "search": "full", "search_representatives": SEARCH_REPRESENTATIVES, "search_quota": SEARCH_QUOTA,
+                  "warm_pool_size": WARM_POOL_SIZE, "warm_pool_idle": WARM_POOL_IDLE}
+
+# write_ip_list 保留节点的国家（键为 ip_key << 16 | 端口），只在 --search subnet 或 --asn 时记录，
+# 供按国家配额的子网搜索和按国家分组的 ASN 分散使用；CIDR 展开的主机按抽样子网（subnet_key）记录一次，
+# 只有国家与所在子网不同的主机（如按数据中心判断）才单独记入 node_countries
+node_countries = {}
+cidr_subnet_countries = {}
+
+# ASN 分散设置：按 (国家, ASN) 分组轮询排列 ip.txt，cap 为每组最多保留的节点数（0 表示不限制），由 main() 更新
+asn_settings = {"enabled": False, "cap": ASN_CAP_PER_COUNTRY}
+
+# 按 Cloudflare 数据中心判断国家的设置：启用后 write_ip_list 先经由每个节点请求 /cdn-cgi/trace，
+# 以 colo 对应的国家（IATA_TO_COUNTRY）代替数据源或 GeoIP 的国家，结果按 TTL 缓存，由 main() 根据 --colo-country 等参数更新
+colo_settings = {"enabled": False, "ttl": COLO_CACHE_TTL, "concurrency": COLO_TRACE_CONCURRENCY}
+
+# 增量输出设置：file 为空表示不输出；速度相对变化或延迟绝对变化超过阈值的节点记为变化，由 main() 更新
+delta_settings = {"file": DELTA_FILE, "speed_threshold": DELTA_SPEED_THRESHOLD, "latency_threshold": DELTA_LATENCY_THRESHOLD}
+
+# 列式结果输出路径（见 ipcol.py），为空表示不输出，由 main() 根据 --columnar-file 更新
+columnar_settings = {"file": COLUMNAR_FILE}
+
+# 测速检查点设置：file 为空表示不写检查点；resume 时跳过检查点中 max_age 秒内测过的节点并合并其结果，
+# 由 main() 根据 --checkpoint-file、--resume 等参数更新
+checkpoint_settings = {"file": CHECKPOINT_FILE, "resume": False, "max_age": CHECKPOINT_MAX_AGE}
+# 本次测速正在写入的检查点（CheckpointLog），不在测速中时为 None
+active_checkpoint = None
+
+# 运行截止时间设置：end 为截止的 time.monotonic() 时刻（None 表示不限制），reserve 为发布阶段预留的秒数，
+# iptest_rate 为上次运行的测速吞吐（节点/秒），由 main() 根据 --deadline 更新；
+# stage_end 为当前阶段的截止时刻，由 stage_timer 进入阶段时计算
+deadline_settings = {"end": None, "reserve": DEADLINE_RESERVE, "iptest_rate": 0.0, "stage_end": None}
+
+def plan_stage_deadline(stage: str, outer_end: float = None) -> float:
+    """为进入的阶段分配截止时刻（time.monotonic()），未设置 --deadline 时返回 None
+
+    发布阶段可以用到运行截止时间；其他阶段不超过截止时间减去预留时间，DEADLINE_STAGE_SHARES 中的阶段
+    只分到剩余工作时间的一部分；嵌套的阶段不超过外层阶段的截止时刻。
+    """
+    end = deadline_settings["end"]
+    if end is None:
+        return None
+    if stage in DEADLINE_PUBLISH_STAGES:
+        return end
+    now = time.monotonic()
+    work_left = max(end - deadline_settings["reserve"] - now, 0.0)
+    stage_end = now + work_left * DEADLINE_STAGE_SHARES.get(stage, 1.0)
+    if outer_end is not None:
+        stage_end = min(stage_end, outer_end)
+    if stage in DEADLINE_STAGE_SHARES:
+        metric_set("stage_budget_seconds", stage_end - now, stage=stage)
+        logger.info(f"时间预算: 阶段 {stage} 最多 {stage_end - now:.0f} 秒（距截止 {end - now:.0f} 秒）")
+    return stage_end
+
+def time_left() -> float:
+    """当前阶段剩余的秒数（不在阶段中时为距运行截止的秒数），未设置 --deadline 时为无穷大"""
+    end = deadline_settings["stage_end"] if deadline_settings["stage_end"] is not None else deadline_settings["end"]
+    return float('inf') if end is None else end - time.monotonic()
+
+def deadline_cutoff(stage: str, message: str):
+    """记录一次因时间预算不足而提前结束或跳过的工作"""
+    metric_inc("deadline_cutoffs_total", stage=stage)
+    logger.warning(f"时间预算不足: {message}")
+
+@contextmanager
+def deadline_share(share: float):
+    """在当前阶段内划出子预算：期间 time_left() 只计当前剩余时间的 share 部分，未设置 --deadline 时不起作用"""
+    previous_end = deadline_settings["stage_end"]
+    left = time_left()
+    if left != float('inf'):
+        deadline_settings["stage_end"] = time.monotonic() + max(left, 0.0) * share
+    try:
+        yield
+    finally:
+        deadline_settings["stage_end"] = previous_end
+
+def load_speed_test_rate(report_path: str) -> float:
+    """由上次的运行报告估算测速吞吐（节点/秒），没有报告或报告中没有测速阶段时返回 0"""
+    try:
+        with open(report_path, "r", encoding="utf-8") as f:
+            report = json.load(f)
+        elapsed = report["stages"].get("speed_test", 0.0)
+        nodes = report["counters"].get("probe_nodes_total", 0.0)
+        return nodes / elapsed if elapsed > 0 and nodes > 0 else 0.0
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return 0.0
+
+@contextmanager
+def stage_timer(stage: str):
+    """记录阶段耗时（同名阶段累加），启用 --profile 时同时用 cProfile 剖析该阶段
+
+    设置了 --deadline 时同时为该阶段分配截止时刻，阶段内的工作通过 time_left() 查询剩余时间。
+    """
+    profiler = None
+    if profile_settings["enabled"]:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    previous_end = deadline_settings["stage_end"]
+    deadline_settings["stage_end"] = plan_stage_deadline(stage, previous_end)
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        deadline_settings["stage_end"] = previous_end
+        elapsed = time.perf_counter() - start_time
+        if profiler is not None:
+            profiler.disable()
+            if stage in stage_profiles:
+                stage_profiles[stage].add(profiler)
+            else:
+                stage_profiles[stage] = pstats.Stats(profiler, stream=io.StringIO())
+        with metrics_lock:
+            run_metrics["stages"][stage] = run_metrics["stages"].get(stage, 0.0) + elapsed
+        metric_observe("stage_duration_seconds", elapsed, stage=stage)
+
+def enable_profiling(profile_dir: str = PROFILE_DIR, top_n: int = PROFILE_TOP_N):
+    """启用按阶段剖析，退出时写出 .pstats、折叠栈文件和热点汇总"""
+    profile_settings.update(enabled=True, dir=profile_dir, top=top_n)
+    atexit.register(dump_stage_profiles)
+    logger.info(f"已启用性能剖析，输出目录: {profile_dir}")
+
+def _profile_frame_name(func: Tuple[str, int, str]) -> str:
+    """将 pstats 的函数键转换为折叠栈中的帧名"""
+    file_name, line_no, func_name = func
+    if file_name == "~":
+        frame = func_name
+    else:
+        frame = f"{os.path.basename(file_name)}:{line_no}({func_name})"
+    return frame.replace(";", ",")
+
+def pstats_to_folded(stats: pstats.Stats, root: str, max_depth: int = 64) -> List[str]:
+    """将 pstats 调用图展开为 flamegraph.pl / speedscope 可用的折叠栈格式（单位: 微秒）
+
+    cProfile 只记录调用边，不记录完整调用栈，因此按每条调用边的累计耗时占比
+    向下分摊自身耗时，结果与调用图一致，但深层栈的分摊是近似值。
+    """
+    callees = defaultdict(dict)
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge[3]
+    folded = defaultdict(float)
+    on_path = set()
+
+    def walk(func, path, ratio):
+        self_time = stats.stats[func][2]
+        frames = path + [_profile_frame_name(func)]
+        folded[";".join(frames)] += self_time * ratio
+        if len(frames) >= max_depth:
+            return
+        for callee, edge_cum_time in callees.get(func, {}).items():
+            if callee in on_path or callee not in stats.stats:
+                continue
+            callee_cum_time = stats.stats[callee][3]
+            if callee_cum_time <= 0:
+                continue
+            # 该调用边在被调函数总耗时中的占比，乘以当前路径的占比
+            child_ratio = ratio * min(edge_cum_time / callee_cum_time, 1.0)
+            if callee_cum_time * child_ratio < 1e-6:
+                continue  # 小于 1 微秒的分支不再展开，避免调用图路径数爆炸
+            on_path.add(callee)
+            walk(callee, frames, child_ratio)
+            on_path.discard(callee)
+
+    roots = [func for func, value in stats.stats.items() if not value[4]]
+    for func in roots:
+        on_path.clear()
+        on_path.add(func)
+        walk(func, [root], 1.0)
+    return [f"{stack} {int(value * 1e6)}" for stack, value in sorted(folded.items()) if int(value * 1e6) > 0]
+
+def dump_stage_profiles():
+    """写出每个阶段的 .pstats 和 .folded 文件，并打印跨阶段的前 N 个热点函数"""
+    if not stage_profiles:
+        return
+    profile_dir = profile_settings["dir"]
+    try:
+        os.makedirs(profile_dir, exist_ok=True)
+    except Exception as e:
+        logger.warning(f"无法创建剖析输出目录 {profile_dir}: {e}")
+        return
+    hotspots = []
+    for stage, stats in stage_profiles.items():
+        try:
+            stats_path = os.path.join(profile_dir, f"{stage}.pstats")
+            stats.dump_stats(stats_path)
+            folded_path = os.path.join(profile_dir, f"{stage}.folded")
+            with open(folded_path, "w", encoding="utf-8") as f:
+                f.write("\n".join(pstats_to_folded(stats, stage)) + "\n")
+            logger.info(f"已写出阶段 {stage} 的剖析结果: {stats_path}, {folded_path}")
+            for func, (_, ncalls, self_time, cum_time, _) in stats.stats.items():
+                hotspots.append((self_time, cum_time, ncalls, stage, func))
+        except Exception as e:
+            logger.warning(f"无法写出阶段 {stage} 的剖析结果: {e}")
+    hotspots.sort(key=lambda x: x[0], reverse=True)
+    logger.info(f"性能热点 (按自身耗时排序，前 {profile_settings['top']} 项):")
+    logger.info(f"{'自身耗时(s)':>12} {'累计耗时(s)':>12} {'调用次数':>10}  阶段 / 函数")
+    for self_time, cum_time, ncalls, stage, func in hotspots[:profile_settings["top"]]:
+        logger.info(f"{self_time:>12.4f} {cum_time:>12.4f} {ncalls:>10}  {stage} / {_profile_frame_name(func)}")
+
+def build_run_report() -> Dict:
+    """汇总本次运行的指标，并计算解析速率、GeoIP 缓存命中率等派生指标"""
+    with metrics_lock:
+        counters = dict(run_metrics["counters"])
+        gauges = dict(run_metrics["gauges"])
+        histograms = {k: dict(v) for k, v in run_metrics["histograms"].items()}
+        stages = dict(run_metrics["stages"])
+    finished_at = time.time()
+    derived = {}
+    parse_seconds = stages.get("parse", 0.0)
+    if parse_seconds > 0:
+        derived["parse_rows_per_second"] = round(counters.get("parse_rows_total", 0.0) / parse_seconds, 2)
+    lookups = counters.get("geoip_cache_hits_total", 0.0) + counters.get("geoip_cache_misses_total", 0.0)
+    if lookups:
+        derived["geoip_cache_hit_rate"] = round(counters.get("geoip_cache_hits_total", 0.0) / lookups, 4)
+    probes = counters.get("probe_nodes_total", 0.0)
+    if probes:
+        derived["probe_timeout_rate"] = round(counters.get("probe_timeouts_total", 0.0) / probes, 4)
+    return {
+        "started_at": run_metrics["started_at"],
+        "finished_at": finished_at,
+        "duration_seconds": round(finished_at - run_metrics["started_at"], 3),
+        "status": run_metrics["status"],
+        "stages": {k: round(v, 3) for k, v in stages.items()},
+        "counters": counters,
+        "gauges": gauges,
+        "histograms": histograms,
+        "derived": derived,
+    }
+
+def _prometheus_metric_name(key: str) -> Tuple[str, str]:
+    """拆分指标键为 (带前缀的名称, 标签部分)"""
+    name, _, labels = key.partition("{")
+    return METRICS_PREFIX + name, ("{" + labels) if labels else ""
+
+def _merge_labels(labels: str, extra: str) -> str:
+    if not labels:
+        return "{" + extra + "}"
+    return labels[:-1] + "," + extra + "}"
+
+def format_prometheus_textfile(report: Dict) -> str:
+    """将运行报告转换为 Prometheus textfile collector 格式"""
+    lines = []
+    typed = set()
+
+    def declare(name: str, metric_type: str):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {metric_type}")
+
+    for key in sorted(report["counters"]):
+        name, labels = _prometheus_metric_name(key)
+        declare(name, "counter")
+        lines.append(f"{name}{labels} {report['counters'][key]}")
+    for key in sorted(report["gauges"]):
+        name, labels = _prometheus_metric_name(key)
+        declare(name, "gauge")
+        lines.append(f"{name}{labels} {report['gauges'][key]}")
+    for stage in sorted(report["stages"]):
+        name = METRICS_PREFIX + "stage_last_duration_seconds"
+        declare(name, "gauge")
+        lines.append(f'{name}{{stage="{stage}"}} {report["stages"][stage]}')
+    for key, value in sorted(report["derived"].items()):
+        name = METRICS_PREFIX + key
+        declare(name, "gauge")
+        lines.append(f"{name} {value}")
+    for key in sorted(report["histograms"]):
+        hist = report["histograms"][key]
+        name, labels = _prometheus_metric_name(key)
+        declare(name, "histogram")
+        for bound, count in zip(hist["buckets"], hist["counts"]):
+            bucket_labels = _merge_labels(labels, f'le="{bound}"')
+            lines.append(f"{name}_bucket{bucket_labels} {count}")
+        bucket_labels = _merge_labels(labels, 'le="+Inf"')
+        lines.append(f"{name}_bucket{bucket_labels} {hist['count']}")
+        lines.append(f"{name}_sum{labels} {hist['sum']}")
+        lines.append(f"{name}_count{labels} {hist['count']}")
+    for name, value in (("run_duration_seconds", report["duration_seconds"]),
+                        ("run_success", 1 if report["status"] == "success" else 0),
+                        ("run_finished_timestamp_seconds", round(report["finished_at"], 3))):
+        declare(METRICS_PREFIX + name, "gauge")
+        lines.append(f"{METRICS_PREFIX}{name} {value}")
+    return "\n".join(lines) + "\n"
+
+def export_run_metrics(report_path: str = RUN_REPORT_FILE, textfile_path: str = PROM_TEXTFILE):
+    """写出 JSON 运行报告和 Prometheus textfile（先写临时文件再原子替换）"""
+    report = build_run_report()
+    outputs = []
+    if report_path:
+        outputs.append((report_path, json.dumps(report, ensure_ascii=False, indent=2)))
+    if textfile_path:
+        outputs.append((textfile_path, format_prometheus_textfile(report)))
+    for path, content in outputs:
+        try:
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(temp_path, path)
+            logger.info(f"已写出运行指标: {path}")
+        except Exception as e:
+            logger.warning(f"无法写出运行指标 {path}: {e}")
+    stage_summary = ", ".join(f"{k}={v:.2f}s" for k, v in report["stages"].items())
+    if stage_summary:
+        logger.info(f"阶段耗时: {stage_summary}")
+
 def find_speedtest_script() -> str:
     system = platform.system().lower()
     candidates = []
@@ -267,6 +775,20 @@ def parse_speedlimit_from_script(script_path: str) -> float:
         logger.warning(f"无法解析 {script_path} 的 speedlimit 参数: {e}，使用默认值 8.0 MB/s")
         return 8.0
 
+def parse_download_bytes_from_script(script_path: str) -> int:
+    """从 iptest.sh 或 iptest.bat 的 -url 参数解析每个节点的下载字节数（__down?bytes=），未找到时返回 0"""
+    try:
+        with open(script_path, "rb") as f:
+            raw_data = f.read()
+        encoding = detect(raw_data).get("encoding", "utf-8") or "utf-8"
+        content = raw_data.decode(encoding, errors="replace")
+        bytes_match = re.search(r'bytes=(\d+)', content)
+        if bytes_match:
+            return int(bytes_match.group(1))
+    except Exception as e:
+        logger.warning(f"无法解析 {script_path} 的下载字节数: {e}")
+    return 0
+
 def filter_ip_csv_by_speed(csv_file: str, speed_limit: float):
     """根据 speed_limit 过滤 ip.csv 中的低速节点"""
     try:
@@ -302,6 +824,9 @@ def filter_ip_csv_by_speed(csv_file: str, speed_limit: float):
         logger.error(f"过滤 {csv_file} 失败: {e}")
 
 geoip_reader = None
+asn_reader = None
+# GeoIP 数据库读取模式，由 main() 根据 --geoip-mode 更新
+geoip_settings = {"mode": "auto"}
 
 def cleanup_temp_file():
     if os.path.exists(TEMP_FILE):
@@ -463,31 +988,31 @@ def setup_and_activate_venv():
         logger.error(f"无法导入关键模块: {e}")
         sys.exit(1)
 
-def get_latest_geoip_url() -> str:
+def get_latest_geoip_url(asset_name: str = "GeoLite2-Country.mmdb") -> str:
     api_url = "https://api.github.com/repos/P3TERX/GeoLite.mmdb/releases/latest"
     logger.info(f"正在从 GitHub API 获取最新版本: {api_url}")
     try:
         session = requests.Session()
         retry = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504, 429])
         session.mount('https://', HTTPAdapter(max_retries=retry))
-        response = session.get(api_url, headers=HEADERS, timeout=30)
+        response = session.get(api_url, headers=HEADERS, timeout=max(1.0, min(30, time_left())))
         response.raise_for_status()
         release_data = response.json()
         
         for asset in release_data.get("assets", []):
-            if asset.get("name") == "GeoLite2-Country.mmdb":
+            if asset.get("name") == asset_name:
                 download_url = asset.get("browser_download_url")
                 logger.info(f"找到最新 GeoIP 数据库 URL: {download_url}")
                 return download_url
         
-        logger.error("未找到 GeoLite2-Country.mmdb 的下载 URL")
+        logger.error(f"未找到 {asset_name} 的下载 URL")
         return ""
     except Exception as e:
         logger.error(f"无法获取最新 GeoIP 数据库 URL: {e}")
         return ""
 
-def download_geoip_database(dest_path: Path) -> bool:
-    url = get_latest_geoip_url()
+def download_geoip_database(dest_path: Path, asset_name: str = "GeoLite2-Country.mmdb") -> bool:
+    url = get_latest_geoip_url(asset_name)
     if not url:
         logger.error("无法获取最新 GeoIP 数据库 URL")
         return False
@@ -506,17 +1031,22 @@ def download_geoip_database(dest_path: Path) -> bool:
             urls_to_try.append((proxy_name, proxy_url))
     
     for proxy_name, download_url in urls_to_try:
+        if time_left() <= 0:
+            deadline_cutoff("geoip_init", "不再尝试其余下载源")
+            break
         logger.info(f"下载 GeoIP 数据库（使用 {proxy_name}）: {download_url}")
         try:
             session = requests.Session()
             retry = Retry(total=5, backoff_factor=2, status_forcelist=[500, 502, 503, 504, 429])
             session.mount('https://', HTTPAdapter(max_retries=retry))
-            response = session.get(download_url, timeout=60, stream=True, headers=HEADERS)
+            response = session.get(download_url, timeout=max(1.0, min(60, time_left())), stream=True, headers=HEADERS)
             response.raise_for_status()
             total_size = int(response.headers.get('content-length', 0))
             downloaded = 0
             with open(dest_path, "wb") as f:
                 for chunk in response.iter_content(chunk_size=8192):
+                    if time_left() <= 0:
+                        raise TimeoutError("下载超出时间预算")
                     if chunk:
                         f.write(chunk)
                         downloaded += len(chunk)
@@ -536,11 +1066,11 @@ def download_geoip_database(dest_path: Path) -> bool:
     logger.error("所有代理服务均无法下载 GeoIP 数据库")
     return False
 
-def download_geoip_database_maxmind(dest_path: Path) -> bool:
+def download_geoip_database_maxmind(dest_path: Path, edition: str = "GeoLite2-Country") -> bool:
     if not MAXMIND_LICENSE_KEY:
         logger.warning("未设置 MAXMIND_LICENSE_KEY，无法从 MaxMind 下载 GeoIP 数据库。请在环境变量中设置 MAXMIND_LICENSE_KEY 或检查 GitHub 下载源。")
         return False
-    url = GEOIP_DB_URL_BACKUP.format(MAXMIND_LICENSE_KEY)
+    url = GEOIP_DB_URL_BACKUP.format(edition, MAXMIND_LICENSE_KEY)
     logger.info(f"从 MaxMind 下载 GeoIP 数据库: {url}")
     try:
         if dest_path.exists():
@@ -550,13 +1080,15 @@ def download_geoip_database_maxmind(dest_path: Path) -> bool:
         session = requests.Session()
         retry = Retry(total=5, backoff_factor=2, status_forcelist=[500, 502, 503, 504, 429])
         session.mount('https://', HTTPAdapter(max_retries=retry))
-        response = session.get(url, timeout=60, stream=True, headers=HEADERS)
+        response = session.get(url, timeout=max(1.0, min(60, time_left())), stream=True, headers=HEADERS)
         response.raise_for_status()
         total_size = int(response.headers.get('content-length', 0))
         downloaded = 0
         temp_tar = dest_path.with_suffix(".tar.gz")
         with open(temp_tar, "wb") as f:
             for chunk in response.iter_content(chunk_size=8192):
+                if time_left() <= 0:
+                    raise TimeoutError("下载超出时间预算")
                 if chunk:
                     f.write(chunk)
                     downloaded += len(chunk)
@@ -565,7 +1097,7 @@ def download_geoip_database_maxmind(dest_path: Path) -> bool:
                         logger.info(f"下载进度: {progress:.2f}%")
         with tarfile.open(temp_tar, "r:gz") as tar:
             for member in tar.getmembers():
-                if member.name.endswith("GeoLite2-Country.mmdb"):
+                if member.name.endswith(f"{edition}.mmdb"):
                     tar.extract(member, dest_path.parent)
                     extracted_path = dest_path.parent / member.name
                     extracted_path.rename(dest_path)
@@ -581,22 +1113,22 @@ def download_geoip_database_maxmind(dest_path: Path) -> bool:
         temp_tar.unlink(missing_ok=True)
         return False
 
+def is_geoip_file_valid(file_path: Path) -> bool:
+    if not file_path.exists():
+        return False
+    if file_path.stat().st_size < 1024 * 1024:
+        logger.warning(f"GeoIP 数据库文件 {file_path} 过小，可能无效")
+        return False
+    mtime = file_path.stat().st_mtime
+    current_time = time.time()
+    age_days = (current_time - mtime) / (24 * 3600)
+    if age_days > 30:
+        logger.warning(f"GeoIP 数据库文件 {file_path} 已超过 30 天 ({age_days:.1f} 天)，建议使用 --update-geoip 更新")
+    return True
+
 def init_geoip_reader(offline: bool = False, update_geoip: bool = False):
     global geoip_reader
     
-    def is_geoip_file_valid(file_path: Path) -> bool:
-        if not file_path.exists():
-            return False
-        if file_path.stat().st_size < 1024 * 1024:
-            logger.warning(f"GeoIP 数据库文件 {file_path} 过小，可能无效")
-            return False
-        mtime = file_path.stat().st_mtime
-        current_time = time.time()
-        age_days = (current_time - mtime) / (24 * 3600)
-        if age_days > 30:
-            logger.warning(f"GeoIP 数据库文件 {file_path} 已超过 30 天 ({age_days:.1f} 天)，建议使用 --update-geoip 更新")
-        return True
-    
     if offline:
         logger.info("离线模式启用，将使用本地 GeoIP 数据库")
         if not GEOIP_DB_PATH.exists():
@@ -623,11 +1155,7 @@ def init_geoip_reader(offline: bool = False, update_geoip: bool = False):
                     sys.exit(1)
     
     try:
-        import geoip2.database
-        with geoip2.database.Reader(GEOIP_DB_PATH) as reader:
-            logger.info("GeoIP 数据库验证成功")
-        geoip_reader = geoip2.database.Reader(GEOIP_DB_PATH)
-        logger.info("GeoIP 数据库加载成功")
+        geoip_reader = open_geoip_reader(geoip_settings["mode"])
     except ImportError as e:
         logger.error(f"无法导入 geoip2.database: {e}. 请确保 geoip2==4.8.0 已安装，并检查虚拟环境")
         sys.exit(1)
@@ -645,13 +1173,111 @@ def init_geoip_reader(offline: bool = False, update_geoip: bool = False):
             if not success:
                 logger.error("重新下载 GeoIP 数据库失败")
                 sys.exit(1)
-        with geoip2.database.Reader(GEOIP_DB_PATH) as reader:
-            logger.info("GeoIP 数据库验证成功")
-        geoip_reader = geoip2.database.Reader(GEOIP_DB_PATH)
-        logger.info("GeoIP 数据库加载成功")
+        geoip_reader = open_geoip_reader(geoip_settings["mode"])
+
+def geoip_extension_available() -> bool:
+    """maxminddb 的 C 扩展（基于 libmaxminddb）是否可用"""
+    try:
+        import maxminddb.extension
+        return hasattr(maxminddb.extension, "Reader")
+    except ImportError:
+        return False
+
+def geoip_reader_mode(reader) -> str:
+    """Reader 实际使用的读取模式：mmap_ext（C 扩展）、mmap、file 或 memory"""
+    db_reader = getattr(reader, "_db_reader", reader)
+    if type(db_reader).__module__.startswith("maxminddb.extension"):
+        return "mmap_ext"
+    buffer = getattr(db_reader, "_buffer", None)
+    if isinstance(buffer, mmap.mmap):
+        return "mmap"
+    if isinstance(buffer, (bytes, bytearray)):
+        return "memory"
+    return "file"
+
+def open_geoip_reader(mode: str = "auto", quiet: bool = False, path: Path = GEOIP_DB_PATH):
+    """按指定模式打开 GeoIP 数据库（只打开一次），通过读取元数据验证文件，并报告实际使用的模式
+
+    auto 依次尝试 C 扩展、mmap 和普通文件读取；指定 mmap_ext 但 C 扩展不可用时退回 auto。
+    """
+    import geoip2.database
+    import maxminddb
+    if mode == "mmap_ext" and not geoip_extension_available():
+        logger.warning("maxminddb C 扩展不可用，GeoIP 读取模式退回 auto")
+        mode = "auto"
+    mode_values = {"auto": maxminddb.MODE_AUTO, "mmap_ext": maxminddb.MODE_MMAP_EXT, "mmap": maxminddb.MODE_MMAP,
+                   "file": maxminddb.MODE_FILE, "memory": maxminddb.MODE_MEMORY}
+    start_time = time.perf_counter()
+    reader = geoip2.database.Reader(str(path), mode=mode_values[mode])
+    try:
+        metadata = reader.metadata()
+    except Exception:
+        reader.close()
+        raise
+    if not quiet:
+        effective = geoip_reader_mode(reader)
+        if path == GEOIP_DB_PATH:
+            metric_set("geoip_reader_extension", 1 if effective == "mmap_ext" else 0)
+        logger.info(f"GeoIP 数据库加载成功: {metadata.database_type}，构建于 "
+                    f"{time.strftime('%Y-%m-%d', time.gmtime(metadata.build_epoch))}，"
+                    f"读取模式 {effective}（请求 {mode}），C 扩展{'可用' if geoip_extension_available() else '不可用'}，"
+                    f"打开耗时 {(time.perf_counter() - start_time) * 1000:.1f} ms")
+    return reader
+
+def benchmark_geoip_modes(lookups: int = GEOIP_BENCHMARK_LOOKUPS) -> Dict[str, Dict[str, float]]:
+    """对每种读取模式测量打开耗时和每秒查询次数，用于为运行环境选择 --geoip-mode
+
+    查询随机的 IPv4 地址（固定随机种子，各模式查询相同的地址），返回 {模式: {"open_ms", "lookups_per_second"}}。
+    """
+    rng = random.Random(0)
+    ips = [socket.inet_ntoa(rng.getrandbits(32).to_bytes(4, 'big')) for _ in range(lookups)]
+    results = {}
+    for mode in GEOIP_READER_MODES[1:]:
+        if mode == "mmap_ext" and not geoip_extension_available():
+            logger.info("GeoIP 基准: maxminddb C 扩展不可用，跳过 mmap_ext")
+            continue
+        start_time = time.perf_counter()
+        reader = open_geoip_reader(mode, quiet=True)
+        open_ms = (time.perf_counter() - start_time) * 1000
+        try:
+            start_time = time.perf_counter()
+            for ip in ips:
+                try:
+                    reader.country(ip)
+                except Exception:
+                    pass
+            elapsed = max(time.perf_counter() - start_time, 1e-9)
+        finally:
+            reader.close()
+        results[mode] = {"open_ms": round(open_ms, 2), "lookups_per_second": round(lookups / elapsed)}
+        metric_set("geoip_benchmark_lookups_per_second", results[mode]["lookups_per_second"], mode=mode)
+        logger.info(f"GeoIP 基准 {mode}: 打开 {open_ms:.1f} ms，{lookups / elapsed:,.0f} 次查询/秒")
+    if results:
+        fastest = max(results, key=lambda mode: results[mode]["lookups_per_second"])
+        logger.info(f"GeoIP 基准: 最快的读取模式为 {fastest}，可通过 --geoip-mode {fastest} 使用")
+    return results
+
+def init_asn_reader(offline: bool = False, update_geoip: bool = False) -> bool:
+    """加载 GeoLite2-ASN 数据库（与国家数据库相同的下载源和缓存方式）；ASN 只用于分散测速节点，失败时不退出"""
+    global asn_reader
+    if not offline and (update_geoip or not is_geoip_file_valid(GEOIP_ASN_DB_PATH)):
+        GEOIP_ASN_DB_PATH.unlink(missing_ok=True)
+        logger.info(f"下载 ASN 数据库: {GEOIP_ASN_DB_PATH}")
+        if not download_geoip_database(GEOIP_ASN_DB_PATH, "GeoLite2-ASN.mmdb"):
+            logger.warning("主下载源失败，尝试 MaxMind")
+            download_geoip_database_maxmind(GEOIP_ASN_DB_PATH, "GeoLite2-ASN")
+    if not GEOIP_ASN_DB_PATH.exists():
+        logger.warning(f"未找到 ASN 数据库 {GEOIP_ASN_DB_PATH}，不按 ASN 分散节点")
+        return False
+    try:
+        asn_reader = open_geoip_reader(geoip_settings["mode"], path=GEOIP_ASN_DB_PATH)
+        return True
+    except Exception as e:
+        logger.warning(f"ASN 数据库加载失败: {e}，不按 ASN 分散节点")
+        return False
 
 def close_geoip_reader():
-    global geoip_reader
+    global geoip_reader, asn_reader
     if geoip_reader:
         try:
             geoip_reader.close()
@@ -659,6 +1285,12 @@ def close_geoip_reader():
         except Exception as e:
             logger.warning(f"关闭 GeoIP 数据库失败: {e}")
         geoip_reader = None
+    if asn_reader:
+        try:
+            asn_reader.close()
+        except Exception as e:
+            logger.warning(f"关闭 ASN 数据库失败: {e}")
+        asn_reader = None
 
 atexit.register(close_geoip_reader)
 
@@ -681,6 +1313,51 @@ def save_country_cache(cache: Dict[str, str]):
     except Exception as e:
         logger.warning(f"无法保存国家缓存: {e}")
 
+def load_asn_cache() -> Dict[str, int]:
+    if os.path.exists(ASN_CACHE_FILE):
+        try:
+            with open(ASN_CACHE_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"无法加载 ASN 缓存: {e}")
+    return {}
+
+def save_asn_cache(cache: Dict[str, int]):
+    try:
+        with open(ASN_CACHE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False)
+    except Exception as e:
+        logger.warning(f"无法保存 ASN 缓存: {e}")
+
+def load_negative_cache() -> Dict[str, Dict]:
+    if os.path.exists(NEGATIVE_CACHE_FILE):
+        try:
+            with open(NEGATIVE_CACHE_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"无法加载负缓存: {e}")
+    return {}
+
+def save_negative_cache(cache: Dict[str, Dict]):
+    try:
+        temp_file = NEGATIVE_CACHE_FILE + ".tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False)
+        os.replace(temp_file, NEGATIVE_CACHE_FILE)
+    except Exception as e:
+        logger.warning(f"无法保存负缓存: {e}")
+
+def quarantine_seconds(failures: int, rng: random.Random) -> float:
+    """连续失败 failures 次后的隔离时长：达到阈值时为 base，之后每多失败一次翻倍，不超过 max，再加 ±20% 随机抖动
+
+    抖动让同一批失败的节点在不同的运行中陆续解除隔离，而不是同时涌回测速。
+    """
+    threshold = negative_cache_settings["threshold"]
+    if failures < threshold:
+        return 0.0
+    period = min(negative_cache_settings["base"] * 2 ** (failures - threshold), negative_cache_settings["max"])
+    return period * rng.uniform(1 - NEGATIVE_CACHE_JITTER, 1 + NEGATIVE_CACHE_JITTER)
+
 def is_temp_file_valid(temp_file: str) -> bool:
     if not os.path.exists(temp_file):
         return False
@@ -712,10 +1389,48 @@ def detect_delimiter(lines: List[str]) -> str:
     logger.warning("无法检测分隔符，假定为逗号")
     return ','
 
+def normalize_ip(ip: str) -> str:
+    """返回 IP 的规范形式：去掉方括号和 IPv6 zone（如 %eth0），IPv6 使用压缩表示，
+    IPv4 映射地址（::ffff:1.2.3.4）还原为 IPv4，IPv4 去掉前导零；无效时返回空字符串"""
+    ip = ip.strip().strip('[]')
+    if IPV4_PATTERN.match(ip):
+        if (ip[0] == '0' or '.0' in ip) and IPV4_LEADING_ZERO_PATTERN.search(ip):
+            return '.'.join(str(int(part)) for part in ip.split('.'))
+        return ip
+    if ':' not in ip:
+        return ''
+    try:
+        address = ipaddress.IPv6Address(ip.split('%', 1)[0])
+    except ValueError:
+        return ''
+    if address.ipv4_mapped:
+        return str(address.ipv4_mapped)
+    return address.compressed
+
+def ip_key(ip: str) -> int:
+    """IP 的 128 位整数键（IPv4 映射到 ::ffff:0:0/96），同一地址的不同写法得到相同的键；无效地址返回 -1"""
+    ip = ip.strip().strip('[]')
+    if IPV4_PATTERN.match(ip):
+        if (ip[0] == '0' or '.0' in ip) and IPV4_LEADING_ZERO_PATTERN.search(ip):
+            ip = normalize_ip(ip)
+        return IPV4_MAPPED_PREFIX | int.from_bytes(socket.inet_aton(ip), 'big')
+    if ':' not in ip:
+        return -1
+    try:
+        return int(ipaddress.IPv6Address(ip.split('%', 1)[0]))  # IPv4 映射地址的整数值与对应 IPv4 的键相同
+    except ValueError:
+        return -1
+
+def ip_family(ip: str) -> int:
+    """规范化后的 IP 的地址族：4 或 6"""
+    return 6 if ':' in ip else 4
+
+def format_host_port(ip: str, port) -> str:
+    """格式化为 host:port，IPv6 地址加方括号"""
+    return f"[{ip}]:{port}" if ':' in ip else f"{ip}:{port}"
+
 def is_valid_ip(ip: str) -> bool:
-    ipv4_pattern = re.compile(r'^(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$')
-    ipv6_pattern = re.compile(r'^(?:[0-9a-fA-F]{0,4}:){1,7}[0-9a-fA-F]{0,4}$')
-    return bool(ipv4_pattern.match(ip) or ipv6_pattern.match(ip.strip('[]')))
+    return bool(normalize_ip(ip))
 
 def is_valid_port(port: str) -> bool:
     try:
@@ -734,6 +1449,7 @@ def is_country_like(value: str) -> bool:
         return True
     return False
 
+@lru_cache(maxsize=4096)
 def standardize_country(value: str) -> str:
     if not value:
         return ''
@@ -794,19 +1510,98 @@ def find_country_column(lines: List[str], delimiter: str) -> Tuple[int, int, int
 
     return ip_col, port_col, country_col
 
+class NodeFilter:
+    """解析阶段的节点过滤条件（国家、端口、地址族、排除的网段），构造时编译一次，逐行解析时调用
+
+    数据源自带的国家有效（在 COUNTRY_LABELS 中）且不在 countries 中的行直接丢弃，不构造节点也不查询 GeoIP；
+    数据源没有国家的行仍由 write_ip_list 查询 GeoIP 后筛选。各原因的丢弃数记在 rejected 中，每次解析开始时清零。
+    """
+
+    def __init__(self, countries: Iterable[str] = None, ports: Iterable[int] = None, families: Iterable[int] = None,
+                 exclude: Iterable[str] = None):
+        self.countries = frozenset(countries) if countries else None
+        self.ports = frozenset(ports) if ports else None
+        self.families = frozenset(families) if families else None
+        # 排除的网段转换为 128 位键空间（IPv4 映射到 ::ffff:0:0/96）上合并后的区间，按起点二分查找
+        ranges = []
+        for prefix in exclude or []:
+            network = parse_cidr(prefix)
+            if network is None:
+                raise ValueError(f"无效的网段: {prefix}")
+            start = ip_key(str(network.network_address))
+            ranges.append((start, start + network.num_addresses - 1))
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.exclude_starts = [start for start, _ in merged]
+        self.exclude_ends = [end for _, end in merged]
+        self.rejected = defaultdict(int)
+
+    def reject_country(self, country: str) -> bool:
+        if self.countries is not None and country in COUNTRY_LABELS and country not in self.countries:
+            self.rejected["country"] += 1
+            return True
+        return False
+
+    def excluded(self, key: int) -> bool:
+        index = bisect.bisect_right(self.exclude_starts, key) - 1
+        return index >= 0 and key <= self.exclude_ends[index]
+
+    def reject_ip(self, ip: str) -> bool:
+        """ip 为 normalize_ip 规范化后的地址"""
+        if self.families is not None and ip_family(ip) not in self.families:
+            self.rejected["family"] += 1
+            return True
+        if self.exclude_starts and self.excluded(ip_key(ip)):
+            self.rejected["excluded"] += 1
+            return True
+        return False
+
+    def reject_node(self, ip: str, port: int) -> bool:
+        if self.ports is not None and port not in self.ports:
+            self.rejected["port"] += 1
+            return True
+        return self.reject_ip(ip)
+
+    def filter_block(self, block: Tuple):
+        """过滤 CIDR 网段：国家和地址族按网段判断，端口取交集，整个网段都在排除范围内时丢弃；返回过滤后的网段或 None"""
+        network, ports, country = block
+        if self.reject_country(country):
+            return None
+        if self.families is not None and network.version not in self.families:
+            self.rejected["family"] += 1
+            return None
+        if self.exclude_starts:
+            start = ip_key(str(network.network_address))
+            index = bisect.bisect_right(self.exclude_starts, start) - 1
+            if index >= 0 and start + network.num_addresses - 1 <= self.exclude_ends[index]:
+                self.rejected["excluded"] += 1
+                return None
+        if self.ports is not None:
+            ports = [port for port in ports if port in self.ports]
+            if not ports:
+                self.rejected["port"] += 1
+                return None
+        return (network, ports, country)
+
 def fetch_and_save_to_temp_file(url: str) -> str:
     logger.info(f"下载 URL: {url} 到 {TEMP_FILE}")
     try:
         session = requests.Session()
         retry = Retry(total=5, backoff_factor=2, status_forcelist=[500, 502, 503, 504, 429])
         session.mount('https://', HTTPAdapter(max_retries=retry))
-        response = session.get(url, timeout=60, headers=HEADERS, stream=True)
+        response = session.get(url, timeout=max(1.0, min(60, time_left())), headers=HEADERS, stream=True)
         response.raise_for_status()
         total_size = int(response.headers.get('content-length', 0))
         downloaded = 0
         temp_content = []
         with open(TEMP_FILE, "wb") as f:
             for chunk in response.iter_content(chunk_size=8192):
+                if time_left() <= 0:
+                    raise TimeoutError("下载超出时间预算")
                 if chunk:
                     f.write(chunk)
                     downloaded += len(chunk)
@@ -846,7 +1641,8 @@ def fetch_and_save_to_temp_file(url: str) -> str:
         logger.error(f"无法下载 URL: {e}")
         return ''
 
-def extract_ip_ports_from_file(file_path: str) -> List[Tuple[str, int, str]]:
+def extract_ip_ports_from_file(file_path: str, cidr_blocks: List[Tuple] = None, bare_ips: List[Tuple[str, str]] = None,
+                               node_filter: NodeFilter = None) -> List[Tuple[str, int, str]]:
     if not os.path.exists(file_path):
         logger.error(f"文件 {file_path} 不存在")
         return []
@@ -860,13 +1656,24 @@ def extract_ip_ports_from_file(file_path: str) -> List[Tuple[str, int, str]]:
     except UnicodeDecodeError as e:
         logger.error(f"无法解码文件 {file_path}: {e}")
         return []
-    ip_ports = extract_ip_ports_from_content(content)
+    ip_ports = extract_ip_ports_from_content(content, cidr_blocks, bare_ips, node_filter)
     logger.info(f"文件 {file_path} 解析完成 (耗时: {time.time() - start_time:.2f} 秒)")
     return ip_ports
 
-def extract_ip_ports_from_content(content: str) -> List[Tuple[str, int, str]]:
+def extract_ip_ports_from_content(content: str, cidr_blocks: List[Tuple] = None, bare_ips: List[Tuple[str, str]] = None,
+                                  node_filter: NodeFilter = None) -> List[Tuple[str, int, str]]:
+    """解析节点列表，返回去重后的 (IP, 端口, 国家)
+
+    传入 cidr_blocks 列表时，CIDR 网段（如 104.16.0.0/13,443）以 (网段, 端口列表, 国家) 追加到该列表，
+    由 write_ip_list 惰性展开；未传入时 CIDR 行与其他无效行一样被忽略。
+    传入 bare_ips 列表时，IP 有效但没有端口的条目以 (IP, 国家) 追加到该列表，由端口发现阶段补全端口。
+    传入 node_filter 时在解码每一行时就应用过滤条件，被过滤的行不会进入以上任何结果。
+    """
     server_port_pairs = []
     invalid_lines = []
+    if node_filter:
+        # 同一个过滤器在 --watch 中会反复用于解析，只统计本次解析的丢弃数
+        node_filter.rejected.clear()
     content = content.replace('\r\n', '\n').replace('\r', '\n')
     lines = content.splitlines()
     if not lines:
@@ -878,7 +1685,7 @@ def extract_ip_ports_from_content(content: str) -> List[Tuple[str, int, str]]:
     try:
         data = json.loads(content)
         for item in data:
-            ip = item.get('ip', '') or item.get('IP Address', '') or item.get('ip_address', '')
+            ip = normalize_ip(str(item.get('ip', '') or item.get('IP Address', '') or item.get('ip_address', '')))
             port = item.get('port', '') or item.get('Port', '')
             country = standardize_country(
                 item.get('country', '') or
@@ -895,8 +1702,29 @@ def extract_ip_ports_from_content(content: str) -> List[Tuple[str, int, str]]:
                 item.get('dc location', '') or
                 item.get('dc_location', '')
             )
-            if is_valid_ip(ip) and is_valid_port(str(port)):
+            if cidr_blocks is not None and not ip:
+                block = parse_cidr_fields([str(item.get('ip', '') or item.get('cidr', '')), str(port), country], 0, 1, 2)
+                if block:
+                    if node_filter:
+                        block = node_filter.filter_block(block)
+                    if block:
+                        cidr_blocks.append(block)
+                    continue
+            if node_filter and (node_filter.reject_country(country) or (ip and node_filter.reject_ip(ip))):
+                continue
+            if ip and is_valid_port(str(port)):
+                if node_filter and node_filter.ports is not None and int(port) not in node_filter.ports:
+                    node_filter.rejected["port"] += 1
+                    continue
                 server_port_pairs.append((ip, int(port), country))
+            elif ip and bare_ips is not None and not str(port).strip():
+                bare_ips.append((ip, country))
+        metric_inc("parse_rows_total", len(data))
+        metric_inc("parse_nodes_total", len(server_port_pairs))
+        if node_filter and node_filter.rejected:
+            for reason, count in node_filter.rejected.items():
+                metric_inc("parse_rejected_total", count, reason=reason)
+            logger.info(f"解析时按过滤条件丢弃: {dict(node_filter.rejected)}")
         logger.info(f"从 JSON 解析出 {len(server_port_pairs)} 个节点，其中 {sum(1 for _, _, c in server_port_pairs if c)} 个有国家信息")
         return list(dict.fromkeys(server_port_pairs))
     except json.JSONDecodeError as e:
@@ -931,69 +1759,101 @@ def extract_ip_ports_from_content(content: str) -> List[Tuple[str, int, str]]:
             else:
                 logger.info(f"无法确定国家列，设为 -1")
 
+    # IPv6 可带方括号、zone（%eth0）或内嵌 IPv4（::ffff:1.2.3.4）；地址是否有效由 normalize_ip 判断
     ip_port_pattern = re.compile(
-        r'(((\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})|\[(?:[0-9a-fA-F]{0,4}:){1,7}[0-9a-fA-F]{0,4}\]|(?:[0-9a-fA-F]{0,4}:){1,7}[0-9a-fA-F]{0,4}))[ :,\t](\d{1,5})'
+        r'(?P<server>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|\[[0-9a-fA-F:.]+(?:%[\w.-]+)?\]|[0-9a-fA-F]*:[0-9a-fA-F:.]*[0-9a-fA-F](?:%[\w.-]+)?)[ :,\t](?P<port>\d{1,5})'
     )
 
     for i, line in enumerate(lines_to_process):
         line = line.strip()
         if not line or line.startswith('#'):
             continue
+        fields = line.split(delimiter) if delimiter else [line]
+        if cidr_blocks is not None and '/' in line:
+            block = parse_cidr_fields(fields, ip_col, port_col, country_col)
+            if block:
+                if node_filter:
+                    block = node_filter.filter_block(block)
+                if block:
+                    cidr_blocks.append(block)
+                continue
+        # 先取国家：数据源国家不在目标国家中的行在匹配和规范化 IP 之前就丢弃
+        country = ''
+        if delimiter:
+            if country_col != -1 and country_col < len(fields):
+                country = standardize_country(fields[country_col].strip())
+            if not country:
+                for col, field in enumerate(fields):
+                    field = field.strip()
+                    potential_country = standardize_country(field)
+                    if potential_country:
+                        country = potential_country
+                        break
+        if node_filter and node_filter.reject_country(country):
+            continue
         match = ip_port_pattern.match(line)
         if match:
-            server = match.group(1).strip('[]')
-            port = match.group(4)
-            country = ''
-            if delimiter:
-                fields = line.split(delimiter)
-                if country_col != -1 and country_col < len(fields):
-                    country = standardize_country(fields[country_col].strip())
-                if not country:
-                    for col, field in enumerate(fields):
-                        field = field.strip()
-                        potential_country = standardize_country(field)
-                        if potential_country:
-                            country = potential_country
-                            break
+            server = normalize_ip(match.group('server'))
+            port = match.group('port')
+            if not server:
+                invalid_lines.append(f"第 {i} 行: {line} (IP 无效)")
+                continue
             if is_valid_port(port):
+                if node_filter and node_filter.reject_node(server, int(port)):
+                    continue
                 server_port_pairs.append((server, int(port), country))
             else:
                 invalid_lines.append(f"第 {i} 行: {line} (端口无效)")
             continue
         if delimiter:
-            fields = line.split(delimiter)
             if len(fields) < max(ip_col, port_col, country_col) + 1:
+                server = normalize_ip(fields[ip_col]) if bare_ips is not None and ip_col < len(fields) else ''
+                if server and port_col >= len(fields):
+                    if not node_filter or not node_filter.reject_ip(server):
+                        bare_ips.append((server, country))
+                    continue
                 invalid_lines.append(f"第 {i} 行: {line} (字段太少)")
                 continue
-            server = fields[ip_col].strip('[]')
+            server = normalize_ip(fields[ip_col])
             port_str = fields[port_col].strip()
-            country = ''
-            if country_col != -1 and country_col < len(fields):
-                country = standardize_country(fields[country_col].strip())
-            if not country:
-                for col, field in enumerate(fields):
-                    field = field.strip()
-                    potential_country = standardize_country(field)
-                    if potential_country:
-                        country = potential_country
-                        break
-            if is_valid_ip(server) and is_valid_port(port_str):
+            if server and is_valid_port(port_str):
+                if node_filter and node_filter.reject_node(server, int(port_str)):
+                    continue
                 server_port_pairs.append((server, int(port_str), country))
+            elif server and bare_ips is not None and not port_str.isdigit():
+                if node_filter and node_filter.reject_ip(server):
+                    continue
+                bare_ips.append((server, country))
             else:
                 invalid_lines.append(f"第 {i} 行: {line} (IP 或端口无效)")
         else:
             invalid_lines.append(f"第 {i} 行: {line} (格式无效)")
 
+    metric_inc("parse_rows_total", len(lines_to_process))
+    metric_inc("parse_invalid_rows_total", len(invalid_lines))
+    metric_inc("parse_nodes_total", len(server_port_pairs))
     if invalid_lines:
         logger.info(f"发现 {len(invalid_lines)} 个无效条目")
+    if node_filter and node_filter.rejected:
+        for reason, count in node_filter.rejected.items():
+            metric_inc("parse_rejected_total", count, reason=reason)
+        logger.info(f"解析时按过滤条件丢弃: {dict(node_filter.rejected)}")
     logger.info(f"解析出 {len(server_port_pairs)} 个节点，其中 {sum(1 for _, _, c in server_port_pairs if c)} 个有国家信息")
+    if cidr_blocks:
+        logger.info(f"解析出 {len(cidr_blocks)} 个 CIDR 网段，将在国家筛选时按需展开")
+    if bare_ips:
+        metric_inc("parse_bare_ips_total", len(bare_ips))
+        logger.info(f"解析出 {len(bare_ips)} 个没有端口的 IP，将通过端口发现补全端口")
     unique_server_port_pairs = list(dict.fromkeys(server_port_pairs))
     logger.info(f"去重后: {len(unique_server_port_pairs)} 个节点")
     return unique_server_port_pairs
 
 def get_country_from_ip(ip: str, cache: Dict[str, str]) -> str:
     if ip in cache:
+        metric_inc("geoip_cache_hits_total")
         return cache[ip]
+    metric_inc("geoip_cache_misses_total")
+    metric_inc("geoip_lookups_total")
     try:
         response = geoip_reader.country(ip)
         country_code = response.country.iso_code or ''
@@ -1004,279 +1864,2268 @@ def get_country_from_ip(ip: str, cache: Dict[str, str]) -> str:
     except Exception:
         return ''
 
-def get_countries_from_ips(ips: List[str], cache: Dict[str, str]) -> List[str]:
-    uncached_ips = [ip for ip in ips if ip not in cache]
-    if uncached_ips:
-        logger.info(f"批量查询 {len(uncached_ips)} 个 IP 的国家信息")
-        for ip in uncached_ips:
-            try:
-                response = geoip_reader.country(ip)
-                cache[ip] = response.country.iso_code or ''
-            except Exception:
-                cache[ip] = ''
+def batch_lookup(ips: List[str], cache: Dict, lookup, default, kind: str = "geoip", label: str = "国家") -> List:
+    """带缓存的批量数据库查询，结果按 ips 的顺序返回；查询失败或地址无效时为 default
+
+    按 128 位整数键合并未缓存的 IP：同一 IP 的多个端口、同一地址的不同写法只查询一次数据库。
+    缓存命中、未命中和实际查询次数记入 {kind}_cache_hits_total 等指标。
+    """
+    uncached = defaultdict(list)
+    for ip in ips:
+        if ip not in cache:
+            uncached[ip_key(ip)].append(ip)
+    uncached_count = sum(len(spellings) for spellings in uncached.values())
+    metric_inc(f"{kind}_cache_hits_total", len(ips) - uncached_count)
+    metric_inc(f"{kind}_cache_misses_total", uncached_count)
+    metric_inc(f"{kind}_lookups_total", len(uncached))
+    if uncached:
+        logger.info(f"批量查询 {len(uncached)} 个 IP 的{label}信息")
+        for key, spellings in uncached.items():
+            value = default
+            if key >= 0:
+                try:
+                    value = lookup(spellings[0])
+                except Exception:
+                    value = default
+            for ip in spellings:
+                cache[ip] = value
     return [cache[ip] for ip in ips]
 
-def write_ip_list(ip_ports: List[Tuple[str, int, str]], is_github_actions: bool) -> str:
-    if not ip_ports:
+def get_countries_from_ips(ips: List[str], cache: Dict[str, str]) -> List[str]:
+    return batch_lookup(ips, cache, lambda ip: geoip_reader.country(ip).country.iso_code or '', '')
+
+def get_asns_from_ips(ips: List[str], cache: Dict[str, int]) -> List[int]:
+    """查询 IP 所属的自治系统号，未知时为 0"""
+    return batch_lookup(ips, cache, lambda ip: asn_reader.asn(ip).autonomous_system_number or 0, 0, kind="asn", label=" ASN ")
+
+def parse_port_list(value: str) -> List[int]:
+    """解析端口列表（如 443;2053;8443、443|8443 或 443 8443），忽略无效端口"""
+    return [int(port) for port in re.split(r'[;|\s]+', value.strip()) if is_valid_port(port)]
+
+def parse_cidr(value: str):
+    """解析 CIDR 前缀（如 104.16.0.0/13、[2606:4700::]/32），主机位不为零时取所在网段；不是 CIDR 时返回 None"""
+    value = value.strip().replace('[', '').replace(']', '')
+    if '/' not in value:
+        return None
+    try:
+        return ipaddress.ip_network(value, strict=False)
+    except ValueError:
+        return None
+
+def parse_cidr_fields(fields: List[str], ip_col: int, port_col: int, country_col: int):
+    """从一行的字段中解析 (网段, 端口列表, 国家)；端口列缺失时使用 --cidr-ports，IP 列不是 CIDR 时返回 None"""
+    if ip_col >= len(fields):
+        return None
+    # 兼容 “104.16.0.0/13 443;8443” 这种网段和端口在同一字段内的写法
+    head, *rest = fields[ip_col].split() or ['']
+    network = parse_cidr(head)
+    if network is None:
+        return None
+    ports = parse_port_list(' '.join(rest))
+    if not ports and port_col != ip_col and port_col < len(fields):
+        ports = parse_port_list(fields[port_col])
+    country = standardize_country(fields[country_col].strip()) if 0 <= country_col < len(fields) else ''
+    if not country:
+        for field in fields:
+            country = standardize_country(field.strip())
+            if country:
+                break
+    return (network, ports or list(cidr_settings["ports"]), country)
+
+def lookup_country_uncached(ip: str) -> str:
+    """直接查询 GeoIP 数据库，不写入国家缓存（CIDR 抽样的主机每次运行都不同，写入缓存只会让缓存无限增长）"""
+    if geoip_reader is None:
+        return ''
+    metric_inc("geoip_lookups_total")
+    try:
+        return geoip_reader.country(ip).country.iso_code or ''
+    except Exception:
+        return ''
+
+def iter_cidr_hosts(cidr_blocks: List[Tuple], per_subnet: int, rng: random.Random, max_hosts: int = 0) -> Iterator[Tuple[str, int, str]]:
+    """惰性展开 CIDR 网段，逐个产出 (IP, 端口, 国家)
+
+    IPv4 每个 /24、IPv6 每个 /48 随机抽取 per_subnet 个主机（网段更小时在网段内抽取），
+    与端口列表组合后产出；网段和主机都按需生成，内存占用与前缀大小无关。
+    网段没有有效的国家信息时，每个抽样子网只查询一次 GeoIP（不写入国家缓存）；查不到时产出的国家为
+    CIDR_UNKNOWN_COUNTRY，write_ip_list 不再逐个主机查询。max_hosts 大于 0 时产出该数量后停止。
+    """
+    produced = 0
+    for network, ports, country in cidr_blocks:
+        sample_prefix = CIDR_SAMPLE_PREFIX_V4 if network.version == 4 else CIDR_SAMPLE_PREFIX_V6
+        subnets = network.subnets(new_prefix=sample_prefix) if network.prefixlen < sample_prefix else (network,)
+        address_type = type(network.network_address)
+        for subnet in subnets:
+            size = subnet.num_addresses
+            first = int(subnet.network_address)
+            # 跳过网络地址和广播地址；/31、/32 等极小网段直接使用全部地址
+            low, high = (1, size - 1) if size > 2 else (0, size)
+            offsets = set()
+            while len(offsets) < min(per_subnet, high - low):
+                offsets.add(rng.randrange(low, high))
+            hosts = [str(address_type(first + offset)) for offset in sorted(offsets)]
+            subnet_country = country if country in COUNTRY_LABELS else (lookup_country_uncached(hosts[0]) if hosts else '')
+            if subnet_country not in COUNTRY_LABELS:
+                subnet_country = CIDR_UNKNOWN_COUNTRY
+            for host in hosts:
+                for port in ports:
+                    yield (host, port, subnet_country)
+                    produced += 1
+                    if max_hosts and produced >= max_hosts:
+                        logger.warning(f"CIDR 展开达到上限 {max_hosts} 个节点，剩余网段不再展开")
+                        return
+
+def iter_chunks(iterable: Iterable, size: int) -> Iterator[List]:
+    """按固定大小分块读取可迭代对象"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def lookup_node_country(ip: str, port: int) -> str:
+    """write_ip_list 记录的节点国家：先查单个节点，再查 CIDR 抽样子网；没有记录时返回空字符串"""
+    country = node_countries.get((ip_key(ip) << 16) | port)
+    if country is None:
+        country = cidr_subnet_countries.get(subnet_key(ip), "")
+    return country
+
+def write_ip_list(ip_ports: List[Tuple[str, int, str]], is_github_actions: bool, cidr_blocks: List[Tuple] = None) -> str:
+    if not ip_ports and not cidr_blocks:
         logger.error(f"没有有效的节点来生成 {IP_LIST_FILE}")
         return None
 
     start_time = time.time()
     country_cache = load_country_cache()
+    # 只为显式列出的节点去重；同一网段抽样出的主机本身不重复，不再逐个记录，内存占用不随 CIDR 展开的规模增长
     filtered_ip_ports = set()
+    record_countries = probe_settings["search"] == "subnet" or asn_settings["enabled"]
+    node_countries.clear()
+    cidr_subnet_countries.clear()
+    colo_cache = load_colo_cache() if colo_settings["enabled"] else None
+    from_colo = 0
+    # 仍在隔离期内的节点：{节点键: 隔离截止时间}
+    quarantined = {}
+    if negative_cache_settings["enabled"]:
+        now = time.time()
+        for node, record in load_negative_cache().items():
+            ip, _, port = node.rpartition(" ")
+            if record.get("until", 0) > now and port.isdigit():
+                quarantined[(ip_key(ip) << 16) | int(port)] = record["until"]
+    canary_rng = random.Random()
+    skipped = 0
+    canaries = 0
     country_counts = defaultdict(int)
     filtered_counts = defaultdict(int)
-    logger.info(f"开始处理 {len(ip_ports)} 个节点...")
-
-    from_source = sum(1 for _, _, country in ip_ports if country and country in COUNTRY_LABELS)
-    logger.info(f"数据源为 {from_source} 个节点提供了有效国家信息（包括城市映射）")
-
-    # 收集需要查询数据库的 IP（国家信息为空或无效）
-    ips_to_query = [ip for ip, _, country in ip_ports if not country or country not in COUNTRY_LABELS]
+    from_source = 0
     supplemented = 0
-    if ips_to_query:
-        logger.info(f"批量查询 {len(ips_to_query)} 个 IP 的国家信息（缺失或无效）")
-        countries = get_countries_from_ips(ips_to_query, country_cache)
-        ip_country_map = dict(zip(ips_to_query, countries))
-        supplemented = sum(1 for country in countries if country)
+    total_nodes = 0
+    written = 0
+    sources = ip_ports
+    if cidr_blocks:
+        logger.info(f"开始处理 {len(ip_ports)} 个节点和 {len(cidr_blocks)} 个 CIDR 网段"
+                    f"（每个子网抽样 {cidr_settings['sample']} 个主机）...")
+        rng = random.Random(cidr_settings["seed"])
+        sources = itertools.chain(ip_ports, iter_cidr_hosts(cidr_blocks, cidr_settings["sample"], rng, cidr_settings["max_hosts"]))
     else:
-        ip_country_map = {}
-
-    for ip, port, country in ip_ports:
-        final_country = country
-        source = "数据源" if country and country in COUNTRY_LABELS else "待查询"
-        
-        if not country or country not in COUNTRY_LABELS:
-            final_country = ip_country_map.get(ip, '')
-            if final_country:
-                source = "GeoIP 数据库"
-        
-        if not DESIRED_COUNTRIES:
-            filtered_ip_ports.add((ip, port))
-            if final_country:
-                country_counts[final_country] += 1
-        elif final_country and final_country in DESIRED_COUNTRIES:
-            filtered_ip_ports.add((ip, port))
-            country_counts[final_country] += 1
-        else:
-            filtered_counts[final_country or 'UNKNOWN'] += 1
+        logger.info(f"开始处理 {len(ip_ports)} 个节点...")
+
+    # 分块处理，CIDR 展开的节点不会一次性全部载入内存；保留的节点边处理边写入临时文件
+    temp_file = IP_LIST_FILE + ".tmp"
+    with open(temp_file, "w", encoding="utf-8") as f:
+        for chunk in iter_chunks(sources, WRITE_IP_LIST_CHUNK):
+            # chain 中先是显式节点，之后全部是 CIDR 展开的主机
+            explicit_count = max(0, min(len(chunk), len(ip_ports) - total_nodes))
+            total_nodes += len(chunk)
+            # 按数据中心判断国家时，trace 成功的节点不再使用数据源或 GeoIP 的国家
+            colo_countries = resolve_colo_countries([(ip, port) for ip, port, _ in chunk], colo_cache) if colo_cache is not None else {}
+            from_colo += len(colo_countries)
+            from_source += sum(1 for ip, port, country in chunk
+                               if country and country in COUNTRY_LABELS and f"{ip} {port}" not in colo_countries)
+
+            # 收集需要查询数据库的 IP（国家信息为空或无效）；CIDR 抽样的主机已按子网查询过，不再逐个查询和缓存
+            ips_to_query = [ip for ip, port, country in chunk
+                            if (not country or country not in COUNTRY_LABELS) and country != CIDR_UNKNOWN_COUNTRY
+                            and f"{ip} {port}" not in colo_countries]
+            if ips_to_query:
+                logger.info(f"批量查询 {len(ips_to_query)} 个 IP 的国家信息（缺失或无效）")
+                countries = get_countries_from_ips(ips_to_query, country_cache)
+                ip_country_map = dict(zip(ips_to_query, countries))
+                supplemented += sum(1 for country in countries if country)
+            else:
+                ip_country_map = {}
+
+            for index, (ip, port, country) in enumerate(chunk):
+                from_cidr = index >= explicit_count
+                final_country = country
+                source = "数据源" if country and country in COUNTRY_LABELS else "待查询"
+
+                if colo_countries.get(f"{ip} {port}"):
+                    final_country = colo_countries[f"{ip} {port}"]
+                    source = "数据中心"
+                elif not country or country not in COUNTRY_LABELS:
+                    final_country = ip_country_map.get(ip, '')
+                    if final_country:
+                        source = "GeoIP 数据库"
+
+                if not DESIRED_COUNTRIES or (final_country and final_country in DESIRED_COUNTRIES):
+                    if final_country:
+                        country_counts[final_country] += 1
+                    # 以 128 位 IP 键和端口拼成的整数去重，比 (IP, 端口) 元组占用的内存小得多；
+                    # CIDR 主机只与显式节点比较，不加入集合
+                    node_key = (ip_key(ip) << 16) | port
+                    if node_key not in filtered_ip_ports:
+                        if not from_cidr:
+                            filtered_ip_ports.add(node_key)
+                        if node_key in quarantined:
+                            # 隔离中的节点按 canary 比例随机抽取一部分继续测试，以便发现已恢复的节点
+                            if canary_rng.random() >= negative_cache_settings["canary"]:
+                                skipped += 1
+                                continue
+                            canaries += 1
+                        if record_countries:
+                            if not from_cidr:
+                                node_countries[node_key] = final_country
+                            elif cidr_subnet_countries.setdefault(subnet_key(ip), final_country) != final_country:
+                                node_countries[node_key] = final_country
+                        f.write(f"{ip} {port}\n")
+                        written += 1
+                else:
+                    filtered_counts[final_country or 'UNKNOWN'] += 1
 
-    total_retained = len(filtered_ip_ports)
+    logger.info(f"数据源为 {from_source} 个节点提供了有效国家信息（包括城市映射）")
+    if colo_cache is not None:
+        save_colo_cache(colo_cache)
+        logger.info(f"按数据中心确定国家: {from_colo} 个节点")
+    for country, count in country_counts.items():
+        metric_inc("geo_filter_retained_total", count, country=country)
+    for country, count in filtered_counts.items():
+        metric_inc("geo_filter_dropped_total", count, country=country)
+    metric_inc("geoip_supplemented_total", supplemented)
+    if cidr_blocks:
+        metric_inc("cidr_blocks_total", len(cidr_blocks))
+        metric_inc("cidr_hosts_total", total_nodes - len(ip_ports))
+    if quarantined:
+        metric_inc("negative_cache_skipped_total", skipped)
+        metric_inc("negative_cache_canary_total", canaries)
+        logger.info(f"负缓存: 跳过 {skipped} 个隔离中的节点，抽取 {canaries} 个隔离节点作为 canary 重新测试")
+    total_retained = written
     total_filtered = sum(filtered_counts.values())
     logger.info(f"过滤结果: 保留 {total_retained} 个节点，过滤掉 {total_filtered} 个节点")
     logger.info(f"通过 GeoIP 数据库补充国家信息: {supplemented} 个节点")
     logger.info(f"保留的国家分布: {dict(country_counts)}")
     logger.info(f"过滤掉的国家分布: {dict(filtered_counts)}")
 
-    if not filtered_ip_ports:
+    if not total_retained:
+        os.remove(temp_file)
         logger.error(f"没有有效的节点来生成 {IP_LIST_FILE}")
         return None
 
-    with open(IP_LIST_FILE, "w", encoding="utf-8") as f:
-        for ip, port in filtered_ip_ports:
-            f.write(f"{ip} {port}\n")
+    os.replace(temp_file, IP_LIST_FILE)
     logger.info(f"已生成 {IP_LIST_FILE}")
 
-    logger.info(f"生成 {IP_LIST_FILE}，包含 {len(filtered_ip_ports)} 个节点 (耗时: {time.time() - start_time:.2f} 秒)")
+    logger.info(f"生成 {IP_LIST_FILE}，包含 {total_retained} 个节点 (耗时: {time.time() - start_time:.2f} 秒)")
     save_country_cache(country_cache)
     return IP_LIST_FILE
 
-def run_speed_test() -> str:
-    if not SPEEDTEST_SCRIPT:
-        logger.info("未找到测速脚本")
-        return None
-
-    if not os.path.exists(IP_LIST_FILE):
-        logger.error(f"{IP_LIST_FILE} 不存在，请确保 write_ip_list 已正确生成文件")
-        return None
+def diversify_ip_list_by_asn(cap: int = ASN_CAP_PER_COUNTRY) -> int:
+    """按 ASN 分散 ip.txt 中的节点，返回重排后的节点数
 
+    节点按 (国家, ASN) 分组，组内保持原有顺序，每组最多保留 cap 个（0 表示不限制，ASN 未知的节点不受限制），
+    然后在各组之间轮询排列：少数几个托管商的节点不会占满前面的测速名额，
+    固定的探测预算（子网搜索配额、截止时间等）能覆盖更多不同的网络。
+    """
     start_time = time.time()
     try:
         with open(IP_LIST_FILE, "r", encoding="utf-8") as f:
-            ip_lines = [line.strip() for line in f if line.strip()]
-        total_nodes = len(ip_lines)
-        logger.info(f"{IP_LIST_FILE} 包含 {total_nodes} 个节点")
+            nodes = [line.split() for line in f if line.strip()]
     except Exception as e:
         logger.error(f"无法读取 {IP_LIST_FILE}: {e}")
-        return None
-
-    # 解析 speedlimit 参数
-    speed_limit = parse_speedlimit_from_script(SPEEDTEST_SCRIPT)
-    
-    logger.info("开始测速")
+        return 0
+    nodes = [parts for parts in nodes if len(parts) >= 2 and parts[1].isdigit()]
+    cache = load_asn_cache()
+    asns = get_asns_from_ips([parts[0] for parts in nodes], cache)
+    save_asn_cache(cache)
+
+    groups = defaultdict(list)
+    capped = 0
+    for (ip, port, *_), asn in zip(nodes, asns):
+        country = lookup_node_country(ip, int(port))
+        group = groups[(country, asn)]
+        if cap and asn and len(group) >= cap:
+            capped += 1
+            continue
+        group.append(f"{ip} {port}")
+    ordered = [node for round_nodes in itertools.zip_longest(*groups.values()) for node in round_nodes if node is not None]
+
+    temp_file = IP_LIST_FILE + ".tmp"
+    with open(temp_file, "w", encoding="utf-8") as f:
+        f.writelines(f"{node}\n" for node in ordered)
+    os.replace(temp_file, IP_LIST_FILE)
+
+    distinct = len({asn for _, asn in groups if asn})
+    unknown = sum(1 for asn in asns if not asn)
+    metric_set("asn_distinct", distinct)
+    metric_inc("asn_capped_total", capped)
+    largest = [f"{country or '?'} AS{asn} {count} 个" for count, country, asn in
+               sorted(((len(group), country, asn) for (country, asn), group in groups.items() if asn), reverse=True)[:5]]
+    cap_text = f"每个国家每个 ASN 最多 {cap} 个" if cap else "不限制每个 ASN 的节点数"
+    logger.info(f"ASN 分散: {len(nodes)} 个节点来自 {distinct} 个 ASN（{unknown} 个未知），"
+                f"{cap_text}，舍弃 {capped} 个，重排后 {len(ordered)} 个节点 "
+                f"(耗时: {time.time() - start_time:.2f} 秒)")
+    logger.info(f"节点最多的 ASN: {', '.join(largest)}")
+    return len(ordered)
+
+def build_speedtest_command(script_path: str) -> List[str]:
+    """根据平台构造执行测速脚本的命令"""
     system = platform.system().lower()
-    is_termux_env = is_termux()
+    if system == "windows":
+        return [script_path]
+    if is_termux():
+        return ["bash", script_path]  # Termux 使用 bash 执行 iptest.sh
+    shell = shutil.which("bash") or shutil.which("sh") or "sh"
+    return ["stdbuf", "-oL", shell, script_path]
+
+def kill_process_tree(process: subprocess.Popen):
+    """终止进程及其子进程：测速命令经由 stdbuf/bash 启动 iptest，只终止直接子进程时 iptest 会继续运行并占用输出管道"""
     try:
-        if system == "windows":
-            command = [SPEEDTEST_SCRIPT]
-        elif is_termux_env:
-            command = ["bash", SPEEDTEST_SCRIPT]  # Termux 使用 bash 执行 iptest.sh
+        if platform.system().lower() == "windows":
+            subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], capture_output=True, check=False)
         else:
-            shell = shutil.which("bash") or shutil.which("sh") or "sh"
-            command = ["stdbuf", "-oL", shell, SPEEDTEST_SCRIPT]
-        
-        process = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            shell=False,
-            encoding='utf-8',
-            errors='replace'
-        )
-        stdout_lines, stderr_lines = [], []
-        def read_stream(stream, lines, is_stderr=False):
-            while True:
-                line = stream.readline()
-                if not line:
-                    break
-                lines.append(line)
-                logger.info(line.strip())  # 直接记录原始输出，无前缀
-                sys.stdout.flush()
-        stdout_thread = threading.Thread(target=read_stream, args=(process.stdout, stdout_lines))
-        stderr_thread = threading.Thread(target=read_stream, args=(process.stderr, stderr_lines, True))
-        stdout_thread.start()
-        stderr_thread.start()
-
-        return_code = process.wait()
-        stdout_thread.join()
-        stderr_thread.join()
-        stdout = ''.join(stdout_lines)
-        stderr = ''.join(stderr_lines)
-        if stdout:
-            logger.info(f"iptest 标准输出: {stdout}")
-        if stderr:
-            logger.warning(f"iptest 错误输出: {stderr}")
+            os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        process.kill()
 
-        logger.info(f"测速完成，耗时: {time.time() - start_time:.2f} 秒")
-        if return_code != 0:
-            logger.error(f"测速失败，返回码: {return_code}")
-            return None
-        if not os.path.exists(FINAL_CSV) or os.path.getsize(FINAL_CSV) < 10:
-            logger.error(f"{FINAL_CSV} 未生成或内容无效")
-            return None
-        
-        # 统计 ip.csv 的速度分布
-        try:
-            with open(FINAL_CSV, "r", encoding="utf-8") as f:
-                reader = csv.reader(f)
-                header = next(reader, None)
-                speeds = []
-                speed_col = 9  # 第 10 列是“下载速度MB/s”
-                for row in reader:
-                    if len(row) > speed_col and row[speed_col].strip():
-                        try:
-                            speeds.append(float(row[speed_col]))
-                        except ValueError:
-                            continue
-                if speeds:
-                    logger.info(f"ip.csv 速度统计: 平均={sum(speeds)/len(speeds):.2f} MB/s, "
-                               f"最小={min(speeds):.2f} MB/s, 最大={max(speeds):.2f} MB/s, "
-                               f"节点数={len(speeds)}")
-        except Exception as e:
-            logger.warning(f"无法统计 ip.csv 速度分布: {e}")
+def run_iptest_process(command: List[str], node_count: int, tag: str = "") -> int:
+    """运行一个 iptest 进程，实时转发输出并统计有效节点，返回退出码
 
-        # 在 Termux 环境中，强制过滤低速节点
-        if is_termux_env:
-            logger.info(f"检测到 Termux 环境，应用速度下限过滤 (speedlimit={speed_limit} MB/s)")
-            filter_ip_csv_by_speed(FINAL_CSV, speed_limit=speed_limit)  # 使用动态 speed_limit
+    iptest 在独立的进程组（Windows 为独立的进程组标志）中运行，超出时间预算或脚本被中断时终止整个进程组。
+    """
+    if platform.system().lower() == "windows":
+        group_options = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        group_options = {"start_new_session": True}
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        shell=False,
+        encoding='utf-8',
+        errors='replace',
+        **group_options
+    )
+    stdout_lines, stderr_lines = [], []
+    def read_stream(stream, lines, is_stderr=False):
+        while True:
+            line = stream.readline()
+            if not line:
+                break
+            lines.append(line)
+            logger.info(f"{tag}{line.strip()}")  # 直接记录原始输出，分片模式下带分片前缀
+            sys.stdout.flush()
+            if not is_stderr:
+                valid_match = IPTEST_VALID_LINE_PATTERN.search(line)
+                if valid_match:
+                    metric_inc("probe_valid_total")
+                    metric_observe("probe_latency_seconds", int(valid_match.group(3)) / 1000)
+                    if negative_cache_settings["enabled"]:
+                        probe_outcomes[(ip_key(valid_match.group(1)) << 16) | int(valid_match.group(2))] = True
+                    iptest_latencies[(valid_match.group(1), int(valid_match.group(2)))] = int(valid_match.group(3))
+                    if active_checkpoint is not None:
+                        # 进程被杀时 iptest 不会写出 CSV，先记下延迟级别的结果；进程正常结束后由完整记录覆盖
+                        active_checkpoint.append({"ip": valid_match.group(1), "port": int(valid_match.group(2)),
+                                                  "outcome": "latency", "latency_ms": int(valid_match.group(3))})
+    stdout_thread = threading.Thread(target=read_stream, args=(process.stdout, stdout_lines), daemon=True)
+    stderr_thread = threading.Thread(target=read_stream, args=(process.stderr, stderr_lines, True), daemon=True)
+    stdout_thread.start()
+    stderr_thread.start()
+    # iptest 不报告并发中的探测数，只能记录分配给运行中的 iptest 进程的节点数
+    with metrics_lock:
+        run_metrics["gauges"]["iptest_nodes_assigned"] = run_metrics["gauges"].get("iptest_nodes_assigned", 0) + node_count
+
+    # 设置了 --deadline 时，超出测速阶段的时间预算即终止 iptest
+    left = time_left()
+    try:
+        return_code = process.wait(timeout=None if left == float('inf') else max(left, 0.0))
+    except subprocess.TimeoutExpired:
+        deadline_cutoff("speed_test", f"{tag}iptest 未在时间预算内完成，终止进程")
+        kill_process_tree(process)
+        return_code = process.wait()
+    except BaseException:
+        # 独立进程组收不到终端的 Ctrl+C，脚本中断时主动终止 iptest
+        kill_process_tree(process)
+        raise
+    with metrics_lock:
+        run_metrics["gauges"]["iptest_nodes_assigned"] = max(run_metrics["gauges"].get("iptest_nodes_assigned", 0) - node_count, 0)
+    stdout_thread.join(IPTEST_READER_JOIN_TIMEOUT)
+    stderr_thread.join(IPTEST_READER_JOIN_TIMEOUT)
+    stdout = ''.join(stdout_lines)
+    stderr = ''.join(stderr_lines)
+    if stdout:
+        logger.info(f"{tag}iptest 标准输出: {stdout}")
+    if stderr:
+        logger.warning(f"{tag}iptest 错误输出: {stderr}")
+    return return_code
+
+def write_shard_script(script_path: str, shard_script: str, overrides: Dict[str, str]) -> bool:
+    """复制测速脚本并改写 iptest 参数（如 -file、-outfile、-speedtest），不存在的参数追加到命令末尾"""
+    try:
+        with open(script_path, "rb") as f:
+            raw_data = f.read()
+        encoding = detect(raw_data).get("encoding", "utf-8") or "utf-8"
+        content = raw_data.decode(encoding, errors="replace")
+    except Exception as e:
+        logger.error(f"无法读取测速脚本 {script_path}: {e}")
+        return False
+    lines = content.splitlines()
+    command_idx = next((i for i, line in enumerate(lines) if re.search(r'-file=', line)), -1)
+    if command_idx < 0:
+        logger.error(f"测速脚本 {script_path} 中未找到 -file= 参数，无法分片")
+        return False
+    command_line = lines[command_idx]
+    for name, value in overrides.items():
+        pattern = re.compile(rf'-{name}=("[^"]*"|\S+)')
+        if pattern.search(command_line):
+            command_line = pattern.sub(lambda _: f'-{name}="{value}"', command_line)
+        else:
+            command_line = f'{command_line.rstrip()} -{name}="{value}"'
+    lines[command_idx] = command_line
+    newline = "\r\n" if "\r\n" in content else "\n"
+    with open(shard_script, "w", encoding=encoding, newline="") as f:
+        f.write(newline.join(lines) + newline)
+    if platform.system().lower() != "windows":
+        os.chmod(shard_script, 0o755)
+    return True
 
-        with open(FINAL_CSV, "r", encoding="utf-8") as f:
-            lines = [line.strip() for line in f if line.strip()]
-            node_count = len(lines) - 1 if lines else 0
-            logger.info(f"{FINAL_CSV} 包含 {node_count} 个节点")
-        return FINAL_CSV
+def parse_iptest_args(script_path: str) -> Dict[str, str]:
+    """解析测速脚本中 iptest 命令行的 -name=value 参数（去掉引号），供内置探测引擎沿用同一套配置"""
+    try:
+        with open(script_path, "rb") as f:
+            raw_data = f.read()
+        encoding = detect(raw_data).get("encoding", "utf-8") or "utf-8"
+        content = raw_data.decode(encoding, errors="replace")
     except Exception as e:
-        logger.error(f"测速异常: {e}")
-        return None
+        logger.warning(f"无法读取测速脚本 {script_path}: {e}")
+        return {}
+    command_line = next((line for line in content.splitlines() if re.search(r'-file=', line)), "")
+    return {name: value.strip('"') for name, value in re.findall(r'-(\w+)=("[^"]*"|\S+)', command_line)}
 
-def filter_speed_and_deduplicate(csv_file: str, is_github_actions: bool):
-    start_time = time.time()
-    if not os.path.exists(csv_file):
-        logger.info(f"{csv_file} 不存在")
-        return
-    seen = set()
-    final_rows = []
+def split_ip_list(ip_lines: List[str], shards: int, prefix: str) -> List[str]:
+    """将节点按轮询方式均分到多个分片文件，返回分片文件列表"""
+    shard_files = []
+    handles = []
     try:
-        with open(csv_file, "r", encoding="utf-8") as f:
+        for i in range(shards):
+            shard_file = f"{prefix}{i}.txt"
+            shard_files.append(shard_file)
+            handles.append(open(shard_file, "w", encoding="utf-8"))
+        for i, line in enumerate(ip_lines):
+            handles[i % shards].write(f"{line}\n")
+    finally:
+        for handle in handles:
+            handle.close()
+    return shard_files
+
+def parse_speed(value: str) -> float:
+    """解析“下载速度MB/s”列，无效值返回 0.0"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+def parse_latency_ms(value: str) -> float:
+    """解析“网络延迟”列（如 “58 ms”），无效值返回无穷大"""
+    match = re.match(r'\s*(\d+(?:\.\d+)?)', value or '')
+    return float(match.group(1)) if match else float('inf')
+
+def result_sort_key(row: List[str]) -> Tuple[float, float]:
+    """测速结果排序键：速度降序，其次延迟升序"""
+    speed = parse_speed(row[9]) if len(row) > 9 else 0.0
+    latency = parse_latency_ms(row[8]) if len(row) > 8 else float('inf')
+    return (-speed, latency)
+
+def score_sort_key(row: List[str], score_col: int) -> Tuple[float, float]:
+    """延迟采样后的排序键：综合得分升序（没有得分的排在最后），其次延迟升序"""
+    try:
+        score = float(row[score_col])
+    except (IndexError, ValueError):
+        score = float('inf')
+    return (score, parse_latency_ms(row[8]) if len(row) > 8 else float('inf'))
+
+def merge_shard_results(shard_csvs: List[str], output_csv: str) -> int:
+    """流式 k 路归并各分片的测速结果，返回写出的行数
+
+    iptest 的输出本身按速度/延迟排序，因此按相同的键归并即可得到全局有序结果；
+    即便某个分片未排序，归并结果也包含全部行，后续 filter_speed_and_deduplicate 会重新排序去重。
+    """
+    handles = []
+    readers = []
+    header = None
+    try:
+        for shard_csv in shard_csvs:
+            if not os.path.exists(shard_csv) or os.path.getsize(shard_csv) < 10:
+                continue
+            handle = open(shard_csv, "r", encoding="utf-8")
+            handles.append(handle)
+            reader = csv.reader(handle)
+            shard_header = next(reader, None)
+            if not shard_header:
+                continue
+            header = header or shard_header
+            readers.append(row for row in reader if row and row[0].strip())
+        if header is None:
+            return 0
+        count = 0
+        temp_file = output_csv + ".tmp"
+        with open(temp_file, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for row in heapq.merge(*readers, key=result_sort_key):
+                writer.writerow(row)
+                count += 1
+        os.replace(temp_file, output_csv)
+        return count
+    finally:
+        for handle in handles:
+            handle.close()
+
+class CheckpointLog:
+    """测速检查点：每测完一个节点（iptest 为每个进程结束时）追加一行 JSON 记录
+
+    iptest 运行期间每输出一个有效节点还会追加一条 outcome 为 latency 的记录，只含延迟，不算测完。
+
+    每条记录写入后立即刷新到操作系统，进程被杀时已写入的记录不会丢失；每隔 CHECKPOINT_SYNC_INTERVAL 秒
+    fsync 一次，机器被回收时最多丢失这段时间的记录。分片模式下多个线程同时写入，用锁保护。
+    """
+
+    def __init__(self, path: str, engine: str, append: bool):
+        self.path = path
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.file = open(path, "a" if append else "w", encoding="utf-8")
+        self.synced_at = time.monotonic()
+        self.count = 0
+        # 内置引擎：有效节点是否还要做下载测速，是则下载测速完成后才记录
+        self.downloads = False
+
+    def append(self, record: Dict):
+        line = json.dumps({"t": round(time.time(), 3), "engine": self.engine, **record},
+                          ensure_ascii=False, separators=(",", ":"))
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+            self.count += 1
+            if time.monotonic() - self.synced_at >= CHECKPOINT_SYNC_INTERVAL:
+                os.fsync(self.file.fileno())
+                self.synced_at = time.monotonic()
+
+    def record_probe(self, result: Dict):
+        """记录内置引擎的探测结果：无效节点和不做下载测速时的有效节点到此测完"""
+        if result["outcome"] != "ok" or not self.downloads:
+            self.append({key: result[key] for key in CHECKPOINT_NATIVE_FIELDS if key in result})
+
+    def record_download(self, result: Dict):
+        self.append({key: result[key] for key in CHECKPOINT_NATIVE_FIELDS if key in result})
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+def load_checkpoint(path: str, engine: str, max_age: float) -> Dict[str, Dict]:
+    """读取检查点中同一探测引擎、max_age 秒内的记录，返回 {"IP 端口": 最新记录}
+
+    进程被杀时最后一行可能不完整，无法解析的行直接跳过。
+    """
+    records = {}
+    if not os.path.exists(path):
+        return records
+    expire_before = time.time() - max_age
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    if record["engine"] == engine and record["t"] >= expire_before:
+                        records[f"{record['ip']} {record['port']}"] = record
+                except (ValueError, KeyError, TypeError):
+                    continue
+    except OSError as e:
+        logger.warning(f"无法读取检查点 {path}: {e}")
+    return records
+
+def checkpoint_iptest_output(input_file: str, output_csv: str) -> int:
+    """一个 iptest 进程成功结束后，把输出中的节点（整行）和输入中未出现在输出里的节点（记为失败）写入检查点，返回记录数"""
+    if active_checkpoint is None:
+        return 0
+    try:
+        with open(input_file, "r", encoding="utf-8") as f:
+            nodes = [" ".join(line.split()[:2]) for line in f if len(line.split()) >= 2]
+        with open(output_csv, "r", encoding="utf-8-sig") as f:
             reader = csv.reader(f)
-            header = next(reader, None)
-            if not header:
-                logger.error(f"{csv_file} 没有有效的表头")
-                return
-            for row in reader:
-                if len(row) < 2 or not row[0].strip():
+            next(reader, None)
+            rows = {f"{row[0]} {row[1]}": row for row in reader if len(row) > 1 and row[0].strip()}
+    except OSError as e:
+        logger.warning(f"无法写入检查点: {e}")
+        return 0
+    for node in dict.fromkeys(nodes):
+        ip, port = node.split()
+        row = rows.pop(node, None)
+        active_checkpoint.append({"ip": ip, "port": int(port), "outcome": "ok" if row else "failed", "row": row})
+    for node, row in rows.items():
+        ip, port = node.split()
+        active_checkpoint.append({"ip": ip, "port": int(port) if is_valid_port(port) else 0, "outcome": "ok", "row": row})
+    return len(nodes) + len(rows)
+
+def merge_checkpoint_rows(records: List[Dict], output_csv: str, include_existing: bool) -> int:
+    """把检查点中 iptest 测得的结果行与本次 iptest 的输出（include_existing 为 True 时）合并，按速度、延迟重新排序写出，返回行数"""
+    header = list(RESULT_HEADER)
+    rows = {}
+    if include_existing and os.path.exists(output_csv):
+        with open(output_csv, "r", encoding="utf-8-sig") as f:
+            reader = csv.reader(f)
+            header = next(reader, None) or header
+            rows = {f"{row[0]} {row[1]}": row for row in reader if len(row) > 1 and row[0].strip()}
+    for record in records:
+        rows.setdefault(f"{record['ip']} {record['port']}", record.get("row"))
+    merged = sorted((row for row in rows.values() if row), key=result_sort_key)
+    temp_file = output_csv + ".tmp"
+    with open(temp_file, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(merged)
+    os.replace(temp_file, output_csv)
+    return len(merged)
+
+def remove_checkpoint():
+    """运行成功结束后删除检查点，下次 --resume 不再沿用"""
+    if checkpoint_settings["file"]:
+        try:
+            os.remove(checkpoint_settings["file"])
+        except OSError:
+            pass
+
+def run_shard_processes(shard_inputs: List[str], shard_outputs: List[str], overrides: Dict[str, str], node_counts: List[int],
+                        script_prefix: str = SHARD_PREFIX) -> List[int]:
+    """并行运行多个 iptest 进程，每个分片使用独立的输入、输出文件和脚本，返回各分片退出码"""
+    shard_scripts = []
+    for i, (shard_input, shard_output) in enumerate(zip(shard_inputs, shard_outputs)):
+        shard_script = f"{script_prefix}{i}{os.path.splitext(SPEEDTEST_SCRIPT)[1]}"
+        if not write_shard_script(SPEEDTEST_SCRIPT, shard_script, {"file": shard_input, "outfile": shard_output, **overrides}):
+            return [1] * len(shard_inputs)
+        shard_scripts.append(shard_script)
+
+    def run_shard(i: int, script: str) -> int:
+        return_code = run_iptest_process(build_speedtest_command(script), node_counts[i], f"[分片 {i + 1}/{len(shard_scripts)}] ")
+        # 每个分片结束即写入检查点；只测延迟的分片（-speedtest=0）不是最终结果，不写入
+        if return_code == 0 and overrides.get("speedtest") != "0":
+            checkpoint_iptest_output(shard_inputs[i], shard_outputs[i])
+        return return_code
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(shard_scripts)) as executor:
+            futures = [executor.submit(run_shard, i, script) for i, script in enumerate(shard_scripts)]
+            return [future.result() for future in futures]
+    finally:
+        for script in shard_scripts:
+            try:
+                os.remove(script)
+            except OSError:
+                pass
+
+def run_sharded_speed_test(ip_lines: List[str], shards: int, serialize_download: bool) -> bool:
+    """将 ip.txt 拆分为多个分片并行测速，归并结果写入 ip.csv
+
+    serialize_download 为 True 时，分片只做延迟测试 (-speedtest=0)，
+    归并后对存活节点运行一次完整测速，避免并行下载互相挤占带宽导致速度失真。
+    """
+    shards = min(shards, len(ip_lines))
+    logger.info(f"分片测速: {len(ip_lines)} 个节点拆分为 {shards} 个分片{'，下载测速串行执行' if serialize_download else ''}")
+    shard_inputs = split_ip_list(ip_lines, shards, SHARD_PREFIX)
+    shard_outputs = [f"{SHARD_PREFIX}{i}.csv" for i in range(shards)]
+    node_counts = [len(ip_lines[i::shards]) for i in range(shards)]
+    overrides = {"speedtest": "0"} if serialize_download else {}
+    temp_files = shard_inputs + shard_outputs
+    try:
+        return_codes = run_shard_processes(shard_inputs, shard_outputs, overrides, node_counts)
+        failed = [i + 1 for i, code in enumerate(return_codes) if code != 0]
+        if failed:
+            logger.warning(f"分片 {failed} 测速失败，返回码: {return_codes}")
+        if len(failed) == len(return_codes):
+            logger.error("所有分片测速均失败")
+            return False
+        merged = merge_shard_results(shard_outputs, FINAL_CSV)
+        logger.info(f"已归并 {shards - len(failed)} 个分片的结果到 {FINAL_CSV}，共 {merged} 行")
+        if not serialize_download or merged == 0:
+            return merged > 0
+
+        # 只对延迟测试存活的节点运行一次完整测速
+        survivors_file = f"{SHARD_PREFIX}download.txt"
+        temp_files.append(survivors_file)
+        with open(FINAL_CSV, "r", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            survivors = [f"{row[0]} {row[1]}" for row in reader if len(row) > 1]
+        with open(survivors_file, "w", encoding="utf-8") as f:
+            f.writelines(f"{line}\n" for line in survivors)
+        logger.info(f"下载测速: {len(survivors)} 个延迟测试存活节点")
+        download_output = f"{SHARD_PREFIX}download.csv"
+        temp_files.append(download_output)
+        return_code = run_shard_processes([survivors_file], [download_output], {}, [len(survivors)])[0]
+        if return_code != 0 or not os.path.exists(download_output) or os.path.getsize(download_output) < 10:
+            logger.warning(f"下载测速失败（返回码: {return_code}），保留延迟测试结果")
+            return True
+        os.replace(download_output, FINAL_CSV)
+        return True
+    finally:
+        for temp_file in temp_files:
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+
+# 分布式测速：协调端持有节点集合，按批次租借给各测速端，租约超时后重新分配
+class LeaseTable:
+    """协调端的租约表（线程安全）"""
+
+    def __init__(self, nodes: List[str], lease_size: int, lease_timeout: float):
+        self.lock = threading.Lock()
+        self.pending = deque(nodes[i:i + lease_size] for i in range(0, len(nodes), lease_size))
+        self.attempts = defaultdict(int)  # 按节点计数，批次被拆分或合并后上限仍然落在每个节点上
+        self.leases = {}
+        self.lease_timeout = lease_timeout
+        self.total = len(nodes)
+        self.completed = 0
+        self.header = None
+        self.rows = []
+        self.next_id = 0
+        self.last_activity = time.time()
+
+    def _requeue(self, lease: Dict) -> int:
+        """将租约中的节点放回队列（调用方持有锁）；分配次数已达上限的节点放弃，返回重新排队的节点数"""
+        retry = [node for node in lease["nodes"] if self.attempts[node] < LEASE_MAX_ATTEMPTS]
+        abandoned = len(lease["nodes"]) - len(retry)
+        if abandoned:
+            logger.warning(f"{abandoned} 个节点已分配 {LEASE_MAX_ATTEMPTS} 次仍未完成，放弃")
+            self.completed += abandoned
+            metric_inc("lease_abandoned_nodes_total", abandoned)
+        if retry:
+            self.pending.append(retry)
+        return len(retry)
+
+    def requeue_expired(self):
+        now = time.time()
+        with self.lock:
+            for lease_id, lease in list(self.leases.items()):
+                if lease["expires"] > now:
                     continue
-                key = (row[0], row[1])
-                if key not in seen:
-                    seen.add(key)
-                    final_rows.append(row)
-    except Exception as e:
-        logger.error(f"无法处理 {csv_file}: {e}")
-        return
-    if not final_rows:
-        logger.info(f"没有有效的节点")
-        os.remove(csv_file)
-        return
+                del self.leases[lease_id]
+                metric_inc("lease_timeouts_total")
+                requeued = self._requeue(lease)
+                logger.warning(f"租约 {lease_id}（测速端 {lease['worker']}）超时，重新分配 {requeued}/{len(lease['nodes'])} 个节点")
+
+    def acquire(self, worker_id: str, max_nodes: int) -> Dict:
+        self.requeue_expired()
+        with self.lock:
+            self.last_activity = time.time()
+            if not self.pending:
+                return {"done": True} if not self.leases else {"wait": WORKER_POLL_INTERVAL}
+            nodes = self.pending.popleft()
+            if max_nodes and len(nodes) > max_nodes:
+                self.pending.appendleft(nodes[max_nodes:])
+                nodes = nodes[:max_nodes]
+            self.next_id += 1
+            lease_id = f"L{self.next_id}"
+            for node in nodes:
+                self.attempts[node] += 1
+            self.leases[lease_id] = {"worker": worker_id, "nodes": nodes, "expires": time.time() + self.lease_timeout}
+            metric_inc("leases_granted_total")
+            return {"lease_id": lease_id, "nodes": nodes, "ttl": self.lease_timeout}
+
+    def heartbeat(self, lease_id: str) -> bool:
+        with self.lock:
+            self.last_activity = time.time()
+            lease = self.leases.get(lease_id)
+            if not lease:
+                return False
+            lease["expires"] = time.time() + self.lease_timeout
+            return True
+
+    def fail(self, lease_id: str, reason: str = "") -> bool:
+        """测速端报告批次测速失败：立即重新分配，而不是把节点当作已测完"""
+        with self.lock:
+            self.last_activity = time.time()
+            lease = self.leases.pop(lease_id, None)
+            if not lease:
+                return False
+            metric_inc("lease_failures_total")
+            requeued = self._requeue(lease)
+            logger.warning(f"租约 {lease_id}（测速端 {lease['worker']}）测速失败{f'（{reason}）' if reason else ''}，"
+                           f"重新分配 {requeued}/{len(lease['nodes'])} 个节点")
+            return True
+
+    def complete(self, lease_id: str, header: List[str], rows: List[List[str]]) -> bool:
+        with self.lock:
+            self.last_activity = time.time()
+            lease = self.leases.pop(lease_id, None)
+            if not lease:
+                return False  # 租约已超时并被重新分配，丢弃迟到的结果
+            if header and self.header is None and len(header) >= 2:
+                self.header = header
+            # 只接受列数与表头一致、IP 和端口有效且属于本租约的行
+            leased = set(lease["nodes"])
+            columns = len(self.header) if self.header else 0
+            accepted = [row for row in rows if len(row) == columns and normalize_ip(row[0]) and is_valid_port(row[1])
+                        and f"{row[0]} {row[1]}" in leased]
+            if len(accepted) < len(rows):
+                logger.warning(f"租约 {lease_id}（测速端 {lease['worker']}）有 {len(rows) - len(accepted)} 行结果无效或不属于该租约，已丢弃")
+                metric_inc("lease_rejected_rows_total", len(rows) - len(accepted))
+            self.rows.extend(accepted)
+            self.completed += len(lease["nodes"])
+            metric_inc("probe_results_total", len(accepted))
+            logger.info(f"租约 {lease_id}（测速端 {lease['worker']}）完成: {len(accepted)}/{len(lease['nodes'])} 个节点有效，"
+                        f"进度 {self.completed}/{self.total}")
+            return True
+
+    def finished(self) -> bool:
+        with self.lock:
+            return not self.pending and not self.leases
+
+    def idle_seconds(self) -> float:
+        with self.lock:
+            return time.time() - self.last_activity
+
+    def status(self) -> Dict:
+        with self.lock:
+            return {"total": self.total, "completed": self.completed, "results": len(self.rows),
+                    "pending_batches": len(self.pending), "active_leases": len(self.leases)}
+
+def make_coordinator_handler(table: LeaseTable, token: str):
+    class CoordinatorHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            logger.debug(f"协调端请求: {self.address_string()} {format % args}")
+
+        def send_json(self, status: int, payload: Dict):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def authorized(self) -> bool:
+            if token and not hmac.compare_digest(self.headers.get("X-Coordinator-Token", "").encode("utf-8"), token.encode("utf-8")):
+                self.send_json(403, {"error": "invalid token"})
+                return False
+            return True
+
+        def do_GET(self):
+            if not self.authorized():
+                return
+            if self.path == "/status":
+                self.send_json(200, table.status())
+            else:
+                self.send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if not self.authorized():
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+            except ValueError:
+                self.send_json(400, {"error": "invalid content-length"})
+                return
+            if length < 0:
+                self.send_json(400, {"error": "invalid content-length"})
+                return
+            if length > COORDINATOR_MAX_BODY:
+                self.send_json(413, {"error": f"body exceeds {COORDINATOR_MAX_BODY} bytes"})
+                return
+            try:
+                payload = json.loads(self.rfile.read(length).decode("utf-8")) if length else {}
+                if not isinstance(payload, dict):
+                    raise ValueError("payload must be an object")
+            except (ValueError, UnicodeDecodeError) as e:
+                self.send_json(400, {"error": f"invalid json: {e}"})
+                return
+            if self.path == "/lease":
+                self.send_json(200, table.acquire(str(payload.get("worker_id", self.address_string())), int(payload.get("max_nodes", 0) or 0)))
+            elif self.path == "/heartbeat":
+                self.send_json(200, {"ok": table.heartbeat(str(payload.get("lease_id", "")))})
+            elif self.path == "/result":
+                raw_rows = payload.get("rows")
+                rows = [[str(v) for v in row] for row in raw_rows if isinstance(row, list)] if isinstance(raw_rows, list) else []
+                header = payload.get("header")
+                header = [str(v) for v in header] if isinstance(header, list) else None
+                self.send_json(200, {"accepted": table.complete(str(payload.get("lease_id", "")), header, rows)})
+            elif self.path == "/fail":
+                self.send_json(200, {"ok": table.fail(str(payload.get("lease_id", "")), str(payload.get("reason", "")))})
+            else:
+                self.send_json(404, {"error": "not found"})
+    return CoordinatorHandler
+
+def is_loopback_bind(bind: str) -> bool:
+    """协调端监听地址是否只在本机可达（127.0.0.0/8、::1 或 localhost）"""
+    host = bind.rpartition(":")[0].strip("[]")
+    if host.lower() == "localhost":
+        return True
     try:
-        final_rows.sort(key=lambda x: float(x[9]) if len(x) > 9 and x[9] and x[9].replace('.', '', 1).isdigit() else 0.0, reverse=True)
-    except Exception as e:
-        logger.warning(f"排序失败: {e}")
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
 
-    with open(csv_file, "w", newline="", encoding="utf-8") as f:
+def run_coordinator(bind: str, lease_size: int, lease_timeout: float, token: str = "",
+                    idle_timeout: float = COORDINATOR_IDLE_TIMEOUT) -> str:
+    """协调端：将 ip.txt 中的节点按批次租借给测速端，收集结果写入 ip.csv
+
+    连续 idle_timeout 秒没有任何测速端请求（领取、续约、回传）时不再等待，用已收到的结果继续；0 表示一直等待。
+    """
+    if not os.path.exists(IP_LIST_FILE):
+        logger.error(f"{IP_LIST_FILE} 不存在，请确保 write_ip_list 已正确生成文件")
+        return None
+    with open(IP_LIST_FILE, "r", encoding="utf-8") as f:
+        nodes = [line.strip() for line in f if line.strip()]
+    host, _, port = bind.rpartition(":")
+    table = LeaseTable(nodes, lease_size, lease_timeout)
+    try:
+        server = ThreadingHTTPServer((host or "0.0.0.0", int(port)), make_coordinator_handler(table, token))
+    except (OSError, ValueError) as e:
+        logger.error(f"协调端无法监听 {bind}: {e}")
+        return None
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    metric_inc("probe_nodes_total", len(nodes))
+    logger.info(f"协调端已启动: {bind}，{len(nodes)} 个节点，每批 {lease_size} 个，租约超时 {lease_timeout} 秒")
+    start_time = time.time()
+    last_report = 0.0
+    try:
+        while not table.finished():
+            time.sleep(1)
+            table.requeue_expired()
+            if time.time() - last_report >= 30:
+                last_report = time.time()
+                logger.info(f"协调端进度: {table.status()}")
+            if idle_timeout > 0 and table.idle_seconds() >= idle_timeout:
+                logger.error(f"已有 {idle_timeout:.0f} 秒没有测速端连接，停止等待，使用已收到的结果继续: {table.status()}")
+                metric_inc("coordinator_idle_timeouts_total")
+                break
+        else:
+            # 保持服务一段时间，让仍在轮询的测速端收到完成通知
+            time.sleep(WORKER_POLL_INTERVAL * 2)
+    finally:
+        server.shutdown()
+        server.server_close()
+    status = table.status()
+    logger.info(f"分布式测速完成，耗时: {time.time() - start_time:.2f} 秒，{status}")
+    metric_inc("probe_timeouts_total", max(len(nodes) - status["results"], 0))
+    if not table.rows or not table.header:
+        logger.error("没有收到任何测速结果")
+        return None
+    with open(FINAL_CSV, "w", newline="", encoding="utf-8") as f:
         writer = csv.writer(f)
-        writer.writerow(header)
-        writer.writerows(final_rows)
-    logger.info(f"已生成 {csv_file}")
+        writer.writerow(table.header)
+        writer.writerows(sorted(table.rows, key=result_sort_key))
+    logger.info(f"已将 {len(table.rows)} 条结果写入 {FINAL_CSV}")
+    return FINAL_CSV
+
+def run_worker(coordinator_url: str, worker_id: str, lease_size: int, token: str = "") -> bool:
+    """测速端：从协调端租借节点批次，按 --probe-engine 使用本地 iptest 或内置引擎测速并回传结果，直到协调端通知完成"""
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=2, status_forcelist=[500, 502, 503, 504, 429], allowed_methods=None)
+    session.mount('http://', HTTPAdapter(max_retries=retry))
+    session.mount('https://', HTTPAdapter(max_retries=retry))
+    headers = {"X-Coordinator-Token": token} if token else {}
+    base_url = coordinator_url.rstrip("/")
+    safe_id = re.sub(r'[^A-Za-z0-9_.-]', '_', worker_id)
+    input_file = f"ip.worker-{safe_id}.txt"
+    output_file = f"ip.worker-{safe_id}.csv"
+    batches = 0
+    failures = 0
+    logger.info(f"测速端 {worker_id} 已启动，协调端: {base_url}")
+
+    def post(path: str, payload: Dict) -> Dict:
+        response = session.post(f"{base_url}{path}", json=payload, headers=headers, timeout=60)
+        response.raise_for_status()
+        return response.json()
 
-    logger.info(f"{csv_file} 处理完成，{len(final_rows)} 个数据节点 (耗时: {time.time() - start_time:.2f} 秒)")
-    return len(final_rows)
+    while True:
+        try:
+            lease = post("/lease", {"worker_id": worker_id, "max_nodes": lease_size})
+        except Exception as e:
+            logger.error(f"无法从协调端获取租约: {e}")
+            return batches > 0
+        if lease.get("done"):
+            logger.info(f"协调端通知测速已完成，测速端 {worker_id} 共处理 {batches} 个批次")
+            return True
+        if "wait" in lease:
+            time.sleep(float(lease["wait"]))
+            continue
 
-def generate_ips_file(csv_file: str, is_github_actions: bool):
-    start_time = time.time()
-    if not os.path.exists(csv_file):
-        logger.info(f"{csv_file} 不存在")
+        lease_id, nodes = lease["lease_id"], lease["nodes"]
+        logger.info(f"获得租约 {lease_id}: {len(nodes)} 个节点")
+        with open(input_file, "w", encoding="utf-8") as f:
+            f.writelines(f"{node}\n" for node in nodes)
+        if os.path.exists(output_file):
+            os.remove(output_file)
+
+        # 测速期间定期续约，避免长批次被误判为超时
+        stop_heartbeat = threading.Event()
+        def heartbeat():
+            while not stop_heartbeat.wait(max(float(lease.get("ttl", LEASE_TIMEOUT)) / 3, 1)):
+                try:
+                    post("/heartbeat", {"lease_id": lease_id})
+                except Exception as e:
+                    logger.warning(f"续约 {lease_id} 失败: {e}")
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            if probe_settings["engine"] == "native":
+                # 内置引擎不需要 iptest；没有有效节点也会写出表头，只有异常才算测速失败
+                try:
+                    run_native_speed_test(nodes, output_csv=output_file)
+                    return_code = 0
+                except Exception as e:
+                    logger.error(f"内置引擎测速租约 {lease_id} 出错: {e}")
+                    return_code = -1
+            else:
+                return_code = run_shard_processes([input_file], [output_file], {}, [len(nodes)], script_prefix=f"ip.worker-{safe_id}.")[0]
+        finally:
+            stop_heartbeat.set()
+            heartbeat_thread.join()
+
+        if return_code != 0:
+            # 测速失败时不能回传空结果，否则协调端会把整个批次当作已测完；改为报告失败，让协调端重新分配
+            failures += 1
+            logger.warning(f"租约 {lease_id} 测速失败，返回码: {return_code}，已连续失败 {failures} 次")
+            try:
+                post("/fail", {"lease_id": lease_id, "worker_id": worker_id, "reason": f"{probe_settings['engine']} 返回码 {return_code}"})
+            except Exception as e:
+                logger.error(f"向协调端报告租约 {lease_id} 失败时出错: {e}，等待租约超时后重新分配")
+            for temp_file in (input_file, output_file):
+                try:
+                    os.remove(temp_file)
+                except OSError:
+                    pass
+            if failures >= WORKER_MAX_FAILURES:
+                logger.error(f"测速端 {worker_id} 连续 {failures} 个批次测速失败，停止领取租约")
+                return False
+            time.sleep(WORKER_POLL_INTERVAL)
+            continue
+        failures = 0
+
+        header, rows = None, []
+        if os.path.exists(output_file) and os.path.getsize(output_file) >= 10:
+            with open(output_file, "r", encoding="utf-8-sig") as f:
+                reader = csv.reader(f)
+                header = next(reader, None)
+                rows = [row for row in reader if row and row[0].strip()]
+        try:
+            accepted = post("/result", {"lease_id": lease_id, "worker_id": worker_id, "header": header, "rows": rows}).get("accepted")
+        except Exception as e:
+            logger.error(f"回传租约 {lease_id} 的结果失败: {e}")
+            accepted = False
+        logger.info(f"租约 {lease_id} 结果已回传: {len(rows)} 行{'' if accepted else '（协调端未接受，租约可能已超时）'}")
+        batches += 1
+        for temp_file in (input_file, output_file):
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+
+# 内置探测引擎（--probe-engine native）：用 asyncio 直接探测节点，并发由 AIMD 控制器自适应调整
+class AIMDController:
+    """AIMD 并发控制器（只在单个事件循环内使用）
+
+    节点列表本身就含有大量失效节点，超时率的绝对值说明不了拥塞，因此以观测到的最低窗口超时率为基线：
+    窗口超时率超出基线 timeout_margin 以上、延迟中位数膨胀到基线的 rtt_tolerance 倍以上，
+    或出现本地资源耗尽错误（EMFILE、ENOBUFS、EADDRNOTAVAIL 等）时判定为拥塞，并发乘以 decrease；
+    否则只要并发确实被用满，就线性增加 increase。
+    """
+
+    def __init__(self, initial: int = AIMD_INITIAL, minimum: int = AIMD_MIN, maximum: int = AIMD_MAX,
+                 increase: float = AIMD_INCREASE, decrease: float = AIMD_DECREASE, window: float = AIMD_WINDOW,
+                 timeout_margin: float = AIMD_TIMEOUT_MARGIN, rtt_tolerance: float = AIMD_RTT_TOLERANCE,
+                 cooldown: float = PROBE_TIMEOUT, name: str = "probe"):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.increase = increase
+        self.decrease = decrease
+        self.window = window
+        self.timeout_margin = timeout_margin
+        self.rtt_tolerance = rtt_tolerance
+        self.cooldown = cooldown  # 下调后等待已发出的探测超时完毕，避免对同一次拥塞重复下调
+        self.name = name
+        self.in_flight = 0
+        self.condition = None
+        self.saturated = False
+        self.draining = False  # 节点已全部发出，剩余的慢节点不再代表当前并发下的网络状况
+        # 超时结果要晚一个超时周期才出现，预热期内不建立基线，避免基线被低估
+        self.cooldown_until = 0.0
+        self.warmup_until = time.monotonic() + cooldown
+        self.baseline_timeout_rate = None
+        self.baseline_rtt = None
+        self.goodput = 0.0
+        self.timeout_rate = 0.0
+        self.peak = self.limit
+        self.increases = 0
+        self.decreases = 0
+        self._reset_window(time.monotonic())
+        metric_set("probe_concurrency", self.limit, pool=self.name)
+
+    def _reset_window(self, now: float):
+        self.window_start = now
+        self.window_ok = 0
+        self.window_timeouts = 0
+        self.window_errors = 0
+        self.window_local = 0
+        self.window_rtts = []
+        self.saturated = self.in_flight >= int(self.limit)
+
+    async def acquire(self):
+        """等待一个并发名额"""
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.saturated = True
+                await self.condition.wait()
+            self.in_flight += 1
+        metric_set("probes_in_flight", self.in_flight, pool=self.name)
+
+    async def release(self, outcome: str, latency_ms: float = None):
+        """归还名额并记录探测结果：ok/invalid 为成功连通，timeout/local 为拥塞候选，其余视为节点自身故障"""
+        async with self.condition:
+            self.in_flight -= 1
+            self.record(outcome, latency_ms)
+            self.condition.notify_all()
+        metric_set("probes_in_flight", self.in_flight, pool=self.name)
+
+    def record(self, outcome: str, latency_ms: float = None):
+        if outcome in ("ok", "invalid"):
+            self.window_ok += outcome == "ok"
+            self.window_errors += outcome == "invalid"
+            if latency_ms is not None:
+                self.window_rtts.append(latency_ms)
+        elif outcome == "timeout":
+            self.window_timeouts += 1
+        elif outcome == "local":
+            self.window_local += 1
+        else:
+            self.window_errors += 1  # 连接被拒、重置等：节点本身的问题，不视为拥塞
+        now = time.monotonic()
+        samples = self.window_ok + self.window_timeouts + self.window_errors + self.window_local
+        if self.draining:
+            return
+        if self.window_local or (now - self.window_start >= self.window and samples >= AIMD_MIN_SAMPLES):
+            self.adjust(now)
+
+    def adjust(self, now: float):
+        """窗口结束时根据超时率和延迟决定增减并发，并更新实时指标"""
+        elapsed = max(now - self.window_start, 1e-6)
+        samples = self.window_ok + self.window_timeouts + self.window_errors + self.window_local
+        self.timeout_rate = (self.window_timeouts + self.window_local) / samples
+        self.goodput = self.window_ok / elapsed
+        median_rtt = statistics.median(self.window_rtts) if self.window_rtts else None
+
+        warming_up = now < self.warmup_until
+        congestion = ""
+        if self.window_local:
+            congestion = f"本地资源耗尽 {self.window_local} 次"
+        elif warming_up:
+            congestion = ""
+        elif self.baseline_timeout_rate is not None and self.timeout_rate > self.baseline_timeout_rate + self.timeout_margin:
+            congestion = f"超时率 {self.timeout_rate:.0%} 高于基线 {self.baseline_timeout_rate:.0%}"
+        elif median_rtt is not None and self.baseline_rtt and median_rtt > self.baseline_rtt * self.rtt_tolerance:
+            congestion = f"延迟中位数 {median_rtt:.0f} ms 超过基线 {self.baseline_rtt:.0f} ms 的 {self.rtt_tolerance} 倍"
+
+        if congestion:
+            if now >= self.cooldown_until:
+                previous = self.limit
+                self.limit = max(float(self.minimum), self.limit * self.decrease)
+                self.cooldown_until = now + self.cooldown
+                self.decreases += 1
+                metric_inc("probe_concurrency_decreases_total", pool=self.name)
+                logger.info(f"[{self.name}] 探测并发下调: {previous:.0f} -> {self.limit:.0f}（{congestion}）")
+        elif self.saturated and self.limit < self.maximum:
+            self.limit = min(float(self.maximum), self.limit + self.increase)
+            self.increases += 1
+        self.peak = max(self.peak, self.limit)
+
+        # 基线每个窗口最多上浮一点，节点质量整体变差时不会一直被判为拥塞
+        if not warming_up:
+            if self.baseline_timeout_rate is None:
+                self.baseline_timeout_rate = self.timeout_rate
+            else:
+                self.baseline_timeout_rate = min(self.timeout_rate, self.baseline_timeout_rate + AIMD_BASELINE_DRIFT)
+            if median_rtt is not None:
+                self.baseline_rtt = median_rtt if self.baseline_rtt is None else min(median_rtt, self.baseline_rtt * (1 + AIMD_BASELINE_DRIFT))
+
+        metric_set("probe_concurrency", self.limit, pool=self.name)
+        metric_set("probe_goodput_per_second", round(self.goodput, 2), pool=self.name)
+        metric_set("probe_window_timeout_rate", round(self.timeout_rate, 4), pool=self.name)
+        self._reset_window(now)
+
+def make_probe_ssl_context() -> ssl.SSLContext:
+    """探测用 TLS 上下文：按 IP 直连，证书与 IP 不对应，因此不校验证书"""
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+def parse_http_head(head: bytes) -> Tuple[int, Dict[str, str]]:
+    """解析 HTTP 响应状态码和头部（头部名转为小写）"""
+    status_line, _, raw_headers = head.decode("latin-1").partition("\r\n")
+    parts = status_line.split(" ", 2)
+    status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+    headers = {}
+    for line in raw_headers.split("\r\n"):
+        name, _, value = line.partition(":")
+        if name:
+            headers[name.strip().lower()] = value.strip()
+    return status, headers
+
+async def read_http_body(reader: asyncio.StreamReader, headers: Dict[str, str], limit: int) -> bytes:
+    """按 Content-Length 或 chunked 读取响应体，最多读取 limit 字节"""
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        body = b""
+        while len(body) < limit:
+            size_line = await reader.readuntil(b"\r\n")
+            size = int(size_line.split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                await reader.readuntil(b"\r\n")
+                break
+            body += await reader.readexactly(size)
+            await reader.readexactly(2)
+        return body[:limit]
+    length = headers.get("content-length", "")
+    if length.isdigit():
+        return await reader.readexactly(min(int(length), limit))
+    return await reader.read(limit)
+
+def parse_trace(body: bytes) -> Dict[str, str]:
+    """解析 /cdn-cgi/trace 的 key=value 内容"""
+    trace = {}
+    for line in body.decode("utf-8", errors="replace").splitlines():
+        key, sep, value = line.partition("=")
+        if sep:
+            trace[key.strip()] = value.strip()
+    return trace
+
+class WarmConnectionPool:
+    """延迟探测后保留的空闲连接：有效节点的 trace 连接不关闭，留给随后的下载测速复用，省去一次 TCP（和 TLS）握手
+
+    下载测速要等全部探测结束才开始，且并发很低，能在空闲超时前用上的连接只有少数几个，因此连接池只保留
+    延迟最低的 capacity 个候选节点的连接：满时新连接比池中延迟最高的连接更好才替换它，否则直接关闭。
+    空闲超过 idle_timeout 秒的连接在放入或取出时关闭。
+    asyncio 的流绑定在创建它的事件循环上，探测和下载必须在同一个事件循环中进行。
+    """
+
+    def __init__(self, capacity: int = WARM_POOL_SIZE, idle_timeout: float = WARM_POOL_IDLE):
+        self.capacity = capacity
+        self.idle_timeout = idle_timeout
+        # (IP, 端口) -> (reader, writer, 放入时间, 建立连接耗时, 延迟毫秒)，按放入顺序排列
+        self.connections = {}
+        self.evicted = 0
+
+    def evict_idle(self):
+        expire_before = time.monotonic() - self.idle_timeout
+        for node in [node for node, entry in self.connections.items() if entry[2] < expire_before]:
+            self.connections.pop(node)[1].close()
+            self.evicted += 1
+
+    def put(self, ip: str, port: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, connect_seconds: float,
+            latency_ms: float = 0.0) -> bool:
+        """放入连接，返回是否保留；未保留时由调用方关闭连接"""
+        if self.capacity <= 0:
+            return False
+        self.evict_idle()
+        if len(self.connections) >= self.capacity:
+            worst = max(self.connections, key=lambda node: self.connections[node][4])
+            if self.connections[worst][4] <= latency_ms:
+                return False
+            self.connections.pop(worst)[1].close()
+            self.evicted += 1
+        self.connections[(ip, port)] = (reader, writer, time.monotonic(), connect_seconds, latency_ms)
+        return True
+
+    def take(self, ip: str, port: int) -> Tuple:
+        """取出节点的空闲连接 (reader, writer, 建立连接耗时)，没有或已被服务器关闭时返回 None"""
+        self.evict_idle()
+        entry = self.connections.pop((ip, port), None)
+        if entry is None:
+            return None
+        reader, writer, _, connect_seconds, _ = entry
+        if reader.at_eof() or writer.is_closing():
+            writer.close()
+            return None
+        return reader, writer, connect_seconds
+
+    def close_all(self):
+        for entry in self.connections.values():
+            entry[1].close()
+        self.connections.clear()
+
+async def _probe_trace(ip: str, port: int, use_tls: bool, ssl_context: ssl.SSLContext, result: Dict,
+                       pool: WarmConnectionPool = None):
+    loop = asyncio.get_running_loop()
+    connect_start = loop.time()
+    reader, writer = await asyncio.open_connection(
+        ip, port, ssl=ssl_context if use_tls else None, server_hostname=PROBE_HOST if use_tls else None)
+    connect_seconds = loop.time() - connect_start
+    kept = False
+    try:
+        request = (f"GET {PROBE_TRACE_PATH} HTTP/1.1\r\nHost: {PROBE_HOST}\r\n"
+                   f"User-Agent: {HEADERS['User-Agent']}\r\nConnection: {'keep-alive' if pool else 'close'}\r\n\r\n")
+        sent_at = loop.time()
+        writer.write(request.encode())
+        await writer.drain()
+        head = await reader.readuntil(b"\r\n\r\n")
+        result["latency_ms"] = (loop.time() - sent_at) * 1000
+        status, headers = parse_http_head(head)
+        body = await read_http_body(reader, headers, TRACE_MAX_BYTES)
+        trace = parse_trace(body)
+        result["colo"] = trace.get("colo", "").upper()
+        result["outcome"] = "ok" if status == 200 and result["colo"] else "invalid"
+        if pool is not None and result["outcome"] == "ok" and headers.get("connection", "").lower() != "close":
+            # 只有完整读完响应体的连接才能继续发送下一个请求
+            length = headers.get("content-length", "")
+            complete = (length.isdigit() and int(length) <= TRACE_MAX_BYTES) or (
+                headers.get("transfer-encoding", "").lower() == "chunked" and len(body) < TRACE_MAX_BYTES)
+            kept = complete and pool.put(ip, port, reader, writer, connect_seconds, result["latency_ms"])
+    finally:
+        if not kept:
+            writer.close()
+
+async def probe_node(ip: str, port: int, use_tls: bool, timeout: float, ssl_context: ssl.SSLContext = None,
+                     pool: WarmConnectionPool = None) -> Dict:
+    """探测单个节点：建立 TCP（可选 TLS）连接后请求 /cdn-cgi/trace
+
+    延迟取请求发出到收到响应头的时间，不含 TCP/TLS 握手；返回的 outcome 为
+    ok（有效 Cloudflare 节点）、invalid（能连通但无 colo 或状态码异常）、timeout、refused、local（本地资源耗尽）或 error。
+    传入 pool 时有效节点的连接保持打开并放入连接池，供随后的下载测速复用。
+    """
+    result = {"ip": ip, "port": port, "outcome": "error", "latency_ms": None, "colo": ""}
+    try:
+        await asyncio.wait_for(_probe_trace(ip, port, use_tls, ssl_context, result, pool), timeout)
+    except asyncio.TimeoutError:
+        result["outcome"] = "timeout"
+    except ConnectionRefusedError:
+        result["outcome"] = "refused"
+    except OSError as e:
+        result["outcome"] = "local" if e.errno in LOCAL_RESOURCE_ERRNOS else "error"
+    except Exception:
+        result["outcome"] = "error"  # TLS 握手失败、响应不完整等
+    if result["outcome"] != "ok":
+        result["latency_ms"] = None
+    return result
+
+def flush_live_metrics():
+    """运行中刷新 Prometheus textfile，长时间的探测阶段也能被实时抓取"""
+    textfile_path = metrics_outputs["textfile"]
+    if not textfile_path:
         return
-    country_cache = load_country_cache()
-    final_nodes = []
+    try:
+        temp_path = f"{textfile_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(format_prometheus_textfile(build_run_report()))
+        os.replace(temp_path, textfile_path)
+    except Exception as e:
+        logger.debug(f"无法刷新实时指标 {textfile_path}: {e}")
+
+async def report_probe_progress(controller: AIMDController, results: List[Dict], total: int):
+    """定期打印探测进度并刷新实时指标"""
+    while True:
+        await asyncio.sleep(LIVE_METRICS_INTERVAL)
+        logger.info(f"[{controller.name}] 探测进度: {len(results)}/{total}，并发 {controller.limit:.0f}（在途 {controller.in_flight}），"
+                    f"有效吞吐 {controller.goodput:.1f} 个/秒，窗口超时率 {controller.timeout_rate:.0%}")
+        flush_live_metrics()
+
+async def probe_nodes_native(nodes: List[Tuple[str, int]], use_tls: bool, controller: AIMDController,
+                             pool: WarmConnectionPool = None) -> List[Dict]:
+    """按控制器给出的并发上限探测全部节点，返回每个节点的探测结果"""
+    ssl_context = make_probe_ssl_context() if use_tls else None
+    timeout = probe_settings["timeout"]
+    results = []
+    pending = set()
+    controller.draining = False  # 子网搜索会用同一个控制器分多轮探测
+
+    async def run_one(ip: str, port: int):
+        result = await probe_node(ip, port, use_tls, timeout, ssl_context, pool)
+        await controller.release(result["outcome"], result["latency_ms"])
+        metric_inc("probe_outcomes_total", outcome=result["outcome"])
+        if result["outcome"] == "ok":
+            metric_inc("probe_valid_total")
+            metric_observe("probe_latency_seconds", result["latency_ms"] / 1000)
+        if negative_cache_settings["enabled"]:
+            probe_outcomes[(ip_key(ip) << 16) | port] = result["outcome"] == "ok"
+        if active_checkpoint is not None:
+            active_checkpoint.record_probe(result)
+        results.append(result)
+
+    reporter = asyncio.create_task(report_probe_progress(controller, results, len(nodes)))
+    try:
+        for launched, (ip, port) in enumerate(nodes):
+            if time_left() <= 0:
+                deadline_cutoff("speed_test", f"[{controller.name}] 停止探测，{len(nodes) - launched} 个节点未测试")
+                break
+            await controller.acquire()
+            task = asyncio.create_task(run_one(ip, port))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        controller.draining = True
+        if pending:
+            await asyncio.gather(*list(pending))
+    finally:
+        reporter.cancel()
+    return results
+
+def parse_download_url(url: str) -> Tuple[str, str]:
+    """拆分测速脚本 -url 参数（如 speed.cloudflare.com/__down?bytes=50000000）为 (主机名, 路径)"""
+    url = re.sub(r'^\w+://', '', url.strip())
+    host, _, path = url.partition("/")
+    return host or PROBE_HOST, "/" + path
+
+def download_stop_reason(rates: List[float], elapsed: float, speed_limit_bps: float, confidence: float) -> str:
+    """根据最近的窗口吞吐判断是否可以提前结束下载测速
+
+    取最近 DOWNLOAD_STABLE_WINDOWS 个窗口的均值和 95% 置信区间：区间上界仍低于 speedlimit 时返回 below_limit，
+    区间半宽不超过均值的 confidence 时返回 stable，否则返回空字符串继续下载。confidence 为 0 时不提前结束。
+    """
+    if confidence <= 0 or elapsed < DOWNLOAD_MIN_SECONDS or len(rates) < DOWNLOAD_STABLE_WINDOWS:
+        return ""
+    recent = rates[-DOWNLOAD_STABLE_WINDOWS:]
+    mean = statistics.fmean(recent)
+    half_width = DOWNLOAD_CI_FACTOR * statistics.stdev(recent) / math.sqrt(len(recent))
+    if speed_limit_bps > 0 and mean + half_width < speed_limit_bps:
+        return "below_limit"
+    if mean > 0 and half_width <= mean * confidence:
+        return "stable"
+    return ""
+
+def download_estimate(result: Dict) -> float:
+    """由窗口吞吐估算下载速度（字节/秒）：窗口足够时取最近窗口均值，避开 TCP 慢启动；否则取整体平均"""
+    rates = result["rates"]
+    if len(rates) >= DOWNLOAD_STABLE_WINDOWS:
+        return statistics.fmean(rates[-DOWNLOAD_STABLE_WINDOWS:])
+    if result["elapsed"] > 0:
+        return result["bytes"] / result["elapsed"]
+    return 0.0
+
+async def _measure_download(ip: str, port: int, use_tls: bool, ssl_context: ssl.SSLContext, host: str, path: str,
+                            speed_limit_bps: float, confidence: float, result: Dict, warm: Tuple = None):
+    loop = asyncio.get_running_loop()
+    # 建立连接和等待响应头受探测超时约束，卡住的节点不会占满整个下载时长
+    timeout = probe_settings["timeout"]
+    request = (f"GET {path} HTTP/1.1\r\nHost: {host}\r\n"
+               f"User-Agent: {HEADERS['User-Agent']}\r\nConnection: close\r\n\r\n").encode()
+    head = None
+    writer = None
+    # 复用连接和新建连接都在同一个 try/finally 内，超时或被取消时连接也会被关闭
+    try:
+        if warm is not None:
+            reader, writer, connect_seconds = warm
+            try:
+                writer.write(request)
+                await writer.drain()
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+                result["reused"] = True
+                result["handshake_saved"] = connect_seconds
+            except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                # 服务器已关闭空闲连接或不再响应，改用新连接
+                writer.close()
+                writer = None
+                result["stale"] = True
+        if head is None:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                ip, port, ssl=ssl_context if use_tls else None, server_hostname=host if use_tls else None), timeout)
+            writer.write(request)
+            await writer.drain()
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+        status, headers = parse_http_head(head)
+        if status != 200:
+            result["stop_reason"] = "http_error"
+            return
+        length = int(headers["content-length"]) if headers.get("content-length", "").isdigit() else None
+        start = window_start = loop.time()
+        window_bytes = 0
+        while True:
+            chunk = await reader.read(DOWNLOAD_CHUNK_SIZE)
+            now = loop.time()
+            result["elapsed"] = now - start
+            if not chunk:
+                result["stop_reason"] = "complete"
+                break
+            result["bytes"] += len(chunk)
+            window_bytes += len(chunk)
+            if now - window_start >= DOWNLOAD_SAMPLE_INTERVAL:
+                result["rates"].append(window_bytes / (now - window_start))
+                window_start, window_bytes = now, 0
+                reason = download_stop_reason(result["rates"], result["elapsed"], speed_limit_bps, confidence)
+                if reason:
+                    result["stop_reason"] = reason
+                    break
+            if length is not None and result["bytes"] >= length:
+                result["stop_reason"] = "complete"
+                break
+    finally:
+        if writer is not None:
+            writer.close()
+
+async def measure_download(ip: str, port: int, use_tls: bool, host: str, path: str, speed_limit_bps: float,
+                           ssl_context: ssl.SSLContext = None, warm: Tuple = None) -> Dict:
+    """对单个节点做自适应下载测速：按 DOWNLOAD_SAMPLE_INTERVAL 采样窗口吞吐，
+    估计值稳定或明显低于 speedlimit 时立即断开，最长下载 download_max_seconds 秒
+
+    返回的 mbps 为估计速度（MB/s），bytes 为实际消耗的字节数，stop_reason 为
+    stable、below_limit、complete、max_time、http_error 或 error。
+    warm 为延迟探测留下的空闲连接 (reader, writer, 建立连接耗时)，可用时直接在其上发送下载请求，
+    reused 和 handshake_saved 记录是否复用及省下的握手时间；连接已失效时 stale 为 True 并改用新连接。
+    """
+    result = {"bytes": 0, "elapsed": 0.0, "rates": [], "stop_reason": "error", "mbps": 0.0,
+              "reused": False, "stale": False, "handshake_saved": 0.0}
+    try:
+        await asyncio.wait_for(
+            _measure_download(ip, port, use_tls, ssl_context, host, path, speed_limit_bps,
+                              probe_settings["download_confidence"], result, warm),
+            probe_settings["timeout"] + min(probe_settings["download_max_seconds"], max(time_left(), 0.0)))
+    except asyncio.TimeoutError:
+        result["stop_reason"] = "max_time" if result["bytes"] else "timeout"
+    except Exception:
+        result["stop_reason"] = "error"
+    if result["stop_reason"] in ("stable", "below_limit", "complete", "max_time"):
+        result["mbps"] = download_estimate(result) / (1024 * 1024)
+    return result
+
+async def measure_downloads(candidates: List[Dict], use_tls: bool, download_url: str, speed_limit: float,
+                            concurrency: int, warm_pool: WarmConnectionPool = None):
+    """以固定并发（测速脚本的 -speedtest 参数）对候选节点做下载测速，结果写回各节点的结果字典
+
+    传入 warm_pool 时先测连接池中仍有空闲连接的节点（按放入顺序，先放入的先过期），复用这些连接。
+    """
+    host, path = parse_download_url(download_url)
+    ssl_context = make_probe_ssl_context() if use_tls else None
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    speed_limit_bps = speed_limit * 1024 * 1024
+    if warm_pool is not None:
+        warm_order = {node: i for i, node in enumerate(warm_pool.connections)}
+        candidates = sorted(candidates, key=lambda c: warm_order.get((c["ip"], c["port"]), len(warm_order)))
+
+    async def run_one(candidate: Dict):
+        async with semaphore:
+            if time_left() < DEADLINE_MIN_DOWNLOAD:
+                candidate.update(mbps=0.0, download_bytes=0, stop_reason="deadline")
+                metric_inc("download_stops_total", reason="deadline")
+                return
+            warm = warm_pool.take(candidate["ip"], candidate["port"]) if warm_pool is not None else None
+            download = await measure_download(candidate["ip"], candidate["port"], use_tls, host, path,
+                                              speed_limit_bps, ssl_context, warm)
+        metric_inc("download_connections_total", reused="true" if download["reused"] else "false")
+        if download["stale"]:
+            metric_inc("warm_pool_stale_total")
+        metric_inc("download_handshake_saved_seconds", download["handshake_saved"])
+        candidate["reused"] = download["reused"]
+        candidate["handshake_saved"] = download["handshake_saved"]
+        candidate["mbps"] = download["mbps"]
+        candidate["download_bytes"] = download["bytes"]
+        candidate["stop_reason"] = download["stop_reason"]
+        if active_checkpoint is not None:
+            active_checkpoint.record_download(candidate)
+        metric_inc("download_bytes_total", download["bytes"])
+        metric_inc("download_stops_total", reason=download["stop_reason"])
+        if download["mbps"] > 0:
+            metric_observe("download_seconds", download["elapsed"])
+        logger.info(f"下载测速 {candidate['ip']} {candidate['port']}: {download['mbps']:.2f} MB/s，"
+                    f"用量 {download['bytes'] / 1024 / 1024:.1f} MB，{download['elapsed']:.1f} 秒，{download['stop_reason']}"
+                    f"{'，复用连接' if download['reused'] else ''}")
+
+    await asyncio.gather(*(run_one(candidate) for candidate in candidates))
+    skipped = sum(1 for candidate in candidates if candidate.get("stop_reason") == "deadline")
+    if skipped:
+        deadline_cutoff("speed_test", f"{skipped}/{len(candidates)} 个节点未做下载测速")
+
+async def probe_pools_native(pools: Dict[int, List[Tuple[str, int]]], use_tls: bool,
+                             controllers: Dict[int, AIMDController], warm_pool: WarmConnectionPool = None) -> List[Dict]:
+    """IPv4 和 IPv6 节点各用一个独立的并发池同时探测，一个地址族的拥塞不会压低另一个的并发"""
+    pool_results = await asyncio.gather(*(probe_nodes_native(nodes, use_tls, controllers[family], warm_pool)
+                                          for family, nodes in pools.items()))
+    return [result for results in pool_results for result in results]
+
+def subnet_key(ip: str) -> Tuple[int, int]:
+    """节点所在子网：IPv4 取 /24，IPv6 取 /48"""
+    if ':' in ip:
+        return 6, ip_key(ip) >> (128 - CIDR_SAMPLE_PREFIX_V6)
+    return 4, ip_key(ip) >> (32 - CIDR_SAMPLE_PREFIX_V4)
+
+def subnet_score(results: List[Dict]) -> float:
+    """子网得分（越小越好）：有效节点的延迟中位数除以有效比例；没有有效节点时为无穷大"""
+    latencies = [r["latency_ms"] for r in results if r["outcome"] == "ok"]
+    if not latencies:
+        return math.inf
+    return statistics.median(latencies) * len(results) / len(latencies)
+
+def split_pools(nodes: List[Tuple[str, int]]) -> Dict[int, List[Tuple[str, int]]]:
+    pools = defaultdict(list)
+    for ip, port in nodes:
+        pools[ip_family(ip)].append((ip, port))
+    return pools
+
+def select_subnets(subnets: Dict, quota: int, batch: int) -> Dict[Tuple[int, int], int]:
+    """为下一轮选择要扩展的子网及各自追加的节点数
+
+    每个国家已有的有效节点不足 quota 时，按得分从好到差选择还有未测节点的子网，
+    每个子网追加 batch 个节点，直到按各子网的有效比例估算的新增有效节点足以补足配额；
+    quota 为 0 时扩展全部有有效节点的子网。代表节点全部失效的子网不再扩展。
+    """
+    found = defaultdict(int)
+    by_country = defaultdict(list)
+    for key, subnet in subnets.items():
+        found[subnet["country"]] += sum(1 for r in subnet["results"] if r["outcome"] == "ok")
+        remaining = len(subnet["nodes"]) - subnet["offset"]
+        if remaining > 0 and subnet["score"] < math.inf:
+            by_country[subnet["country"]].append((subnet["score"], key, remaining))
+    selection = {}
+    for country, candidates in by_country.items():
+        need = quota - found[country] if quota > 0 else math.inf
+        expected = 0.0
+        for _, key, remaining in sorted(candidates):
+            if expected >= need:
+                break
+            subnet = subnets[key]
+            count = min(batch, remaining)
+            selection[key] = count
+            expected += count * sum(1 for r in subnet["results"] if r["outcome"] == "ok") / len(subnet["results"])
+    return selection
+
+async def search_subnets_native(nodes: List[Tuple[str, int]], use_tls: bool, controllers: Dict[int, AIMDController],
+                                warm_pool: WarmConnectionPool = None) -> List[Dict]:
+    """分层子网搜索：先在每个子网（IPv4 /24、IPv6 /48）探测少量代表节点并为子网打分，
+    之后每轮只扩展得分最好的子网，每轮追加的节点数翻倍，直到每个国家的有效节点达到配额
+
+    同一子网内的节点表现几乎一致，聚集的输入不必逐个探测；扩展时优先选择该子网内已探测成功的端口。
+    节点国家取 write_ip_list 的筛选结果，缺失时取子网内第一个有效节点的数据中心所在国家。
+    """
+    representatives = max(1, probe_settings["search_representatives"])
+    quota = probe_settings["search_quota"]
+    rng = random.Random(cidr_settings["seed"])
+    subnets = {}
+    for ip, port in nodes:
+        subnet = subnets.get(subnet_key(ip))
+        if subnet is None:
+            subnet = subnets[subnet_key(ip)] = {"nodes": [], "offset": 0, "results": [], "score": math.inf,
+                                                "country": lookup_node_country(ip, port)}
+        subnet["nodes"].append((ip, port))
+    for subnet in subnets.values():
+        rng.shuffle(subnet["nodes"])
+    logger.info(f"子网搜索: {len(nodes)} 个节点分布在 {len(subnets)} 个子网，每个子网先探测 {representatives} 个代表节点，"
+                f"每个国家配额 {quota or '不限'} 个有效节点")
+
+    results = []
+    selection = {key: representatives for key in subnets}
+    batch = representatives
+    search_round = 0
+    while selection:
+        if time_left() <= 0:
+            deadline_cutoff("speed_test", f"子网搜索在第 {search_round} 轮后停止，{len(selection)} 个子网未继续扩展")
+            break
+        search_round += 1
+        round_nodes = []
+        for key, count in selection.items():
+            subnet = subnets[key]
+            round_nodes.extend(subnet["nodes"][subnet["offset"]:subnet["offset"] + count])
+            subnet["offset"] += count
+        round_results = await probe_pools_native(split_pools(round_nodes), use_tls, controllers, warm_pool)
+        for result in round_results:
+            subnet = subnets[subnet_key(result["ip"])]
+            subnet["results"].append(result)
+            if result["outcome"] == "ok" and not subnet["country"]:
+                subnet["country"] = IATA_TO_COUNTRY.get(result["colo"], "")
+        for key in selection:
+            subnet = subnets[key]
+            subnet["score"] = subnet_score(subnet["results"])
+            # 已探测成功的端口排到未测节点的前面
+            good_ports = {r["port"] for r in subnet["results"] if r["outcome"] == "ok"}
+            if good_ports:
+                untested = subnet["nodes"][subnet["offset"]:]
+                untested.sort(key=lambda node: node[1] not in good_ports)
+                subnet["nodes"][subnet["offset"]:] = untested
+        results.extend(round_results)
+        metric_inc("search_rounds_total")
+        valid = sum(1 for r in round_results if r["outcome"] == "ok")
+        logger.info(f"子网搜索第 {search_round} 轮: 扩展 {len(selection)} 个子网，探测 {len(round_nodes)} 个节点，有效 {valid} 个")
+        batch *= 2
+        selection = select_subnets(subnets, quota, batch)
+
+    valid = sum(1 for r in results if r["outcome"] == "ok")
+    skipped = len(nodes) - len(results)
+    metric_inc("search_skipped_total", skipped)
+    logger.info(f"子网搜索完成: 共 {search_round} 轮，探测 {len(results)}/{len(nodes)} 个节点，跳过 {skipped} 个，"
+                f"有效 {valid} 个，平均每个有效节点探测 {len(results) / max(valid, 1):.1f} 次")
+    return results
+
+def load_port_stats() -> Dict[str, Dict[str, int]]:
+    if os.path.exists(PORT_STATS_FILE):
+        try:
+            with open(PORT_STATS_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"无法加载端口统计: {e}")
+    return {}
+
+def save_port_stats(stats: Dict[str, Dict[str, int]]):
+    try:
+        with open(PORT_STATS_FILE, 'w', encoding='utf-8') as f:
+            json.dump(stats, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        logger.warning(f"无法保存端口统计: {e}")
+
+def rank_ports(ports: List[int], stats: Dict[str, Dict[str, int]]) -> List[int]:
+    """按历史命中率（加一平滑，没有记录的端口为 50%）从高到低排列端口，命中率相同时保持配置顺序"""
+    def hit_rate(port: int) -> float:
+        record = stats.get(str(port), {})
+        return (record.get("hits", 0) + 1) / (record.get("probes", 0) + 2)
+    return sorted(dict.fromkeys(ports), key=hit_rate, reverse=True)
+
+async def discover_ports_native(ips: List[str], ports: List[int], use_tls: bool, concurrency: int,
+                                max_hits: int) -> Tuple[Dict[str, List[int]], Dict[int, List[int]]]:
+    """按端口顺序探测每个 IP，找到 max_hits 个可用端口后不再探测该 IP 的其余端口（0 表示探测全部端口）
+
+    所有 IP 共用一个并发名额池；信号量按先来先得放行，排在前面的端口会先在所有 IP 上探测完。
+    返回 ({IP: [可用端口]}, {端口: [探测次数, 命中次数]})。
+    """
+    ssl_context = make_probe_ssl_context() if use_tls else None
+    timeout = probe_settings["timeout"]
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    found = {}
+    tallies = {port: [0, 0] for port in ports}
+
+    async def run_one(ip: str):
+        hits = []
+        for port in ports:
+            if max_hits and len(hits) >= max_hits:
+                break
+            async with semaphore:
+                if time_left() <= 0:
+                    break
+                result = await probe_node(ip, port, use_tls, timeout, ssl_context)
+            tallies[port][0] += 1
+            if result["outcome"] == "ok":
+                tallies[port][1] += 1
+                hits.append(port)
+        if hits:
+            found[ip] = hits
+
+    await asyncio.gather(*(run_one(ip) for ip in ips))
+    return found, tallies
+
+def discover_ports(bare_ips: List[Tuple[str, str]]) -> List[Tuple[str, int, str]]:
+    """端口发现：对没有端口的 IP 按历史命中率顺序探测端口列表，返回发现的 (IP, 端口, 国家)
+
+    只探测国家属于 DESIRED_COUNTRIES 的 IP（国家缺失时先查询 GeoIP），探测方式与内置引擎相同：
+    按测速脚本的 -tls 参数建立连接并请求 /cdn-cgi/trace，返回 colo 的端口视为可用。
+    各端口的探测和命中次数累计到 port_stats.json，供下次运行排序。
+    """
+    start_time = time.time()
+    countries = {}
+    for ip, country in bare_ips:
+        countries.setdefault(ip, country)  # 同一 IP 出现多次时保留第一条的国家
+    unknown = [ip for ip, country in countries.items() if not country or country not in COUNTRY_LABELS]
+    if unknown:
+        country_cache = load_country_cache()
+        countries.update(zip(unknown, get_countries_from_ips(unknown, country_cache)))
+        save_country_cache(country_cache)
+    # 按数据中心判断国家时，注册国家不在目标国家中的 IP 也可能落在目标数据中心，全部探测
+    ips = [ip for ip, country in countries.items()
+           if colo_settings["enabled"] or not DESIRED_COUNTRIES or country in DESIRED_COUNTRIES]
+    if not ips:
+        logger.info(f"端口发现: {len(countries)} 个没有端口的 IP 都不在目标国家中，跳过")
+        return []
+
+    stats = load_port_stats()
+    ports = rank_ports(discovery_settings["ports"], stats)
+    script_args = parse_iptest_args(SPEEDTEST_SCRIPT) if SPEEDTEST_SCRIPT else {}
+    use_tls = script_args.get("tls", "true").lower() != "false"
+    logger.info(f"端口发现: {len(ips)}/{len(countries)} 个 IP 属于目标国家，端口顺序 {ports}，"
+                f"并发 {discovery_settings['concurrency']}，每个 IP 最多保留 {discovery_settings['max_hits'] or '全部'} 个端口")
+    found, tallies = asyncio.run(discover_ports_native(ips, ports, use_tls, discovery_settings["concurrency"],
+                                                       discovery_settings["max_hits"]))
+    if time_left() <= 0:
+        deadline_cutoff("port_discovery", "端口发现提前结束，部分 IP 的端口未探测")
+
+    for port, (probes, hits) in tallies.items():
+        record = stats.setdefault(str(port), {"probes": 0, "hits": 0})
+        record["probes"] += probes
+        record["hits"] += hits
+        metric_inc("port_discovery_probes_total", probes, port=str(port))
+        metric_inc("port_discovery_hits_total", hits, port=str(port))
+    save_port_stats(stats)
+
+    discovered = [(ip, port, countries[ip]) for ip in ips for port in found.get(ip, [])]
+    probes = sum(probes for probes, _ in tallies.values())
+    hit_rates = {port: f"{hits}/{probes}" for port, (probes, hits) in tallies.items() if probes}
+    logger.info(f"端口发现完成: {len(found)}/{len(ips)} 个 IP 找到可用端口，共 {len(discovered)} 个节点，"
+                f"探测 {probes} 次，各端口命中: {hit_rates} (耗时: {time.time() - start_time:.2f} 秒)")
+    return discovered
+
+def load_colo_cache() -> Dict[str, List]:
+    """加载数据中心缓存 {"IP 端口": [colo, 时间戳]}，colo 为空表示上次 trace 失败"""
+    if os.path.exists(COLO_CACHE_FILE):
+        try:
+            with open(COLO_CACHE_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"无法加载数据中心缓存: {e}")
+    return {}
+
+def save_colo_cache(cache: Dict[str, List]):
+    # 顺便清理过期条目，避免缓存随输入变化无限增长
+    expire_before = time.time() - colo_settings["ttl"]
+    try:
+        with open(COLO_CACHE_FILE, 'w', encoding='utf-8') as f:
+            json.dump({node: entry for node, entry in cache.items() if entry[1] >= expire_before}, f, separators=(",", ":"))
+    except Exception as e:
+        logger.warning(f"无法保存数据中心缓存: {e}")
+
+async def trace_nodes_native(nodes: List[Tuple[str, int]], use_tls: bool, concurrency: int) -> Dict[str, str]:
+    """并发经由每个节点请求 /cdn-cgi/trace，返回 {"IP 端口": colo}，失败的节点 colo 为空；超出时间预算后未 trace 的节点不在结果中"""
+    ssl_context = make_probe_ssl_context() if use_tls else None
+    timeout = probe_settings["timeout"]
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run_one(ip: str, port: int):
+        async with semaphore:
+            if time_left() <= 0:
+                return f"{ip} {port}", None
+            result = await probe_node(ip, port, use_tls, timeout, ssl_context)
+        return f"{ip} {port}", result["colo"] if result["outcome"] == "ok" else ""
+
+    traced = await asyncio.gather(*(run_one(ip, port) for ip, port in nodes))
+    return {node: colo for node, colo in traced if colo is not None}
+
+def resolve_colo_countries(nodes: List[Tuple[str, int]], cache: Dict[str, List]) -> Dict[str, str]:
+    """返回 {"IP 端口": 数据中心所在国家}，只包含 trace 成功且数据中心在 IATA_TO_COUNTRY 中的节点
+
+    缓存未过期（--colo-cache-ttl）的节点直接使用缓存，其余节点并发 trace 后写入缓存；
+    trace 失败也会缓存，TTL 内这些节点不再重试，由调用方改用数据源或 GeoIP 的国家。
+    """
+    now = time.time()
+    expire_before = now - colo_settings["ttl"]
+    pending = list(dict.fromkeys((ip, port) for ip, port in nodes
+                                 if cache.get(f"{ip} {port}", ("", 0))[1] < expire_before))
+    if pending:
+        start_time = time.time()
+        script_args = parse_iptest_args(SPEEDTEST_SCRIPT) if SPEEDTEST_SCRIPT else {}
+        use_tls = script_args.get("tls", "true").lower() != "false"
+        logger.info(f"数据中心 trace: {len(nodes) - len(pending)} 个节点使用缓存，探测 {len(pending)} 个节点"
+                    f"（并发 {colo_settings['concurrency']}）")
+        colos = asyncio.run(trace_nodes_native(pending, use_tls, colo_settings["concurrency"]))
+        for node, colo in colos.items():
+            cache[node] = [colo, now]
+        traced = sum(1 for colo in colos.values() if colo)
+        metric_inc("colo_traces_total", len(colos))
+        metric_inc("colo_trace_failures_total", len(colos) - traced)
+        if len(colos) < len(pending):
+            deadline_cutoff("geo_filter", f"{len(pending) - len(colos)} 个节点未 trace，改用数据源或 GeoIP 的国家")
+        logger.info(f"数据中心 trace 完成: {traced}/{len(colos)} 个节点返回 colo (耗时: {time.time() - start_time:.2f} 秒)")
+    metric_inc("colo_cache_hits_total", len(nodes) - len(pending))
+    countries = {}
+    for ip, port in nodes:
+        colo = cache.get(f"{ip} {port}", ("", 0))[0]
+        if colo in IATA_TO_COUNTRY:
+            countries[f"{ip} {port}"] = IATA_TO_COUNTRY[colo]
+    return countries
+
+def record_result_colos(csv_file: str) -> int:
+    """把测速结果中各节点的数据中心写入数据中心缓存，下次运行这些节点不需要重新 trace，返回记录的节点数"""
+    cache = load_colo_cache()
+    now = time.time()
+    count = 0
     try:
         with open(csv_file, "r", encoding="utf-8") as f:
             reader = csv.reader(f)
-            next(reader)
+            next(reader, None)
             for row in reader:
-                if len(row) < 2:
-                    continue
-                ip, port = row[0], row[1]
-                if not is_valid_ip(ip) or not is_valid_port(port):
-                    continue
-                country = country_cache.get(ip, '')
-                if not country:
-                    country = get_country_from_ip(ip, country_cache)
-                if DESIRED_COUNTRIES and country and country in DESIRED_COUNTRIES:
-                    final_nodes.append((ip, int(port), country))
+                ip = normalize_ip(row[0]) if row else None
+                if ip and len(row) > 3 and row[1].isdigit() and row[3].strip():
+                    cache[f"{ip} {row[1]}"] = [row[3].strip().upper(), now]
+                    count += 1
+    except Exception as e:
+        logger.warning(f"无法从 {csv_file} 读取数据中心: {e}")
+        return 0
+    save_colo_cache(cache)
+    return count
+
+def write_probe_results(results: List[Dict], output_csv: str, use_tls: bool, speed_limit: float = None) -> int:
+    """将有效节点按 iptest 的列格式写入 CSV，返回写出的行数
+
+    speed_limit 为 None 表示未做下载测速，按延迟升序写出且速度列留空；
+    否则与 iptest 一致，只写出速度不低于 speed_limit 的节点，按速度降序、延迟升序排列。
+    """
+    valid = [r for r in results if r["outcome"] == "ok"]
+    if speed_limit is None:
+        valid.sort(key=lambda r: r["latency_ms"])
+    else:
+        valid = sorted((r for r in valid if r.get("mbps", 0.0) >= speed_limit and r.get("mbps", 0.0) > 0),
+                       key=lambda r: (-r["mbps"], r["latency_ms"]))
+    temp_file = output_csv + ".tmp"
+    with open(temp_file, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(RESULT_HEADER)
+        for r in valid:
+            country = IATA_TO_COUNTRY.get(r["colo"], "")
+            writer.writerow([r["ip"], r["port"], str(use_tls).lower(), r["colo"], "", country,
+                             COUNTRY_LABELS.get(country, ("", ""))[1], "", f"{round(r['latency_ms'])} ms",
+                             f"{r['mbps']:.2f}" if speed_limit is not None else ""])
+    os.replace(temp_file, output_csv)
+    return len(valid)
+
+def run_native_speed_test(ip_lines: List[str], resumed: List[Dict] = None, output_csv: str = FINAL_CSV) -> bool:
+    """用内置探测引擎测试 ip.txt 中的节点，结果写入 output_csv（默认 ip.csv）
+
+    TLS、下载地址、下载并发和速度下限分别沿用测速脚本中的 -tls、-url、-speedtest、-speedlimit 参数；
+    -speedtest=0 时只测延迟，下载速度列留空。resumed 为从检查点恢复的测速结果，不再测试，直接并入 ip.csv。
+    """
+    pools = defaultdict(list)
+    for line in ip_lines:
+        parts = line.split()
+        ip = normalize_ip(parts[0]) if parts else ''
+        if ip and len(parts) >= 2 and is_valid_port(parts[1]):
+            pools[ip_family(ip)].append((ip, int(parts[1])))
+    script_args = parse_iptest_args(SPEEDTEST_SCRIPT) if SPEEDTEST_SCRIPT else {}
+    use_tls = script_args.get("tls", "true").lower() != "false"
+    controllers = {
+        family: AIMDController(initial=probe_settings["initial"], minimum=probe_settings["min"],
+                               maximum=probe_settings["max"], cooldown=probe_settings["timeout"], name=f"ipv{family}")
+        for family in pools
+    }
+    pool_sizes = "，".join(f"IPv{family} {len(nodes)} 个" for family, nodes in sorted(pools.items()))
+    logger.info(f"内置探测引擎: {pool_sizes}，TLS: {use_tls}，超时 {probe_settings['timeout']} 秒，"
+                f"每个地址族初始并发 {probe_settings['initial']}（范围 {probe_settings['min']}-{probe_settings['max']}）")
+    speedtest_arg = script_args.get("speedtest", "5")
+    download_concurrency = int(speedtest_arg) if speedtest_arg.isdigit() else 5
+    download_url = script_args.get("url", f"{PROBE_HOST}/__down?bytes=50000000")
+    # 下载地址与 trace 使用同一个 Host/SNI 时，有效节点的 trace 连接留给下载测速复用；
+    # 连接绑定在事件循环上，因此探测和下载共用一个事件循环
+    if active_checkpoint is not None:
+        active_checkpoint.downloads = download_concurrency > 0
+    warm_pool = None
+    if download_concurrency > 0 and probe_settings["warm_pool_size"] > 0 and parse_download_url(download_url)[0] == PROBE_HOST:
+        # 只保留空闲超时前能轮到下载的连接数：每个下载位在 idle 秒内最多完成 idle / download_max_seconds 个节点
+        reachable = math.ceil(download_concurrency * probe_settings["warm_pool_idle"] / max(probe_settings["download_max_seconds"], 1e-6))
+        capacity = min(probe_settings["warm_pool_size"], max(download_concurrency, reachable))
+        warm_pool = WarmConnectionPool(capacity, probe_settings["warm_pool_idle"])
+        logger.info(f"连接池: 保留延迟最低的 {capacity} 个有效节点的连接（上限 {probe_settings['warm_pool_size']}）")
+    loop = asyncio.new_event_loop()
+    try:
+        start_time = time.time()
+        # 设置了 --deadline 时延迟探测只用测速阶段的一部分时间，其余留给下载测速
+        with deadline_share(DEADLINE_PROBE_SHARE if download_concurrency > 0 else 1.0):
+            if probe_settings["search"] == "subnet":
+                results = loop.run_until_complete(search_subnets_native(
+                    [node for nodes in pools.values() for node in nodes], use_tls, controllers, warm_pool))
+            else:
+                results = loop.run_until_complete(probe_pools_native(pools, use_tls, controllers, warm_pool))
+        elapsed = max(time.time() - start_time, 1e-6)
+        return _finish_native_speed_test(loop, results, elapsed, controllers, script_args, use_tls,
+                                         download_concurrency, download_url, warm_pool, resumed or [], output_csv)
+    finally:
+        if warm_pool is not None:
+            warm_pool.close_all()
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+def _finish_native_speed_test(loop: asyncio.AbstractEventLoop, results: List[Dict], elapsed: float,
+                              controllers: Dict[int, AIMDController], script_args: Dict[str, str], use_tls: bool,
+                              download_concurrency: int, download_url: str, warm_pool: WarmConnectionPool,
+                              resumed: List[Dict], output_csv: str = FINAL_CSV) -> bool:
+    """汇总探测结果，在同一个事件循环中对有效节点做下载测速，与从检查点恢复的结果一起写出 ip.csv"""
+    outcomes = defaultdict(int)
+    for result in results:
+        outcomes[result["outcome"]] += 1
+    metric_inc("probe_results_total", outcomes["ok"])
+    metric_inc("probe_timeouts_total", outcomes["timeout"])
+    logger.info(f"探测完成: {dict(outcomes)}，耗时 {elapsed:.2f} 秒，平均 {len(results) / elapsed:.1f} 个/秒")
+    for controller in controllers.values():
+        metric_set("probe_concurrency_peak", controller.peak, pool=controller.name)
+        logger.info(f"[{controller.name}] 并发峰值 {controller.peak:.0f}，上调 {controller.increases} 次，下调 {controller.decreases} 次")
+
+    candidates = [r for r in results if r["outcome"] == "ok"]
+    if download_concurrency <= 0 or not (candidates or resumed):
+        return write_probe_results(results + resumed, output_csv, use_tls) > 0
+
+    speed_limit = parse_speedlimit_from_script(SPEEDTEST_SCRIPT) if SPEEDTEST_SCRIPT else 0.0
+    full_bytes = parse_download_bytes_from_script(SPEEDTEST_SCRIPT) if SPEEDTEST_SCRIPT else 0
+    logger.info(f"下载测速: {len(candidates)} 个节点，并发 {download_concurrency}，速度下限 {speed_limit} MB/s，"
+                f"置信区间 ±{probe_settings['download_confidence']:.0%}，单节点最长 {probe_settings['download_max_seconds']} 秒")
+    start_time = time.time()
+    loop.run_until_complete(measure_downloads(candidates, use_tls, download_url, speed_limit, download_concurrency, warm_pool))
+    spent = sum(r.get("download_bytes", 0) for r in candidates)
+    reasons = defaultdict(int)
+    for r in candidates:
+        reasons[r.get("stop_reason", "error")] += 1
+    saving = f"，按完整下载需 {full_bytes * len(candidates) / 1024 / 1024:.0f} MB" if full_bytes else ""
+    logger.info(f"下载测速完成: 耗时 {time.time() - start_time:.2f} 秒，共消耗 {spent / 1024 / 1024:.1f} MB{saving}，"
+                f"结束原因: {dict(reasons)}")
+    if warm_pool is not None:
+        reused = sum(1 for r in candidates if r.get("reused"))
+        saved = sum(r.get("handshake_saved", 0.0) for r in candidates)
+        metric_set("download_reuse_ratio", reused / len(candidates) if candidates else 0.0)
+        logger.info(f"连接复用: {reused}/{len(candidates)} 个节点复用了延迟探测的连接，省去握手共 {saved:.2f} 秒，"
+                    f"连接池淘汰 {warm_pool.evicted} 个空闲连接")
+    return write_probe_results(results + resumed, output_csv, use_tls, speed_limit) > 0
+
+def parse_score_weights(text: str) -> Dict[str, float]:
+    """解析 --score-weights（如 median=1,p90=0.5,jitter=1,loss=1000,speed=-10），未给出的项沿用默认权重"""
+    weights = dict(SCORE_WEIGHTS)
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        name, sep, value = item.partition("=")
+        if not sep or name.strip() not in SCORE_WEIGHTS:
+            raise ValueError(f"无效的评分权重: {item}（可用项: {', '.join(SCORE_WEIGHTS)}）")
+        weights[name.strip()] = float(value)
+    return weights
+
+def latency_stats(samples: List[float]) -> Dict[str, float]:
+    """由多次延迟采样（丢失的采样为 None）计算最低、中位数、P90、抖动（相邻成功采样差值的平均）和丢包率"""
+    received = [s for s in samples if s is not None]
+    stats = {"loss": (len(samples) - len(received)) / len(samples) if samples else 1.0}
+    if not received:
+        return stats
+    ordered = sorted(received)
+    stats["min"] = ordered[0]
+    stats["median"] = statistics.median(ordered)
+    stats["p90"] = ordered[max(math.ceil(0.9 * len(ordered)) - 1, 0)]
+    stats["jitter"] = statistics.fmean(abs(b - a) for a, b in zip(received, received[1:])) if len(received) > 1 else 0.0
+    return stats
+
+def latency_score(stats: Dict[str, float], speed: float, weights: Dict[str, float]) -> float:
+    """综合得分（毫秒当量，越低越好）：中位数、P90 与中位数之差、抖动、丢包率和下载速度的加权和，全部丢包时为无穷大"""
+    if "median" not in stats:
+        return float('inf')
+    return (weights["median"] * stats["median"] + weights["p90"] * (stats["p90"] - stats["median"])
+            + weights["jitter"] * stats["jitter"] + weights["loss"] * stats["loss"] + weights["speed"] * speed)
+
+async def sample_node_latency(ip: str, port: int, use_tls: bool, samples: int, interval: float,
+                              ssl_context: ssl.SSLContext = None) -> List[float]:
+    """对单个节点按固定间隔采样 samples 次延迟（每次新建连接），丢失的采样记为 None"""
+    loop = asyncio.get_running_loop()
+    results = []
+    for i in range(samples):
+        started = loop.time()
+        result = await probe_node(ip, port, use_tls, probe_settings["timeout"], ssl_context)
+        results.append(result["latency_ms"])
+        if i + 1 < samples:
+            await asyncio.sleep(max(0.0, interval - (loop.time() - started)))
+    return results
+
+async def sample_latencies(nodes: List[Tuple[str, int]], use_tls: bool, samples: int, interval: float) -> List[List[float]]:
+    """并发采样多个节点的延迟，返回与 nodes 顺序一致的采样列表"""
+    ssl_context = make_probe_ssl_context() if use_tls else None
+    semaphore = asyncio.Semaphore(LATENCY_SAMPLE_CONCURRENCY)
+
+    async def run_one(ip: str, port: int) -> List[float]:
+        async with semaphore:
+            return await sample_node_latency(ip, port, use_tls, samples, interval, ssl_context)
+
+    return await asyncio.gather(*(run_one(ip, port) for ip, port in nodes))
+
+def apply_latency_samples(csv_file: str) -> int:
+    """对测速结果中的节点做多次延迟采样，在第 10 列之后追加延迟统计和综合得分列，并按综合得分升序重排
+
+    延迟采样使用内置探测引擎（TLS 开关沿用测速脚本的 -tls 参数），对 iptest、内置引擎和分布式测速的结果都适用；
+    重复运行时覆盖已有的统计列。返回写出的行数。
+    """
+    samples = probe_settings["latency_samples"]
+    weights = probe_settings["score_weights"]
+    try:
+        with open(csv_file, "r", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            rows = [row for row in reader if len(row) > 1 and row[0].strip()]
     except Exception as e:
         logger.error(f"无法读取 {csv_file}: {e}")
-        return
-    if not final_nodes:
-        logger.info(f"没有符合条件的节点（DESIRED_COUNTRIES: {DESIRED_COUNTRIES}）")
-        return
-    country_count = defaultdict(int)
-    labeled_nodes = []
-    for ip, port, country in sorted(final_nodes, key=lambda x: x[2] or 'ZZ'):
-        country_count[country] += 1
-        emoji, name = COUNTRY_LABELS.get(country, ('🌐', '未知'))
-        label = f"{emoji} {name}-{country_count[country]}"
-        labeled_nodes.append((ip, port, label))
+        return 0
+    if not header or not rows:
+        return 0
+    base_columns = len(RESULT_HEADER)
+    header = header[:base_columns] + LATENCY_STATS_HEADER
+    needed = (math.ceil(len(rows) / LATENCY_SAMPLE_CONCURRENCY) * samples * probe_settings["latency_interval"]
+              + probe_settings["timeout"])
+    if needed > time_left():
+        deadline_cutoff("latency_samples", f"延迟采样预计需要 {needed:.0f} 秒，剩余 {max(time_left(), 0):.0f} 秒，跳过")
+        return 0
+    nodes = [(row[0], int(row[1]) if is_valid_port(row[1]) else 0) for row in rows]
+    script_args = parse_iptest_args(SPEEDTEST_SCRIPT) if SPEEDTEST_SCRIPT else {}
+    use_tls = script_args.get("tls", "true").lower() != "false"
+    logger.info(f"延迟采样: {len(rows)} 个节点，每个节点 {samples} 次，间隔 {probe_settings['latency_interval']} 秒")
+    start_time = time.time()
+    sampled = asyncio.run(sample_latencies(nodes, use_tls, samples, probe_settings["latency_interval"]))
+
+    scored = []
+    lossless = 0
+    for row, node_samples in zip(rows, sampled):
+        stats = latency_stats(node_samples)
+        speed = parse_speed(row[9]) if len(row) > 9 else 0.0
+        score = latency_score(stats, speed, weights)
+        lost = sum(1 for s in node_samples if s is None)
+        lossless += lost == 0
+        metric_inc("latency_samples_total", len(node_samples))
+        metric_inc("latency_samples_lost_total", lost)
+        if "jitter" in stats:
+            metric_observe("latency_jitter_seconds", stats["jitter"] / 1000)
+        row = (row + [""] * base_columns)[:base_columns] + [
+            f"{stats[key]:.1f}" if key in stats else "" for key in ("min", "median", "p90", "jitter")
+        ] + [f"{stats['loss']:.2f}", f"{score:.1f}" if score != float('inf') else ""]
+        scored.append((score, row))
+    scored.sort(key=lambda item: item[0])
+
+    temp_file = csv_file + ".tmp"
+    with open(temp_file, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(row for _, row in scored)
+    os.replace(temp_file, csv_file)
+    logger.info(f"延迟采样完成: 耗时 {time.time() - start_time:.2f} 秒，无丢包节点 {lossless}/{len(scored)}，已按综合得分重排 {csv_file}")
+    return len(scored)
+
+def run_speed_test(shards: int = 1, serialize_download: bool = False) -> str:
+    global active_checkpoint
+    native = probe_settings["engine"] == "native"
+    if not SPEEDTEST_SCRIPT and not native:
+        logger.info("未找到测速脚本")
+        return None
 
-    with open(IPS_FILE, "w", encoding="utf-8-sig") as f:
-        for ip, port, label in labeled_nodes:
-            f.write(f"{ip}:{port}#{label}\n")
-    logger.info(f"已生成 {IPS_FILE}")
+    if not os.path.exists(IP_LIST_FILE):
+        logger.error(f"{IP_LIST_FILE} 不存在，请确保 write_ip_list 已正确生成文件")
+        return None
 
-    logger.info(f"生成 {IPS_FILE}，{len(labeled_nodes)} 个数据节点 (耗时: {time.time() - start_time:.2f} 秒)")
-    logger.info(f"国家分布: {dict(country_count)}")
-    save_country_cache(country_cache)
-    return len(labeled_nodes)
+    start_time = time.time()
+    iptest_latencies.clear()
+    try:
+        with open(IP_LIST_FILE, "r", encoding="utf-8") as f:
+            ip_lines = [line.strip() for line in f if line.strip()]
+        total_nodes = len(ip_lines)
+        logger.info(f"{IP_LIST_FILE} 包含 {total_nodes} 个节点")
+    except Exception as e:
+        logger.error(f"无法读取 {IP_LIST_FILE}: {e}")
+        return None
+
+    # --resume：跳过检查点中已测过的节点，测速结束后并入它们的结果
+    engine = "native" if native else "iptest"
+    resumed = {}
+    if checkpoint_settings["file"] and checkpoint_settings["resume"]:
+        nodes = {" ".join(line.split()[:2]) for line in ip_lines}
+        records = load_checkpoint(checkpoint_settings["file"], engine, checkpoint_settings["max_age"])
+        resumed = {node: record for node, record in records.items() if node in nodes and record.get("outcome") != "latency"}
+        # 被杀的 iptest 进程只留下延迟级别的记录，缺少数据中心和下载速度，这些节点仍需重测，但排到最前面优先测试
+        alive = {node for node, record in records.items() if node in nodes and record.get("outcome") == "latency"}
+        if resumed or alive:
+            ip_lines = sorted((line for line in ip_lines if " ".join(line.split()[:2]) not in resumed),
+                              key=lambda line: " ".join(line.split()[:2]) not in alive)
+            total_nodes = len(ip_lines)
+            metric_inc("checkpoint_resumed_total", len(resumed))
+            logger.info(f"从检查点 {checkpoint_settings['file']} 恢复 {len(resumed)} 个节点的结果，"
+                        f"剩余 {total_nodes} 个节点需要测速（其中 {len(alive)} 个上次已发现有效、优先重测）")
+            if not native:
+                with open(IP_LIST_FILE, "w", encoding="utf-8") as f:
+                    f.writelines(f"{line}\n" for line in ip_lines)
+    metric_inc("probe_nodes_total", total_nodes)
+
+    # 设置了 --deadline 时按上次的吞吐估算 iptest 能测完的节点数（内置引擎到时自行停止）
+    if not native and deadline_settings["iptest_rate"] > 0 and time_left() != float('inf'):
+        capacity = max(int(deadline_settings["iptest_rate"] * max(time_left(), 0.0) * DEADLINE_IPTEST_MARGIN), 1)
+        if capacity < total_nodes:
+            deadline_cutoff("speed_test", f"按上次的吞吐 {deadline_settings['iptest_rate']:.1f} 个/秒估算，"
+                                          f"只测试 {IP_LIST_FILE} 前 {capacity}/{total_nodes} 个节点")
+            ip_lines = ip_lines[:capacity]
+            total_nodes = capacity
+            with open(IP_LIST_FILE, "w", encoding="utf-8") as f:
+                f.writelines(f"{line}\n" for line in ip_lines)
+
+    # 解析 speedlimit 参数
+    speed_limit = parse_speedlimit_from_script(SPEEDTEST_SCRIPT) if SPEEDTEST_SCRIPT else 8.0
+    
+    logger.info("开始测速")
+    is_termux_env = is_termux()
+    if checkpoint_settings["file"]:
+        try:
+            active_checkpoint = CheckpointLog(checkpoint_settings["file"], engine, append=checkpoint_settings["resume"])
+        except OSError as e:
+            logger.warning(f"无法写入检查点 {checkpoint_settings['file']}: {e}")
+    try:
+        if native:
+            success = run_native_speed_test(ip_lines, list(resumed.values()))
+        elif not ip_lines and resumed:
+            success = False  # 全部节点都已在检查点中，下面直接合并
+        elif shards > 1:
+            success = run_sharded_speed_test(ip_lines, shards, serialize_download)
+        else:
+            return_code = run_iptest_process(build_speedtest_command(SPEEDTEST_SCRIPT), total_nodes)
+            success = return_code == 0
+            if success:
+                checkpoint_iptest_output(IP_LIST_FILE, FINAL_CSV)
+            else:
+                logger.error(f"测速失败，返回码: {return_code}")
+        if resumed and not native:
+            success = merge_checkpoint_rows(list(resumed.values()), FINAL_CSV, include_existing=success) > 0
+
+        logger.info(f"测速完成，耗时: {time.time() - start_time:.2f} 秒")
+        if not success:
+            return None
+        if not os.path.exists(FINAL_CSV) or os.path.getsize(FINAL_CSV) < 10:
+            logger.error(f"{FINAL_CSV} 未生成或内容无效")
+            return None
+        
+        # 统计 ip.csv 的速度分布
+        try:
+            with open(FINAL_CSV, "r", encoding="utf-8") as f:
+                reader = csv.reader(f)
+                header = next(reader, None)
+                speeds = []
+                result_count = 0
+                speed_col = 9  # 第 10 列是“下载速度MB/s”
+                for row in reader:
+                    if row and row[0].strip():
+                        result_count += 1
+                    if len(row) > speed_col and row[speed_col].strip():
+                        try:
+                            speeds.append(float(row[speed_col]))
+                        except ValueError:
+                            continue
+                # iptest 不区分超时和连接失败，未出现在结果中的节点统一计为超时；内置引擎已自行统计
+                # iptest 不报告实际下载字节数，download_bytes_total 只由内置引擎按实测值累计
+                if not native:
+                    metric_inc("probe_results_total", result_count)
+                    metric_inc("probe_timeouts_total", max(total_nodes - result_count, 0))
+                for speed in speeds:
+                    metric_observe("download_speed_mbps", speed, buckets=SPEED_BUCKETS_MBPS)
+                if speeds:
+                    logger.info(f"ip.csv 速度统计: 平均={sum(speeds)/len(speeds):.2f} MB/s, "
+                               f"最小={min(speeds):.2f} MB/s, 最大={max(speeds):.2f} MB/s, "
+                               f"节点数={len(speeds)}")
+        except Exception as e:
+            logger.warning(f"无法统计 ip.csv 速度分布: {e}")
+
+        # 在 Termux 环境中，强制过滤低速节点
+        if is_termux_env:
+            logger.info(f"检测到 Termux 环境，应用速度下限过滤 (speedlimit={speed_limit} MB/s)")
+            filter_ip_csv_by_speed(FINAL_CSV, speed_limit=speed_limit)  # 使用动态 speed_limit
+
+        with open(FINAL_CSV, "r", encoding="utf-8") as f:
+            lines = [line.strip() for line in f if line.strip()]
+            node_count = len(lines) - 1 if lines else 0
+            logger.info(f"{FINAL_CSV} 包含 {node_count} 个节点")
+        return FINAL_CSV
+    except Exception as e:
+        logger.error(f"测速异常: {e}")
+        return None
+    finally:
+        if active_checkpoint is not None:
+            logger.info(f"检查点 {active_checkpoint.path}: 本次写入 {active_checkpoint.count} 条记录")
+            active_checkpoint.close()
+            active_checkpoint = None
 
 def validate_username(username: str) -> bool:
     """验证 Git 用户名格式"""
@@ -1638,6 +4487,10 @@ def commit_and_push(is_github_actions: bool = False):
 
         # 添加文件
         files_to_commit = [IPS_FILE, FINAL_CSV]
+        if delta_settings["file"]:
+            files_to_commit += [delta_settings["file"], DELTA_SNAPSHOT_FILE]
+        if columnar_settings["file"]:
+            files_to_commit.append(columnar_settings["file"])
         for file in files_to_commit:
             if os.path.exists(file):
                 subprocess.run(["git", "add", file], check=True)
@@ -1672,6 +4525,62 @@ def commit_and_push(is_github_actions: bool = False):
         logger.error(f"提交和推送过程中发生未知错误: {e}")
         sys.exit(1)
 
+def update_negative_cache(csv_file: str, probed_only: bool) -> int:
+    """根据本次测速结果更新负缓存，返回隔离中的节点数
+
+    出现在测速结果或探测有效记录中的节点清除失败记录，ip.txt 中的其余节点连续失败次数加一，
+    达到阈值后按 quarantine_seconds 隔离。probed_only 为 True（内置引擎）时只处理实际探测过的节点，
+    子网搜索跳过的节点不计为失败。没有任何有效节点时视为网络故障，不更新缓存。
+    """
+    alive = {key for key, ok in probe_outcomes.items() if ok}
+    try:
+        with open(csv_file, "r", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                if len(row) >= 2 and row[1].strip().isdigit() and ip_key(row[0]) >= 0:
+                    alive.add((ip_key(row[0]) << 16) | int(row[1]))
+        with open(IP_LIST_FILE, "r", encoding="utf-8") as f:
+            nodes = [line.split() for line in f if line.strip()]
+    except Exception as e:
+        logger.warning(f"无法更新负缓存: {e}")
+        return 0
+    if not alive:
+        logger.warning("本次测速没有任何有效节点，可能是网络故障，不更新负缓存")
+        return 0
+
+    cache = load_negative_cache()
+    rng = random.Random()
+    now = time.time()
+    recovered = failed = 0
+    for parts in nodes:
+        if len(parts) < 2 or not parts[1].isdigit():
+            continue
+        node_key = (ip_key(parts[0]) << 16) | int(parts[1])
+        if probed_only and node_key not in probe_outcomes:
+            continue
+        node = f"{parts[0]} {parts[1]}"
+        if node_key in alive:
+            recovered += cache.pop(node, None) is not None
+            continue
+        record = cache.setdefault(node, {"failures": 0, "until": 0})
+        record["failures"] += 1
+        record["last"] = now
+        record["until"] = now + quarantine_seconds(record["failures"], rng)
+        failed += 1
+    # 长期没有再出现在输入中的节点不再保留记录
+    stale = [node for node, record in cache.items() if record.get("last", 0) < now - 2 * negative_cache_settings["max"]]
+    for node in stale:
+        del cache[node]
+    save_negative_cache(cache)
+
+    quarantined = sum(1 for record in cache.values() if record.get("until", 0) > now)
+    metric_set("negative_cache_entries", len(cache))
+    metric_set("negative_cache_quarantined", quarantined)
+    logger.info(f"负缓存: 本次失败 {failed} 个节点，恢复 {recovered} 个，清理过期记录 {len(stale)} 条，"
+                f"共 {len(cache)} 条记录，其中 {quarantined} 个节点处于隔离期")
+    return quarantined
+
 def filter_speed_and_deduplicate(csv_file: str, is_github_actions: bool):
     start_time = time.time()
     if not os.path.exists(csv_file):
@@ -1689,7 +4598,7 @@ def filter_speed_and_deduplicate(csv_file: str, is_github_actions: bool):
             for row in reader:
                 if len(row) < 2 or not row[0].strip():
                     continue
-                key = (row[0], row[1])
+                key = (ip_key(row[0]), row[1])
                 if key not in seen:
                     seen.add(key)
                     final_rows.append(row)
@@ -1701,7 +4610,12 @@ def filter_speed_and_deduplicate(csv_file: str, is_github_actions: bool):
         os.remove(csv_file)
         return
     try:
-        final_rows.sort(key=lambda x: float(x[9]) if len(x) > 9 and x[9] and x[9].replace('.', '', 1).isdigit() else 0.0, reverse=True)
+        if LATENCY_STATS_HEADER[-1] in header:
+            # 多次延迟采样后按综合得分升序排列，没有得分（全部丢包）的节点排在最后
+            score_col = header.index(LATENCY_STATS_HEADER[-1])
+            final_rows.sort(key=lambda x: score_sort_key(x, score_col))
+        else:
+            final_rows.sort(key=result_sort_key)
     except Exception as e:
         logger.warning(f"排序失败: {e}")
 
@@ -1710,49 +4624,101 @@ def filter_speed_and_deduplicate(csv_file: str, is_github_actions: bool):
         writer.writerow(header)
         writer.writerows(final_rows)
     logger.info(f"已生成 {csv_file}")
+    if columnar_settings["file"]:
+        write_columnar_results(final_rows, columnar_settings["file"])
 
     logger.info(f"{csv_file} 处理完成，{len(final_rows)} 个数据节点 (耗时: {time.time() - start_time:.2f} 秒)")
     return len(final_rows)
 
-def generate_ips_file(csv_file: str, is_github_actions: bool):
+def write_columnar_results(rows: List[List[str]], path: str) -> int:
+    """把最终测速结果按列写成二进制文件（格式和读取接口见 ipcol.py），返回写出的行数
+
+    延迟存为整数毫秒、速度存为 float32、IP 存为 16 字节、国家和数据中心存为枚举下标，
+    下游工具用 ipcol.ColumnarResults 以 mmap 打开，不需要再解析 CSV 的表头、BOM 和 “58 ms” 这样的字符串。
+    """
+    latency_col, speed_col = RESULT_HEADER.index('网络延迟'), RESULT_HEADER.index('下载速度MB/s')
+    results = []
+    for row in rows:
+        ip = normalize_ip(row[0])
+        if not ip or len(row) <= speed_col or not row[1].isdigit():
+            continue
+        latency = parse_latency_ms(row[latency_col])
+        results.append(ipcol.Result(ip, int(row[1]), row[2].strip().lower() == "true", row[3], row[5],
+                                    round(latency) if math.isfinite(latency) else None,
+                                    parse_speed(row[speed_col]) if row[speed_col].strip() else None))
+    try:
+        count = ipcol.write_columns(path, results)
+    except Exception as e:
+        logger.warning(f"无法生成 {path}: {e}")
+        return 0
+    logger.info(f"已生成 {path}（{count} 行，{os.path.getsize(path)} 字节）")
+    return count
+
+def generate_ips_file(csv_file: str, is_github_actions: bool, top_k: int = TOP_K_PER_COUNTRY):
+    """逐行读取测速结果，按国家选出最好的节点写入 ips.txt
+
+    每个国家维护一个最多 top_k 个节点的堆（堆顶是已保留节点中最差的一个），新节点更好时替换堆顶，
+    总耗时 O(n log K)，每个国家的内存占用与 K 成正比；top_k 为 0 时保留全部节点。
+    排序与 filter_speed_and_deduplicate 一致：有综合得分时按得分升序，否则按速度降序，其次都按延迟升序，
+    仍然相同时保持 CSV 中的先后顺序。
+    """
     start_time = time.time()
     if not os.path.exists(csv_file):
         logger.info(f"{csv_file} 不存在")
         return
     country_cache = load_country_cache()
-    final_nodes = []
+    heaps = defaultdict(list)
+    total = 0
     try:
         with open(csv_file, "r", encoding="utf-8") as f:
             reader = csv.reader(f)
-            next(reader)
-            for row in reader:
+            header = next(reader, None) or []
+            score_col = header.index(LATENCY_STATS_HEADER[-1]) if LATENCY_STATS_HEADER[-1] in header else -1
+            for seq, row in enumerate(reader):
                 if len(row) < 2:
                     continue
-                ip, port = row[0], row[1]
-                if not is_valid_ip(ip) or not is_valid_port(port):
+                ip, port = normalize_ip(row[0]), row[1]
+                if not ip or not is_valid_port(port):
                     continue
-                country = country_cache.get(ip, '')
+                # 按数据中心判断国家时以测速结果中的数据中心为准
+                country = IATA_TO_COUNTRY.get(row[3].strip().upper(), '') if colo_settings["enabled"] and len(row) > 3 else ''
+                if not country:
+                    country = country_cache.get(ip, '')
                 if not country:
                     country = get_country_from_ip(ip, country_cache)
-                if DESIRED_COUNTRIES and country and country in DESIRED_COUNTRIES:
-                    final_nodes.append((ip, int(port), country))
+                if not (DESIRED_COUNTRIES and country and country in DESIRED_COUNTRIES):
+                    continue
+                total += 1
+                key = score_sort_key(row, score_col) if score_col >= 0 else result_sort_key(row)
+                # 键取反后堆顶是最差的节点；seq 取反使排序相同时先出现的节点更好
+                item = (-key[0], -key[1], -seq, ip, int(port))
+                heap = heaps[country]
+                if not top_k or len(heap) < top_k:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
     except Exception as e:
         logger.error(f"无法读取 {csv_file}: {e}")
         return
-    if not final_nodes:
+    if not heaps:
         logger.info(f"没有符合条件的节点（DESIRED_COUNTRIES: {DESIRED_COUNTRIES}）")
         return
     country_count = defaultdict(int)
     labeled_nodes = []
-    for ip, port, country in sorted(final_nodes, key=lambda x: x[2] or 'ZZ'):
-        country_count[country] += 1
-        emoji, name = COUNTRY_LABELS.get(country, ('🌐', '未知'))
-        label = f"{emoji} {name}-{country_count[country]}"
-        labeled_nodes.append((ip, port, label))
+    for country in sorted(heaps, key=lambda c: c or 'ZZ'):
+        for _, _, _, ip, port in sorted(heaps[country], reverse=True):
+            country_count[country] += 1
+            metric_inc("nodes_kept_total", country=country)
+            emoji, name = COUNTRY_LABELS.get(country, ('🌐', '未知'))
+            label = f"{emoji} {name}-{country_count[country]}"
+            labeled_nodes.append((ip, port, label))
+    if top_k and total > len(labeled_nodes):
+        metric_inc("nodes_trimmed_total", total - len(labeled_nodes))
+        logger.info(f"每个国家保留最好的 {top_k} 个节点，共舍弃 {total - len(labeled_nodes)} 个")
 
     with open(IPS_FILE, "w", encoding="utf-8-sig") as f:
         for ip, port, label in labeled_nodes:
-            f.write(f"{ip}:{port}#{label}\n")
+            f.write(f"{format_host_port(ip, port)}#{label}\n")
     logger.info(f"已生成 {IPS_FILE}")
 
     logger.info(f"生成 {IPS_FILE}，{len(labeled_nodes)} 个数据节点 (耗时: {time.time() - start_time:.2f} 秒)")
@@ -1760,84 +4726,642 @@ def generate_ips_file(csv_file: str, is_github_actions: bool):
     save_country_cache(country_cache)
     return len(labeled_nodes)
 
-def main():
-    parser = argparse.ArgumentParser(description="IP 测试和筛选脚本")
-    parser.add_argument("--input-file", type=str, default=INPUT_FILE, help=f"输入 CSV 文件路径 (默认: {INPUT_FILE})")
-    parser.add_argument("--url", type=str, default=INPUT_URL, help=f"输入 URL (默认: {INPUT_URL})")
-    parser.add_argument("--offline", action="store_true", help="离线模式，不下载 GeoIP 数据库")
-    parser.add_argument("--update-geoip", action="store_true", help="强制更新 GeoIP 数据库")
-    args = parser.parse_args()
+def read_published_nodes(ips_file: str = IPS_FILE, csv_file: str = FINAL_CSV) -> Dict[str, Dict]:
+    """读取 ips.txt 中发布的节点，国家取自标签，速度和延迟取自测速结果，返回 {host:port: {"country", "speed", "latency"}}
+
+    不记录 ips.txt 中的编号：新增一个节点就会使同一国家其余节点的编号全部后移，记入增量没有意义。
+    """
+    label_countries = {f"{emoji} {name}": country for country, (emoji, name) in COUNTRY_LABELS.items()}
+    latency_col, speed_col = RESULT_HEADER.index('网络延迟'), RESULT_HEADER.index('下载速度MB/s')
+    results = {}
+    with open(csv_file, "r", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            ip = normalize_ip(row[0]) if row else None
+            if ip and len(row) > speed_col:
+                results.setdefault(format_host_port(ip, row[1]), (parse_speed(row[speed_col]), parse_latency_ms(row[latency_col])))
+    nodes = {}
+    with open(ips_file, "r", encoding="utf-8-sig") as f:
+        for line in f:
+            node, _, label = line.strip().partition("#")
+            if not node:
+                continue
+            speed, latency = results.get(node, (0.0, float('inf')))
+            nodes[node] = {"country": label_countries.get(label.rpartition("-")[0], ""), "speed": round(speed, 2),
+                           "latency": round(latency, 1) if math.isfinite(latency) else None}
+    return nodes
+
+def node_changed(old: Dict, new: Dict, speed_threshold: float, latency_threshold: float) -> bool:
+    """节点的国家变化、速度相对变化超过 speed_threshold，或延迟变化超过 latency_threshold 毫秒时视为变化"""
+    if old.get("country") != new["country"]:
+        return True
+    old_speed = old.get("speed") or 0.0
+    if old_speed and abs(new["speed"] - old_speed) > speed_threshold * old_speed:
+        return True
+    if not old_speed and new["speed"] > 0:
+        return True
+    old_latency = old.get("latency")
+    if old_latency is None or new["latency"] is None:
+        return old_latency != new["latency"]
+    return abs(new["latency"] - old_latency) > latency_threshold
+
+def write_delta_feed(delta_file: str, speed_threshold: float = DELTA_SPEED_THRESHOLD,
+                     latency_threshold: float = DELTA_LATENCY_THRESHOLD) -> int:
+    """对比本次发布的节点与上次发布的快照，写出增量文件和新的快照，返回当前版本号
+
+    快照（ips_snapshot.json）保存的是下游按增量更新后看到的状态：变化未超过阈值的节点保留上次发布的数值，
+    缓慢漂移累计超过阈值后才会出现在增量中，下游不会与真实结果越差越远。
+    增量文件只包含从 base_version 到 version 的一次变化，版本号不连续的下游应改为下载快照。
+    没有任何变化时不增加版本号，也不改写文件。
+    """
+    start_time = time.time()
+    snapshot = {"version": 0, "nodes": {}}
+    if os.path.exists(DELTA_SNAPSHOT_FILE):
+        try:
+            with open(DELTA_SNAPSHOT_FILE, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except Exception as e:
+            logger.warning(f"无法加载 {DELTA_SNAPSHOT_FILE}，从空快照开始: {e}")
+    try:
+        current = read_published_nodes()
+    except Exception as e:
+        logger.error(f"无法读取本次发布的节点: {e}")
+        return snapshot["version"]
+    previous = snapshot["nodes"]
+    added = {node: entry for node, entry in current.items() if node not in previous}
+    removed = [node for node in previous if node not in current]
+    changed = {node: entry for node, entry in current.items()
+               if node in previous and node_changed(previous[node], entry, speed_threshold, latency_threshold)}
+    metric_inc("delta_nodes_total", len(added), change="added")
+    metric_inc("delta_nodes_total", len(removed), change="removed")
+    metric_inc("delta_nodes_total", len(changed), change="changed")
+    if not (added or removed or changed):
+        metric_set("delta_version", snapshot["version"])
+        logger.info(f"与上次发布的快照（版本 {snapshot['version']}）相比没有超过阈值的变化，不生成新的增量")
+        return snapshot["version"]
+
+    version = snapshot["version"] + 1
+    delta = {
+        "version": version,
+        "base_version": snapshot["version"],
+        "generated_at": int(time.time()),
+        "total": len(current),
+        "added": [{"node": node, **entry} for node, entry in added.items()],
+        "removed": removed,
+        "changed": [{"node": node, **entry} for node, entry in changed.items()],
+    }
+    nodes = {node: entry for node, entry in previous.items() if node in current}
+    nodes.update(added)
+    nodes.update(changed)
+    outputs = [(delta_file, json.dumps(delta, ensure_ascii=False, separators=(",", ":"))),
+               (DELTA_SNAPSHOT_FILE, json.dumps({"version": version, "nodes": nodes}, ensure_ascii=False, separators=(",", ":")))]
+    for path, content in outputs:
+        temp_file = path + ".tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(temp_file, path)
+    metric_set("delta_version", version)
+    logger.info(f"已生成 {delta_file}（版本 {snapshot['version']} -> {version}）: 新增 {len(added)} 个、删除 {len(removed)} 个、"
+                f"变化 {len(changed)} 个节点，共 {len(current)} 个节点，{len(outputs[0][1].encode('utf-8'))} 字节 "
+                f"(耗时: {time.time() - start_time:.2f} 秒)")
+    return version
+
+class InputWatcher:
+    """监视输入文件的变化：优先使用 watchdog 的文件系统通知，未安装时按间隔轮询文件的修改时间和大小
+
+    监视的是文件所在目录，上游先写临时文件再重命名覆盖的方式也能收到通知。
+    """
+    def __init__(self, path: str, poll_interval: float = WATCH_POLL_INTERVAL):
+        self.path = os.path.abspath(path)
+        self.poll_interval = poll_interval
+        self.changed = threading.Event()
+        self.observer = None
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            logger.info(f"未安装 watchdog，每 {poll_interval} 秒轮询 {path} 的修改时间")
+            return
+        watcher = self
 
-    is_github_actions = os.getenv("GITHUB_ACTIONS") == "true"
-    logger.info(f"运行环境: {'GitHub Actions' if is_github_actions else '本地'}, 离线模式: {args.offline}, 更新 GeoIP: {args.update_geoip}")
+        # 只关心写入、创建和重命名；较新的 watchdog 还会报告打开、关闭等事件，本脚本每轮读取输入文件时也会触发
+        class Handler(FileSystemEventHandler):
+            def on_change(self, event):
+                paths = (getattr(event, "src_path", ""), getattr(event, "dest_path", ""))
+                if any(path and os.path.abspath(path) == watcher.path for path in paths):
+                    watcher.changed.set()
 
-    # 设置虚拟环境并安装依赖
-    setup_and_activate_venv()
+            on_modified = on_created = on_moved = on_change
 
-    # 检查依赖
-    check_dependencies(offline=args.offline, update_geoip=args.update_geoip)
+        try:
+            self.observer = Observer()
+            self.observer.schedule(Handler(), os.path.dirname(self.path), recursive=False)
+            self.observer.start()
+        except Exception as e:
+            logger.warning(f"无法启用文件系统通知，改为轮询: {e}")
+            self.observer = None
 
-    # 设置 Git 配置
-    setup_git_config(is_github_actions=is_github_actions)
+    def signature(self) -> Tuple[int, int]:
+        """文件的 (修改时间, 大小)，文件不存在时返回 None"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def wait(self, last_signature: Tuple[int, int], debounce: float, timeout: float = None) -> Tuple[int, int]:
+        """等待文件变化，并且连续 debounce 秒没有新的变化后返回新的签名；timeout 秒内没有变化时返回 None"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            wait_time = self.poll_interval
+            if deadline is not None:
+                wait_time = min(wait_time, max(0.0, deadline - time.monotonic()))
+            if self.observer:
+                # 先清除标志再比较签名：事件对应的修改时间和大小没有变化时，下一次等待不会立即返回
+                self.changed.wait(wait_time)
+                self.changed.clear()
+            else:
+                time.sleep(wait_time)
+            signature = self.signature()
+            if signature is not None and signature != last_signature:
+                # 防抖：上游连续写入时等到文件稳定下来再处理
+                while True:
+                    self.changed.clear()
+                    time.sleep(debounce)
+                    latest = self.signature()
+                    if latest == signature and not self.changed.is_set():
+                        return signature
+                    signature = latest
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+
+    def stop(self):
+        if self.observer:
+            self.observer.stop()
+            self.observer.join()
+
+class WatchState:
+    """监视模式在内存中保存的上一轮节点集合和测速结果
+
+    diff() 比较新旧节点集合，只返回新增的节点、网段和无端口 IP 用于本轮测速；
+    merge_results() 把仍在输入中的旧结果与本轮结果合并为完整的 ip.csv，删除的节点不再出现在结果中。
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.nodes = set()
+        self.blocks = {}
+        self.bare_ips = set()
+        self.header = None
+        self.rows = {}
+
+    def diff(self, ip_ports: List[Tuple[str, int, str]], cidr_blocks: List[Tuple],
+             bare_ips: List[Tuple[str, str]]) -> Tuple[List, List, List, int]:
+        """更新节点集合，返回 (新增节点, 新增网段, 新增无端口 IP, 删除的条目数)"""
+        nodes = {(ip_key(ip) << 16) | port: (ip, port, country) for ip, port, country in ip_ports}
+        blocks = {(block[0], tuple(block[1])): block for block in cidr_blocks}
+        bare = {ip_key(ip): (ip, country) for ip, country in bare_ips or []}
+        added = [node for key, node in nodes.items() if key not in self.nodes]
+        added_blocks = [block for key, block in blocks.items() if key not in self.blocks]
+        added_bare = [entry for key, entry in bare.items() if key not in self.bare_ips]
+        removed = len(self.nodes - nodes.keys()) + len(self.blocks.keys() - blocks.keys()) + len(self.bare_ips - bare.keys())
+        self.nodes, self.blocks, self.bare_ips = set(nodes), blocks, set(bare)
+        return added, added_blocks, added_bare, removed
+
+    def listed(self, ip: str, port: int) -> bool:
+        """节点是否仍在输入中（直接列出、属于某个网段，或是端口发现的 IP）"""
+        key = ip_key(ip)
+        if (key << 16) | port in self.nodes or key in self.bare_ips:
+            return True
+        if self.blocks:
+            address = ipaddress.ip_address(normalize_ip(ip))
+            return any(address in network and port in ports for network, ports in self.blocks)
+        return False
 
-    # 处理输入（优先读取本地 input.csv，若不存在或无效则从 URL 获取）
+    def merge_results(self, csv_file: str = None) -> str:
+        """把上一轮仍在输入中的结果追加到本轮测速结果，写入 ip.csv；没有任何结果时返回 None"""
+        header, rows = self.header, []
+        if csv_file and os.path.exists(csv_file):
+            with open(csv_file, "r", encoding="utf-8") as f:
+                reader = csv.reader(f)
+                header = next(reader, None) or header
+                rows = [row for row in reader if len(row) >= 2]
+        tested = {(ip_key(row[0]) << 16) | int(row[1]) for row in rows if row[1].isdigit()}
+        retained = [row for key, row in self.rows.items() if key not in tested and self.listed(row[0], int(row[1]))]
+        if not header or (not rows and not retained):
+            return None
+        with open(FINAL_CSV, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+            writer.writerows(retained)
+        logger.info(f"合并测速结果: 本轮 {len(rows)} 个节点，沿用上一轮 {len(retained)} 个节点，"
+                    f"删除 {len(self.rows) - len(retained)} 个不在输入中或已重新测速的节点")
+        return FINAL_CSV
+
+    def record_results(self, csv_file: str):
+        """保存本轮去重后的完整结果，供下一轮合并"""
+        with open(csv_file, "r", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            self.header = next(reader, None)
+            self.rows = {(ip_key(row[0]) << 16) | int(row[1]): row for row in reader if len(row) >= 2 and row[1].isdigit()}
+
+def load_input_nodes(args, node_filter: NodeFilter, allow_url: bool = True) -> Tuple[List, List, List]:
+    """读取输入节点（优先读取本地输入文件，不存在或无有效节点时从 URL 获取），返回 (节点, CIDR 网段, 无端口 IP)，失败时返回 None"""
     ip_ports = []
+    cidr_blocks = []
+    bare_ips = [] if discovery_settings["enabled"] else None
     if os.path.exists(args.input_file):
-        ip_ports = extract_ip_ports_from_file(args.input_file)
-        if ip_ports:
+        with stage_timer("parse"):
+            ip_ports = extract_ip_ports_from_file(args.input_file, cidr_blocks, bare_ips, node_filter)
+        if ip_ports or cidr_blocks or bare_ips:
             logger.info(f"从本地文件 {args.input_file} 提取到 {len(ip_ports)} 个节点")
         else:
-            logger.warning(f"本地文件 {args.input_file} 无有效节点，尝试从 URL 获取")
+            logger.warning(f"本地文件 {args.input_file} 无有效节点{'，尝试从 URL 获取' if allow_url else ''}")
     else:
-        logger.info(f"本地文件 {args.input_file} 不存在，尝试从 URL 获取")
+        logger.info(f"本地文件 {args.input_file} 不存在{'，尝试从 URL 获取' if allow_url else ''}")
 
-    if not ip_ports and args.url and not args.offline:
-        temp_file = fetch_and_save_to_temp_file(args.url)
+    if allow_url and not ip_ports and not cidr_blocks and not bare_ips and args.url and not args.offline:
+        with stage_timer("fetch"):
+            temp_file = fetch_and_save_to_temp_file(args.url)
         if temp_file and is_temp_file_valid(temp_file):
-            ip_ports = extract_ip_ports_from_file(temp_file)
+            with stage_timer("parse"):
+                ip_ports = extract_ip_ports_from_file(temp_file, cidr_blocks, bare_ips, node_filter)
             logger.info(f"从 URL {args.url} 提取到 {len(ip_ports)} 个节点")
         else:
             logger.error(f"无法从 URL {args.url} 获取有效节点")
-            sys.exit(1)
+            return None
+    return ip_ports, cidr_blocks, bare_ips
+
+def deadline_fallback_results() -> str:
+    """测速被时间预算截断且没有写出结果时的兜底 ip.csv，返回文件路径；没有可发布的结果时返回 None
+
+    优先用本次 iptest 已输出的有效节点生成（只有延迟，数据中心和下载速度留空）；本次没有任何有效节点时，
+    只沿用 DEADLINE_FALLBACK_MAX_AGE 秒内的旧 ip.csv，更旧的结果不再发布。
+    """
+    if iptest_latencies:
+        script_args = parse_iptest_args(SPEEDTEST_SCRIPT) if SPEEDTEST_SCRIPT else {}
+        use_tls = script_args.get("tls", "true").lower() != "false"
+        results = [{"ip": ip, "port": port, "outcome": "ok", "colo": "", "latency_ms": latency}
+                   for (ip, port), latency in iptest_latencies.items()]
+        count = write_probe_results(results, FINAL_CSV, use_tls)
+        metric_inc("deadline_partial_results_total", count)
+        logger.warning(f"测速未在时间预算内完成，用本次 iptest 已发现的 {count} 个有效节点生成 {FINAL_CSV}（只有延迟，没有下载速度）")
+        return FINAL_CSV
+    if not os.path.exists(FINAL_CSV) or os.path.getsize(FINAL_CSV) < 10:
+        return None
+    age = time.time() - os.path.getmtime(FINAL_CSV)
+    if age > DEADLINE_FALLBACK_MAX_AGE:
+        logger.error(f"测速未在时间预算内得到结果，现有的 {FINAL_CSV} 已是 {age / 3600:.1f} 小时前的结果"
+                     f"（超过 {DEADLINE_FALLBACK_MAX_AGE / 3600:.1f} 小时），不再发布")
+        return None
+    logger.warning(f"测速未在时间预算内得到结果，沿用 {age / 60:.0f} 分钟前的 {FINAL_CSV} 发布")
+    return FINAL_CSV
+
+def run_pipeline(args, ip_ports: List[Tuple[str, int, str]], cidr_blocks: List[Tuple], bare_ips: List[Tuple[str, str]],
+                 is_github_actions: bool, watch_state: WatchState = None) -> bool:
+    """从端口发现到提交推送的完整流程，返回是否成功
+
+    监视模式下传入 watch_state：输入只包含新增的节点，没有新增节点或新增节点全部被过滤时跳过测速，
+    测速结果与上一轮仍在输入中的结果合并后再去重、生成 ips.txt。
+    """
+    # 为没有端口的 IP 探测可用端口
+    if bare_ips:
+        with stage_timer("port_discovery"):
+            ip_ports = list(dict.fromkeys(ip_ports + discover_ports(bare_ips)))
+
+    csv_file = None
+    if ip_ports or cidr_blocks:
+        # 写入 IP 列表
+        with stage_timer("geo_filter"):
+            ip_list_file = write_ip_list(ip_ports, is_github_actions=is_github_actions, cidr_blocks=cidr_blocks)
+        if ip_list_file:
+            # 按 ASN 分散测速节点
+            if asn_settings["enabled"]:
+                with stage_timer("asn_diversify"):
+                    diversify_ip_list_by_asn(asn_settings["cap"])
+
+            # 运行测速
+            with stage_timer("speed_test"):
+                if args.role == "coordinator":
+                    csv_file = run_coordinator(args.coordinator_bind, args.lease_size, args.lease_timeout, args.coordinator_token,
+                                               args.coordinator_idle_timeout)
+                else:
+                    csv_file = run_speed_test(shards=args.shards, serialize_download=args.serialize_download)
+            # 测速因时间预算被截断且没有结果时，用本次已发现的有效节点或不太旧的 ip.csv 发布，保证截止前尽量有结果
+            reused_results = False
+            if not csv_file and metric_value("deadline_cutoffs_total", stage="speed_test"):
+                csv_file = deadline_fallback_results()
+                reused_results = bool(csv_file)
+            if not csv_file:
+                logger.error("测速失败")
+                return False
 
-    if not ip_ports:
+            # 测速结果中的数据中心写入缓存
+            if colo_settings["enabled"] and not reused_results:
+                record_result_colos(csv_file)
+
+            # 记录连续失败的节点，下次运行时跳过
+            if negative_cache_settings["enabled"] and not reused_results:
+                with stage_timer("negative_cache"):
+                    update_negative_cache(csv_file, probed_only=probe_settings["engine"] == "native" and args.role != "coordinator")
+
+            # 多次延迟采样并按综合得分排序
+            if probe_settings["latency_samples"] > 1:
+                with stage_timer("latency_samples"):
+                    apply_latency_samples(csv_file)
+        elif watch_state is None:
+            logger.error("无法生成 IP 列表")
+            return False
+    elif watch_state is None:
         logger.error("没有有效的 IP 和端口数据")
-        sys.exit(1)
-
-    # 写入 IP 列表
-    ip_list_file = write_ip_list(ip_ports, is_github_actions=is_github_actions)
-    if not ip_list_file:
-        logger.error("无法生成 IP 列表")
-        sys.exit(1)
+        return False
 
-    # 运行测速
-    csv_file = run_speed_test()
-    if not csv_file:
-        logger.error("测速失败")
-        sys.exit(1)
+    # 监视模式：与上一轮仍在输入中的结果合并
+    if watch_state is not None:
+        with stage_timer("watch_merge"):
+            csv_file = watch_state.merge_results(csv_file)
+        if not csv_file:
+            logger.error("没有有效的节点")
+            return False
 
     # 过滤和去重
-    node_count = filter_speed_and_deduplicate(csv_file, is_github_actions=is_github_actions)
+    with stage_timer("dedupe"):
+        node_count = filter_speed_and_deduplicate(csv_file, is_github_actions=is_github_actions)
     if not node_count:
         logger.error("没有有效的节点")
-        sys.exit(1)
+        return False
+    if watch_state is not None:
+        watch_state.record_results(csv_file)
 
     # 生成最终 IPs 文件
-    final_node_count = generate_ips_file(csv_file, is_github_actions=is_github_actions)
+    with stage_timer("generate_ips"):
+        final_node_count = generate_ips_file(csv_file, is_github_actions=is_github_actions, top_k=args.top_k)
     if not final_node_count:
         logger.error("无法生成最终 IPs 文件")
-        sys.exit(1)
+        return False
+
+    # 生成相对上次发布的增量文件
+    if delta_settings["file"]:
+        with stage_timer("delta_feed"):
+            write_delta_feed(delta_settings["file"], delta_settings["speed_threshold"], delta_settings["latency_threshold"])
 
     # 提交并推送
-    commit_and_push(is_github_actions=is_github_actions)
+    with stage_timer("git_push"):
+        commit_and_push(is_github_actions=is_github_actions)
+    remove_checkpoint()
+    return True
 
-    logger.info("脚本执行完成")
+def run_watch(args, node_filter: NodeFilter, is_github_actions: bool):
+    """监视模式：输入文件变化（防抖后）时只对新增的节点做国家筛选和测速，并合并上一轮的结果
+
+    每隔 --watch-refresh 秒（即使输入没有变化）做一轮全量测速，避免沿用的结果过期；某一轮失败后下一轮也做全量测速。
+    """
+    watcher = InputWatcher(args.input_file)
+    state = WatchState()
+    mode = "文件系统通知" if watcher.observer else f"每 {watcher.poll_interval} 秒轮询"
+    logger.info(f"监视模式: 监视 {args.input_file}（{mode}），防抖 {args.watch_debounce} 秒，"
+                f"全量测速间隔 {args.watch_refresh or '不限'} 秒")
+    signature = watcher.signature()
+    full = True
+    last_full = time.monotonic()
+    rounds = 0
+    try:
+        while True:
+            if signature is not None:
+                rounds += 1
+                round_start = time.time()
+                if full:
+                    state.reset()
+                probe_outcomes.clear()
+                try:
+                    inputs = load_input_nodes(args, node_filter, allow_url=False)
+                    added, added_blocks, added_bare, removed = state.diff(*inputs)
+                    metric_inc("watch_rounds_total", mode="full" if full else "delta")
+                    metric_inc("watch_added_total", len(added) + len(added_blocks) + len(added_bare))
+                    metric_inc("watch_removed_total", removed)
+                    logger.info(f"监视模式第 {rounds} 轮（{'全量' if full else '增量'}）: 新增 {len(added)} 个节点、"
+                                f"{len(added_blocks)} 个网段、{len(added_bare)} 个无端口 IP，删除 {removed} 个条目")
+                    if not (added or added_blocks or added_bare or removed):
+                        logger.info("节点集合没有变化，跳过本轮")
+                        success = True
+                    else:
+                        success = run_pipeline(args, added, added_blocks, added_bare if inputs[2] is not None else None,
+                                               is_github_actions, watch_state=state)
+                except SystemExit:
+                    # Git 推送等步骤失败时会调用 sys.exit，监视模式只结束本轮
+                    success = False
+                except Exception as e:
+                    logger.error(f"监视模式第 {rounds} 轮执行失败: {e}")
+                    success = False
+                if success:
+                    run_metrics["status"] = "success"
+                    logger.info(f"监视模式第 {rounds} 轮完成 (耗时: {time.time() - round_start:.2f} 秒)")
+                else:
+                    run_metrics["status"] = "failed"
+                    logger.warning("本轮失败，下一轮将全量测速")
+                    state.reset()
+                export_run_metrics(metrics_outputs["report"], metrics_outputs["textfile"])
+
+            timeout = None
+            if args.watch_refresh > 0:
+                timeout = max(0.0, args.watch_refresh - (time.monotonic() - last_full))
+            new_signature = watcher.wait(signature, args.watch_debounce, timeout)
+            full = new_signature is None
+            if full:
+                logger.info("到达全量测速间隔，重新测速全部节点")
+                last_full = time.monotonic()
+                signature = watcher.signature()
+            else:
+                logger.info(f"检测到 {args.input_file} 变化")
+                signature = new_signature
+    finally:
+        watcher.stop()
 
+def main():
+    parser = argparse.ArgumentParser(description="IP 测试和筛选脚本")
+    parser.add_argument("--input-file", type=str, default=INPUT_FILE, help=f"输入 CSV 文件路径 (默认: {INPUT_FILE})")
+    parser.add_argument("--url", type=str, default=INPUT_URL, help=f"输入 URL (默认: {INPUT_URL})")
+    parser.add_argument("--offline", action="store_true", help="离线模式，不下载 GeoIP 数据库")
+    parser.add_argument("--update-geoip", action="store_true", help="强制更新 GeoIP 数据库")
+    parser.add_argument("--geoip-mode", choices=GEOIP_READER_MODES, default="auto", help="GeoIP 数据库读取模式：auto、mmap_ext（C 扩展）、mmap、file 或 memory (默认: auto)")
+    parser.add_argument("--geoip-benchmark", action="store_true", help="测量每种 GeoIP 读取模式的查询速度后退出")
+    parser.add_argument("--cidr-sample", type=int, default=CIDR_SAMPLE_PER_SUBNET, help=f"CIDR 输入每个 /24（IPv6 为 /48）随机抽样的主机数 (默认: {CIDR_SAMPLE_PER_SUBNET})")
+    parser.add_argument("--cidr-ports", type=str, default=",".join(map(str, CIDR_DEFAULT_PORTS)), help=f"CIDR 行未给出端口时使用的端口列表，逗号分隔 (默认: {','.join(map(str, CIDR_DEFAULT_PORTS))})")
+    parser.add_argument("--cidr-seed", type=int, default=None, help="CIDR 抽样的随机种子，默认每次运行抽样不同的主机")
+    parser.add_argument("--cidr-max-hosts", type=int, default=CIDR_MAX_HOSTS, help=f"CIDR 展开的节点数上限，0 表示不限制 (默认: {CIDR_MAX_HOSTS})")
+    parser.add_argument("--ports", type=str, default="", help="只保留这些端口的节点，逗号分隔，解析时即过滤 (默认: 不限制)")
+    parser.add_argument("--ip-family", type=str, default="", choices=["", "4", "6", "4,6"], help="只保留 IPv4 或 IPv6 节点，解析时即过滤 (默认: 不限制)")
+    parser.add_argument("--exclude-prefixes", type=str, default="", help="排除这些网段内的节点，逗号分隔，例如 104.16.0.0/13,2606:4700::/32")
+    parser.add_argument("--asn", action="store_true", help="使用 GeoLite2-ASN 数据库按 (国家, ASN) 分组轮询排列测速节点")
+    parser.add_argument("--asn-cap", type=int, default=ASN_CAP_PER_COUNTRY, help=f"每个国家每个 ASN 最多测速的节点数，0 表示不限制 (默认: {ASN_CAP_PER_COUNTRY})")
+    parser.add_argument("--colo-country", action="store_true", help="经由每个节点请求 /cdn-cgi/trace，按实际的 Cloudflare 数据中心判断国家并筛选")
+    parser.add_argument("--colo-cache-ttl", type=float, default=COLO_CACHE_TTL, help=f"数据中心缓存的有效秒数 (默认: {COLO_CACHE_TTL})")
+    parser.add_argument("--colo-concurrency", type=int, default=COLO_TRACE_CONCURRENCY, help=f"数据中心 trace 的并发 (默认: {COLO_TRACE_CONCURRENCY})")
+    parser.add_argument("--port-discovery", action="store_true", help="为输入中只有 IP 没有端口的条目探测可用端口")
+    parser.add_argument("--discovery-ports", type=str, default=",".join(map(str, PORT_DISCOVERY_PORTS)), help=f"端口发现探测的端口列表，逗号分隔，实际顺序按历史命中率调整 (默认: {','.join(map(str, PORT_DISCOVERY_PORTS))})")
+    parser.add_argument("--discovery-concurrency", type=int, default=PORT_DISCOVERY_CONCURRENCY, help=f"端口发现的全局并发 (默认: {PORT_DISCOVERY_CONCURRENCY})")
+    parser.add_argument("--discovery-max-hits", type=int, default=PORT_DISCOVERY_MAX_HITS, help=f"每个 IP 找到多少个可用端口后停止探测，0 表示探测全部端口 (默认: {PORT_DISCOVERY_MAX_HITS})")
+    parser.add_argument("--negative-cache", action="store_true", help=f"启用负缓存：连续失败的节点按指数退避隔离，写入 ip.txt 前跳过 (缓存文件: {NEGATIVE_CACHE_FILE})")
+    parser.add_argument("--negative-cache-threshold", type=int, default=NEGATIVE_CACHE_THRESHOLD, help=f"连续失败多少次后开始隔离 (默认: {NEGATIVE_CACHE_THRESHOLD})")
+    parser.add_argument("--negative-cache-base", type=float, default=NEGATIVE_CACHE_BASE, help=f"首次隔离的秒数，此后每多失败一次翻倍 (默认: {NEGATIVE_CACHE_BASE})")
+    parser.add_argument("--negative-cache-max", type=float, default=NEGATIVE_CACHE_MAX, help=f"隔离时长上限秒数 (默认: {NEGATIVE_CACHE_MAX})")
+    parser.add_argument("--negative-cache-canary", type=float, default=NEGATIVE_CACHE_CANARY, help=f"隔离中的节点仍被重新测试的比例 (默认: {NEGATIVE_CACHE_CANARY})")
+    parser.add_argument("--metrics-report", type=str, default=RUN_REPORT_FILE, help=f"JSON 运行报告输出路径，留空则不输出 (默认: {RUN_REPORT_FILE})")
+    parser.add_argument("--metrics-textfile", type=str, default=PROM_TEXTFILE, help=f"Prometheus textfile 输出路径，留空则不输出 (默认: {PROM_TEXTFILE})")
+    parser.add_argument("--shards", type=int, default=1, help="将节点拆分为 N 个分片，并行运行 N 个 iptest 进程 (默认: 1)")
+    parser.add_argument("--serialize-download", action="store_true", help="分片模式下先并行测延迟，再串行对存活节点测下载速度")
+    parser.add_argument("--probe-engine", choices=["iptest", "native"], default="iptest", help="探测引擎：外部 iptest 或内置 asyncio 探测（AIMD 自适应并发） (默认: iptest)")
+    parser.add_argument("--probe-timeout", type=float, default=PROBE_TIMEOUT, help=f"内置引擎单个节点的探测超时秒数 (默认: {PROBE_TIMEOUT})")
+    parser.add_argument("--probe-concurrency", type=int, default=AIMD_INITIAL, help=f"内置引擎的初始并发 (默认: {AIMD_INITIAL})")
+    parser.add_argument("--probe-concurrency-min", type=int, default=AIMD_MIN, help=f"内置引擎的并发下限 (默认: {AIMD_MIN})")
+    parser.add_argument("--probe-concurrency-max", type=int, default=AIMD_MAX, help=f"内置引擎的并发上限 (默认: {AIMD_MAX})")
+    parser.add_argument("--download-confidence", type=float, default=DOWNLOAD_CONFIDENCE, help=f"内置引擎下载测速的提前结束阈值：速度 95%% 置信区间半宽不超过该比例时停止，0 表示下载完整文件 (默认: {DOWNLOAD_CONFIDENCE})")
+    parser.add_argument("--download-max-seconds", type=float, default=DOWNLOAD_MAX_SECONDS, help=f"内置引擎单个节点的最长下载秒数 (默认: {DOWNLOAD_MAX_SECONDS})")
+    parser.add_argument("--warm-pool-size", type=int, default=WARM_POOL_SIZE, help=f"内置引擎保留给下载测速复用的延迟探测连接数上限，0 表示不复用 (默认: {WARM_POOL_SIZE})")
+    parser.add_argument("--warm-pool-idle", type=float, default=WARM_POOL_IDLE, help=f"复用连接的最长空闲秒数，超过后关闭 (默认: {WARM_POOL_IDLE})")
+    parser.add_argument("--search", choices=["full", "subnet"], default="full", help="内置引擎的探测方式：全量探测，或按子网先测代表节点、只扩展表现好的子网 (默认: full)")
+    parser.add_argument("--search-representatives", type=int, default=SEARCH_REPRESENTATIVES, help=f"子网搜索第一轮每个子网探测的代表节点数 (默认: {SEARCH_REPRESENTATIVES})")
+    parser.add_argument("--search-quota", type=int, default=SEARCH_QUOTA, help=f"子网搜索每个国家需要的有效节点数，达到后不再扩展该国家的子网，0 表示扩展全部有效子网 (默认: {SEARCH_QUOTA})")
+    parser.add_argument("--top-k", type=int, default=TOP_K_PER_COUNTRY, help=f"ips.txt 中每个国家最多保留的节点数，0 表示不限制 (默认: {TOP_K_PER_COUNTRY})")
+    parser.add_argument("--latency-samples", type=int, default=LATENCY_SAMPLES, help=f"测速后对每个结果节点采样延迟的次数，大于 1 时追加延迟统计列并按综合得分排序 (默认: {LATENCY_SAMPLES})")
+    parser.add_argument("--latency-interval", type=float, default=LATENCY_SAMPLE_INTERVAL, help=f"同一节点两次延迟采样的间隔秒数 (默认: {LATENCY_SAMPLE_INTERVAL})")
+    parser.add_argument("--score-weights", type=str, default="", help="综合得分权重，例如 median=1,p90=0.5,jitter=1,loss=1000,speed=-10（未给出的项使用默认值）")
+    parser.add_argument("--role", choices=["standalone", "coordinator", "worker"], default="standalone", help="运行角色：单机、分布式协调端或测速端 (默认: standalone)")
+    parser.add_argument("--coordinator-bind", type=str, default=COORDINATOR_BIND, help=f"协调端监听地址 (默认: {COORDINATOR_BIND})")
+    parser.add_argument("--coordinator-url", type=str, default="", help="测速端连接的协调端地址，例如 http://10.0.0.1:8765")
+    parser.add_argument("--coordinator-token", type=str, default=os.getenv("COORDINATOR_TOKEN", ""), help="协调端与测速端共享的访问令牌 (默认读取环境变量 COORDINATOR_TOKEN)")
+    parser.add_argument("--lease-size", type=int, default=LEASE_SIZE, help=f"每个租约包含的节点数 (默认: {LEASE_SIZE})")
+    parser.add_argument("--lease-timeout", type=float, default=LEASE_TIMEOUT, help=f"租约超时秒数，超时后重新分配 (默认: {LEASE_TIMEOUT})")
+    parser.add_argument("--coordinator-idle-timeout", type=float, default=COORDINATOR_IDLE_TIMEOUT, help=f"协调端连续多少秒没有测速端请求后停止等待，0 表示一直等待 (默认: {COORDINATOR_IDLE_TIMEOUT})")
+    parser.add_argument("--worker-id", type=str, default=f"{socket.gethostname()}-{os.getpid()}", help="测速端标识 (默认: 主机名-进程号)")
+    parser.add_argument("--delta-file", type=str, default=DELTA_FILE, help=f"相对上次发布的增量文件路径，留空则不输出 (默认: {DELTA_FILE})")
+    parser.add_argument("--delta-speed-threshold", type=float, default=DELTA_SPEED_THRESHOLD, help=f"下载速度相对变化超过该比例时记为变化 (默认: {DELTA_SPEED_THRESHOLD})")
+    parser.add_argument("--delta-latency-threshold", type=float, default=DELTA_LATENCY_THRESHOLD, help=f"延迟变化超过该毫秒数时记为变化 (默认: {DELTA_LATENCY_THRESHOLD})")
+    parser.add_argument("--columnar-file", type=str, default=COLUMNAR_FILE, help=f"列式二进制结果文件路径，留空则不输出 (默认: {COLUMNAR_FILE})")
+    parser.add_argument("--watch", action="store_true", help="监视输入文件，变化时只对新增节点测速并合并上一轮结果，持续运行")
+    parser.add_argument("--watch-debounce", type=float, default=WATCH_DEBOUNCE, help=f"输入文件连续多少秒没有新的变化后才开始处理 (默认: {WATCH_DEBOUNCE})")
+    parser.add_argument("--watch-refresh", type=float, default=WATCH_REFRESH, help=f"监视模式下全量重新测速的间隔秒数，0 表示只在启动时全量测速 (默认: {WATCH_REFRESH})")
+    parser.add_argument("--resume", action="store_true", help="从检查点恢复：跳过上次中断的运行中已测过的节点，并合并其结果")
+    parser.add_argument("--checkpoint-file", type=str, default=CHECKPOINT_FILE, help=f"测速检查点路径，每测完一个节点追加一行，留空则不写 (默认: {CHECKPOINT_FILE})")
+    parser.add_argument("--checkpoint-max-age", type=float, default=CHECKPOINT_MAX_AGE, help=f"--resume 沿用的检查点记录的最长时间秒数 (默认: {CHECKPOINT_MAX_AGE})")
+    parser.add_argument("--deadline", type=float, default=0, help="整个运行的时间预算秒数（从脚本启动时算起），各阶段按预算缩减工作量，0 表示不限制 (默认: 0)")
+    parser.add_argument("--deadline-reserve", type=float, default=DEADLINE_RESERVE, help=f"为去重、生成 ips.txt 和提交推送预留的秒数 (默认: {DEADLINE_RESERVE})")
+    parser.add_argument("--profile", action="store_true", help="按阶段启用 cProfile 剖析，输出 .pstats 和折叠栈文件")
+    parser.add_argument("--profile-dir", type=str, default=PROFILE_DIR, help=f"剖析结果输出目录 (默认: {PROFILE_DIR})")
+    parser.add_argument("--profile-top", type=int, default=PROFILE_TOP_N, help=f"结束时打印的热点函数数量 (默认: {PROFILE_TOP_N})")
+    args = parser.parse_args()
+    if args.deadline > 0:
+        if args.watch:
+            parser.error("--deadline 不能与 --watch 同时使用")
+        # 截止时间从脚本启动（run_metrics 的 started_at）算起，包括创建虚拟环境等准备步骤
+        deadline_settings.update(end=time.monotonic() - (time.time() - run_metrics["started_at"]) + args.deadline,
+                                 reserve=max(args.deadline_reserve, 0.0),
+                                 iptest_rate=load_speed_test_rate(args.metrics_report or RUN_REPORT_FILE))
+    checkpoint_settings.update(file=args.checkpoint_file, resume=args.resume, max_age=args.checkpoint_max_age)
+    try:
+        score_weights = parse_score_weights(args.score_weights)
+    except ValueError as e:
+        parser.error(str(e))
+    cidr_ports = parse_port_list(args.cidr_ports.replace(",", " "))
+    if not cidr_ports or args.cidr_sample < 1:
+        parser.error("--cidr-ports 需要至少一个有效端口，--cidr-sample 至少为 1")
+    cidr_settings.update(sample=args.cidr_sample, ports=cidr_ports, seed=args.cidr_seed, max_hosts=args.cidr_max_hosts)
+    geoip_settings["mode"] = args.geoip_mode
+    asn_settings.update(enabled=args.asn, cap=args.asn_cap)
+    columnar_settings["file"] = args.columnar_file
+    delta_settings.update(file=args.delta_file, speed_threshold=args.delta_speed_threshold, latency_threshold=args.delta_latency_threshold)
+    discovery_ports = parse_port_list(args.discovery_ports.replace(",", " "))
+    if args.port_discovery and not discovery_ports:
+        parser.error("--discovery-ports 需要至少一个有效端口")
+    discovery_settings.update(enabled=args.port_discovery, ports=discovery_ports, concurrency=args.discovery_concurrency,
+                              max_hits=args.discovery_max_hits)
+    colo_settings.update(enabled=args.colo_country, ttl=args.colo_cache_ttl, concurrency=args.colo_concurrency)
+    try:
+        # 按数据中心判断国家时，数据源的国家不可靠，不能在解析阶段按国家丢弃
+        node_filter = NodeFilter(countries=None if args.colo_country else DESIRED_COUNTRIES, ports=parse_port_list(args.ports.replace(",", " ")),
+                                 families=[int(family) for family in args.ip_family.split(",") if family.strip()],
+                                 exclude=[prefix for prefix in args.exclude_prefixes.split(",") if prefix.strip()])
+    except ValueError as e:
+        parser.error(f"过滤条件无效: {e}")
+    # 回传的结果会写入 ip.csv 并被推送，协调端对外监听时必须要求令牌
+    if args.role == "coordinator" and not args.coordinator_token and not is_loopback_bind(args.coordinator_bind):
+        parser.error(f"协调端监听非回环地址 {args.coordinator_bind} 时必须设置 --coordinator-token（或环境变量 COORDINATOR_TOKEN）")
+    negative_cache_settings.update(enabled=args.negative_cache, threshold=max(1, args.negative_cache_threshold),
+                                   base=args.negative_cache_base, max=args.negative_cache_max, canary=args.negative_cache_canary)
+
+    if args.profile:
+        enable_profiling(args.profile_dir, args.profile_top)
+
+    probe_settings.update(engine=args.probe_engine, timeout=args.probe_timeout, initial=args.probe_concurrency,
+                          min=args.probe_concurrency_min, max=args.probe_concurrency_max,
+                          download_confidence=args.download_confidence, download_max_seconds=args.download_max_seconds,
+                          latency_samples=args.latency_samples, latency_interval=args.latency_interval, score_weights=score_weights,
+                          search=args.search, search_representatives=args.search_representatives, search_quota=args.search_quota,
+                          warm_pool_size=max(0, args.warm_pool_size), warm_pool_idle=args.warm_pool_idle)
+
+    # 无论成功与否，退出时都写出运行指标
+    metrics_outputs.update(report=args.metrics_report, textfile=args.metrics_textfile)
+    atexit.register(export_run_metrics, args.metrics_report, args.metrics_textfile)
+
+    is_github_actions = os.getenv("GITHUB_ACTIONS") == "true"
+    logger.info(f"运行环境: {'GitHub Actions' if is_github_actions else '本地'}, 离线模式: {args.offline}, 更新 GeoIP: {args.update_geoip}")
+
+    # 设置虚拟环境并安装依赖
+    with stage_timer("venv"):
+        setup_and_activate_venv()
+
+    # 测速端只负责测速，不需要 GeoIP 数据库和 Git 配置
+    if args.role == "worker":
+        if not args.coordinator_url:
+            logger.error("测速端需要通过 --coordinator-url 指定协调端地址")
+            sys.exit(1)
+        with stage_timer("speed_test"):
+            success = run_worker(args.coordinator_url, args.worker_id, args.lease_size, args.coordinator_token)
+        if not success:
+            sys.exit(1)
+        run_metrics["status"] = "success"
+        logger.info("测速端执行完成")
+        return
+
+    # 检查依赖
+    with stage_timer("geoip_init"):
+        check_dependencies(offline=args.offline, update_geoip=args.update_geoip)
+        if asn_settings["enabled"] and not init_asn_reader(offline=args.offline, update_geoip=args.update_geoip):
+            asn_settings["enabled"] = False
+
+    if args.geoip_benchmark:
+        with stage_timer("geoip_benchmark"):
+            benchmark_geoip_modes()
+        run_metrics["status"] = "success"
+        return
+
+    # 设置 Git 配置
+    with stage_timer("git_config"):
+        setup_git_config(is_github_actions=is_github_actions)
+
+    # 监视模式：持续运行，输入文件变化时增量测速
+    if args.watch:
+        run_watch(args, node_filter, is_github_actions)
+        return
+
+    # 处理输入（优先读取本地 input.csv，若不存在或无效则从 URL 获取）
+    inputs = load_input_nodes(args, node_filter)
+    if inputs is None or not run_pipeline(args, *inputs, is_github_actions=is_github_actions):
+        sys.exit(1)
+
+    run_metrics["status"] = "success"
+    logger.info("脚本执行完成")
+
 if __name__ == "__main__":
     try:
         main()
     except KeyboardInterrupt:
         logger.info("用户中断脚本执行")
+        if checkpoint_settings["file"] and os.path.exists(checkpoint_settings["file"]):
+            logger.info(f"已测节点保存在检查点 {checkpoint_settings['file']}，使用 --resume 重新运行可跳过这些节点")
         sys.exit(1)
     except Exception as e:
         logger.error(f"脚本执行失败: {e}")
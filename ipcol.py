@@ -0,0 +1,214 @@
+import argparse
+import array
+import json
+import logging
+import math
+import mmap
+import os
+import socket
+import struct
+import sys
+import time
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+# 作为模块导入时不配置日志，沿用调用方（主脚本）的日志设置
+logger = logging.getLogger("ipcol")
+
+# 文件布局（小端）：
+#   文件头  magic(8) 行数(u32) 元数据长度(u32)
+#   元数据  UTF-8 JSON：{"version", "generated_at", "countries", "colos", "columns": {列名: [偏移, 类型]}}
+#   各列    按 8 字节对齐依次存放，每列 行数 × 元素大小 字节
+MAGIC = b"IPCOL\x00\x00\x01"
+HEADER = struct.Struct("<8sII")
+FORMAT_VERSION = 1
+ALIGNMENT = 8
+LATENCY_MISSING = 0xFFFFFFFF
+IPV4_MAPPED = b"\x00" * 10 + b"\xff\xff"
+
+# 列名 -> memoryview.cast 类型码；ip 为 16 字节（IPv4 映射为 ::ffff:a.b.c.d）
+COLUMNS = [
+    ("ip", "16s"),
+    ("port", "H"),
+    ("tls", "B"),
+    ("colo", "H"),          # 数据中心，colos 列表中的下标
+    ("country", "H"),       # 国家代码，countries 列表中的下标
+    ("latency_ms", "I"),    # 延迟毫秒数，LATENCY_MISSING 表示无数据
+    ("speed", "f"),         # 下载速度 MB/s（float32），NaN 表示未测速
+]
+
+class Result(NamedTuple):
+    """一个测速结果，latency_ms、speed 无数据时为 None"""
+    ip: str
+    port: int
+    tls: bool
+    colo: str
+    country: str
+    latency_ms: Optional[int]
+    speed: Optional[float]
+
+def pack_ip(ip: str) -> bytes:
+    if ':' in ip:
+        return socket.inet_pton(socket.AF_INET6, ip)
+    return IPV4_MAPPED + socket.inet_pton(socket.AF_INET, ip)
+
+def unpack_ip(packed: bytes) -> str:
+    if packed[:12] == IPV4_MAPPED:
+        return socket.inet_ntop(socket.AF_INET, packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+def write_columns(path: str, results: Iterable[Result]) -> int:
+    """按列写出测速结果（先写临时文件再原子替换），返回行数"""
+    results = list(results)
+    countries: Dict[str, int] = {}
+    colos: Dict[str, int] = {}
+    data = {
+        "ip": b"".join(pack_ip(r.ip) for r in results),
+        "port": array.array("H", (r.port for r in results)),
+        "tls": array.array("B", (1 if r.tls else 0 for r in results)),
+        "colo": array.array("H", (colos.setdefault(r.colo, len(colos)) for r in results)),
+        "country": array.array("H", (countries.setdefault(r.country, len(countries)) for r in results)),
+        "latency_ms": array.array("I", (LATENCY_MISSING if r.latency_ms is None else min(int(r.latency_ms), LATENCY_MISSING - 1)
+                                        for r in results)),
+        "speed": array.array("f", (math.nan if r.speed is None else r.speed for r in results)),
+    }
+    if sys.byteorder == "big":
+        for column in data.values():
+            if isinstance(column, array.array):
+                column.byteswap()
+    raw = {name: column if isinstance(column, bytes) else column.tobytes() for name, column in data.items()}
+
+    # 元数据中的偏移取决于元数据本身的长度，先按占位偏移估算长度，再预留足够的对齐空间
+    meta = {"version": FORMAT_VERSION, "generated_at": int(time.time()), "countries": list(countries), "colos": list(colos),
+            "columns": {name: [0, typecode] for name, typecode in COLUMNS}}
+    meta_len = len(json.dumps(meta, ensure_ascii=False, separators=(",", ":")).encode("utf-8")) + 16 * len(COLUMNS)
+    offset = _align(HEADER.size + meta_len)
+    for name, typecode in COLUMNS:
+        meta["columns"][name][0] = offset
+        offset = _align(offset + len(raw[name]))
+    meta_bytes = json.dumps(meta, ensure_ascii=False, separators=(",", ":")).encode("utf-8").ljust(meta_len)
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(results), meta_len))
+        f.write(meta_bytes)
+        for name, _ in COLUMNS:
+            f.write(b"\x00" * (meta["columns"][name][0] - f.tell()))
+            f.write(raw[name])
+    os.replace(temp_path, path)
+    return len(results)
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+class ColumnarResults:
+    """只读访问列式结果文件：mmap 映射整个文件，各列以 memoryview 直接引用映射的内存，打开时不复制、不逐行解析
+
+    column(名称) 返回带类型的 memoryview（ip 列为每行 16 字节的原始字节），适合整列计算；
+    row(i)、迭代和下标访问返回解码后的 Result。使用完毕后调用 close() 或使用 with 语句。
+    """
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        self._buffer = memoryview(self._mmap)
+        self._views: Dict[str, memoryview] = {}
+        try:
+            magic, self.rows, meta_len = HEADER.unpack_from(self._buffer)
+            if magic != MAGIC:
+                raise ValueError(f"{path} 不是列式结果文件")
+            meta = json.loads(bytes(self._buffer[HEADER.size:HEADER.size + meta_len]))
+            if meta.get("version") != FORMAT_VERSION:
+                raise ValueError(f"{path} 的格式版本 {meta.get('version')} 不受支持")
+            self.generated_at = meta["generated_at"]
+            self.countries: List[str] = meta["countries"]
+            self.colos: List[str] = meta["colos"]
+            for name, (offset, typecode) in meta["columns"].items():
+                size = struct.calcsize(typecode) * self.rows
+                view = self._buffer[offset:offset + size]
+                if typecode != "16s":
+                    typed = view.cast(typecode)
+                    view.release()
+                    view = typed
+                    if sys.byteorder == "big":
+                        # 大端机器上无法零拷贝，换成字节序转换后的副本
+                        swapped = array.array(typecode, view.tobytes())
+                        swapped.byteswap()
+                        view.release()
+                        view = memoryview(swapped)
+                self._views[name] = view
+        except Exception:
+            self.close()
+            raise
+
+    def column(self, name: str) -> memoryview:
+        return self._views[name]
+
+    def ip(self, index: int) -> str:
+        return unpack_ip(bytes(self._views["ip"][index * 16:index * 16 + 16]))
+
+    def row(self, index: int) -> Result:
+        if not -self.rows <= index < self.rows:
+            raise IndexError(index)
+        index %= self.rows
+        latency = self._views["latency_ms"][index]
+        speed = self._views["speed"][index]
+        return Result(self.ip(index), self._views["port"][index], bool(self._views["tls"][index]),
+                      self.colos[self._views["colo"][index]], self.countries[self._views["country"][index]],
+                      None if latency == LATENCY_MISSING else latency, None if math.isnan(speed) else speed)
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def __getitem__(self, index: int) -> Result:
+        return self.row(index)
+
+    def __iter__(self) -> Iterator[Result]:
+        return (self.row(i) for i in range(self.rows))
+
+    def close(self):
+        # mmap 在仍有 memoryview 引用时无法关闭，先释放所有视图
+        for view in self._views.values():
+            view.release()
+        self._views = {}
+        if self._buffer is not None:
+            self._buffer.release()
+            self._buffer = None
+        if not self._mmap.closed:
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> "ColumnarResults":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s', handlers=[logging.StreamHandler(sys.stdout)], force=True)
+    parser = argparse.ArgumentParser(description="查看列式测速结果文件")
+    parser.add_argument("path", nargs="?", default="ip.col", help="列式结果文件路径 (默认: ip.col)")
+    parser.add_argument("--head", type=int, default=10, help="输出前 N 行 (默认: 10)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        results = ColumnarResults(args.path)
+    except (OSError, ValueError) as e:
+        logger.error(f"无法打开 {args.path}: {e}")
+        sys.exit(1)
+    elapsed = time.perf_counter() - start
+    with results:
+        logger.info(f"{args.path}: {len(results)} 行，{len(results.countries)} 个国家，{len(results.colos)} 个数据中心，"
+                    f"生成于 {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(results.generated_at))}，"
+                    f"打开耗时 {elapsed * 1e6:.0f} 微秒")
+        for i in range(min(args.head, len(results))):
+            r = results[i]
+            latency = f"{r.latency_ms} ms" if r.latency_ms is not None else "-"
+            speed = f"{r.speed:.2f} MB/s" if r.speed is not None else "-"
+            logger.info(f"{r.ip} {r.port} {r.colo} {r.country} {latency} {speed}")
+
+if __name__ == "__main__":
+    main()
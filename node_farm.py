@@ -0,0 +1,465 @@
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+# 日志配置
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)],
+    force=True
+)
+logger = logging.getLogger("node_farm")
+
+# 常量
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+MAIN_SCRIPT = "ip-filter-speedtest-api.py"
+FARM_PORTS = [2053, 2083, 2087, 2096, 8443, 50000, 8080]
+BASE_PORT = 20000
+DOWNLOAD_CHUNK = 64 * 1024
+HANG_SECONDS = 120
+REQUEST_TIMEOUT = 30
+FAILURE_MODES = ["refuse", "reset", "hang", "http_error", "no_colo"]
+DEFAULT_DOWNLOAD_BYTES = 50000000
+
+# 国家 -> (数据中心, 地区, 城市, 基础延迟 ms, 权重)，权重偏向亚太以贴近真实数据源
+COUNTRY_PROFILES = {
+    'JP': ('NRT', 'AS', 'Tokyo', 45, 14), 'KR': ('ICN', 'AS', 'Seoul', 60, 14),
+    'HK': ('HKG', 'AS', 'Hong Kong', 50, 10), 'SG': ('SIN', 'AS', 'Singapore', 75, 10),
+    'TW': ('TPE', 'AS', 'Taipei', 55, 8), 'IN': ('DEL', 'AS', 'New Delhi', 120, 4),
+    'VN': ('SGN', 'AS', 'Ho Chi Minh City', 90, 3), 'TH': ('BKK', 'AS', 'Bangkok', 85, 3),
+    'US': ('LAX', 'NA', 'Los Angeles', 160, 14), 'DE': ('FRA', 'EU', 'Frankfurt', 220, 10),
+    'NL': ('AMS', 'EU', 'Amsterdam', 230, 10),
+}
+
+class NodeSpec(NamedTuple):
+    """单个模拟节点的行为参数"""
+    ip: str
+    port: int
+    country: str
+    colo: str
+    latency_ms: float       # 每个请求返回首字节前的延迟
+    jitter_ms: float        # 延迟的随机抖动（正态分布标准差）
+    bandwidth_mbps: float   # __down 下载带宽，MB/s
+    loss: float             # 每个连接被静默挂起（模拟丢包超时）的概率
+    failure: str            # 故障模式: none / refuse / reset / hang / http_error / no_colo
+
+def generate_specs(count: int, seed: int, spread_ips: bool, fail_rate: float = 0.2) -> List[NodeSpec]:
+    """按固定随机种子生成节点参数，同一种子总是得到相同的节点集合"""
+    rng = random.Random(seed)
+    countries = list(COUNTRY_PROFILES)
+    weights = [COUNTRY_PROFILES[c][4] for c in countries]
+    specs = []
+    used = set()
+    for i in range(count):
+        country = rng.choices(countries, weights)[0]
+        colo, _, _, base_latency, _ = COUNTRY_PROFILES[country]
+        if spread_ips:
+            # Linux 上整个 127.0.0.0/8 都指向回环接口，每个节点可以使用独立地址
+            ip = f"127.1.{i // 250}.{i % 250 + 1}"
+            port = rng.choice(FARM_PORTS)
+        else:
+            ip = "127.0.0.1"
+            port = BASE_PORT + i
+        if (ip, port) in used:
+            continue
+        used.add((ip, port))
+        failure = rng.choice(FAILURE_MODES) if rng.random() < fail_rate else "none"
+        specs.append(NodeSpec(
+            ip=ip,
+            port=port,
+            country=country,
+            colo=colo,
+            latency_ms=max(1.0, base_latency + rng.uniform(-10, 30)),
+            jitter_ms=rng.choice([1, 2, 5, 20, 60]),
+            bandwidth_mbps=round(min(60.0, max(0.5, rng.lognormvariate(2.2, 0.7))), 2),
+            loss=rng.choice([0.0, 0.0, 0.0, 0.05, 0.2]),
+            failure=failure,
+        ))
+    return specs
+
+def format_trace(spec: NodeSpec, host: str, peer_ip: str, scheme: str) -> bytes:
+    """模拟 /cdn-cgi/trace 的响应内容"""
+    lines = [
+        "fl=0f0",
+        f"h={host}",
+        f"ip={peer_ip}",
+        f"ts={time.time():.3f}",
+        f"visit_scheme={scheme}",
+        "uag=Mozilla/5.0",
+    ]
+    if spec.failure != "no_colo":
+        lines.append(f"colo={spec.colo}")
+    lines.extend(["sliver=none", "http=http/1.1", f"loc={spec.country}", "tls=TLSv1.3" if scheme == "https" else "tls=off",
+                  "sni=plaintext", "warp=off", "gateway=off", "rbi=off", "kex=X25519"])
+    return ("\n".join(lines) + "\n").encode()
+
+class FakeNode:
+    """单个模拟节点：HTTP/1.1 keep-alive，支持 /cdn-cgi/trace 和 /__down?bytes=N"""
+
+    def __init__(self, spec: NodeSpec, seed: int, tls: bool):
+        self.spec = spec
+        self.tls = tls
+        self.rng = random.Random(f"{seed}-{spec.ip}-{spec.port}")
+        self.connections = 0
+        self.bytes_sent = 0
+
+    def delay(self) -> float:
+        return max(0.0, self.spec.latency_ms + self.rng.gauss(0, self.spec.jitter_ms)) / 1000
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        spec = self.spec
+        try:
+            if spec.failure == "reset":
+                sock = writer.get_extra_info("socket")
+                if sock is not None:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                return
+            if spec.failure == "hang" or self.rng.random() < spec.loss:
+                await asyncio.sleep(HANG_SECONDS)
+                return
+            peer_ip = (writer.get_extra_info("peername") or ("127.0.0.1",))[0]
+            while True:
+                request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT)
+                request_line, _, raw_headers = request.decode("latin-1").partition("\r\n")
+                parts = request_line.split(" ")
+                target = parts[1] if len(parts) > 1 else "/"
+                headers = {}
+                for line in raw_headers.split("\r\n"):
+                    name, _, value = line.partition(":")
+                    if name:
+                        headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await asyncio.sleep(self.delay())
+                if spec.failure == "http_error":
+                    await self.respond(writer, 503, b"service unavailable\n", keep_alive)
+                    return
+                path, _, query = target.partition("?")
+                if path.endswith("/cdn-cgi/trace"):
+                    host = headers.get("host", "speed.cloudflare.com")
+                    await self.respond(writer, 200, format_trace(spec, host, peer_ip, "https" if self.tls else "http"), keep_alive)
+                elif path.endswith("/__down"):
+                    params = dict(p.partition("=")[::2] for p in query.split("&") if p)
+                    try:
+                        size = int(params.get("bytes", DEFAULT_DOWNLOAD_BYTES))
+                    except ValueError:
+                        size = DEFAULT_DOWNLOAD_BYTES
+                    await self.send_download(writer, size, keep_alive)
+                else:
+                    await self.respond(writer, 404, b"not found\n", keep_alive)
+                if not keep_alive:
+                    return
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ssl.SSLError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+    async def respond(self, writer: asyncio.StreamWriter, status: int, body: bytes, keep_alive: bool):
+        reason = {200: "OK", 404: "Not Found", 503: "Service Unavailable"}.get(status, "OK")
+        head = (f"HTTP/1.1 {status} {reason}\r\nServer: cloudflare\r\nContent-Type: text/plain\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode() + body)
+        await writer.drain()
+        self.bytes_sent += len(body)
+
+    async def send_download(self, writer: asyncio.StreamWriter, size: int, keep_alive: bool):
+        """按节点带宽限速发送 size 字节"""
+        head = (f"HTTP/1.1 200 OK\r\nServer: cloudflare\r\nContent-Type: application/octet-stream\r\n"
+                f"Content-Length: {size}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode())
+        rate = self.spec.bandwidth_mbps * 1024 * 1024
+        chunk = b"\0" * DOWNLOAD_CHUNK
+        start = time.monotonic()
+        sent = 0
+        while sent < size:
+            n = min(DOWNLOAD_CHUNK, size - sent)
+            writer.write(chunk[:n])
+            await writer.drain()
+            sent += n
+            self.bytes_sent += n
+            ahead = sent / rate - (time.monotonic() - start)
+            if ahead > 0:
+                await asyncio.sleep(ahead)
+
+class NodeFarm:
+    """在后台线程的事件循环中运行一组 FakeNode"""
+
+    def __init__(self, specs: List[NodeSpec], seed: int = 0, ssl_context: Optional[ssl.SSLContext] = None,
+                 speed_port: int = 0, speed_bandwidth_mbps: float = 50.0):
+        self.specs = specs
+        self.ssl_context = ssl_context
+        self.nodes = [FakeNode(spec, seed, ssl_context is not None) for spec in specs]
+        self.speed_port = speed_port
+        self.speed_node = None
+        if speed_port:
+            # 独立的 speed.cloudflare.com 替身，供 -url 直接指向
+            self.speed_node = FakeNode(NodeSpec("127.0.0.1", speed_port, "US", "LAX", 0.0, 0.0, speed_bandwidth_mbps, 0.0, "none"),
+                                       seed, ssl_context is not None)
+        self.loop = None
+        self.thread = None
+        self.servers = []
+        self.handlers = set()  # 正在处理连接的任务，停止时取消
+        self.ready = threading.Event()
+        self.error = None
+
+    def _tracked(self, node: FakeNode):
+        """包装节点的连接处理函数，记录处理任务以便 stop 时取消"""
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            task = asyncio.current_task()
+            self.handlers.add(task)
+            try:
+                await node.handle(reader, writer)
+            except asyncio.CancelledError:
+                # 只有 stop 会取消处理任务；正常结束任务，否则 Python 3.11 的 StreamReaderProtocol 回调会把取消记为错误日志
+                pass
+            finally:
+                self.handlers.discard(task)
+        return handle
+
+    async def _start_servers(self):
+        nodes = list(self.nodes)
+        if self.speed_node:
+            nodes.append(self.speed_node)
+        for node in nodes:
+            if node.spec.failure == "refuse":
+                continue  # 不监听，客户端得到 connection refused
+            server = await asyncio.start_server(self._tracked(node), host=node.spec.ip, port=node.spec.port,
+                                                ssl=self.ssl_context, reuse_address=True, backlog=256)
+            self.servers.append(server)
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._start_servers())
+        except Exception as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.ready.set()
+        self.loop.run_forever()
+        self.loop.run_until_complete(self._shutdown())
+        self.loop.close()
+
+    async def _shutdown(self):
+        """关闭监听，取消仍在处理的连接（挂起、下载中的节点）并等待其结束，避免关闭事件循环时遗留未完成的任务"""
+        for server in self.servers:
+            server.close()
+        handlers = list(self.handlers)
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="node-farm", daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error:
+            raise RuntimeError(f"节点农场启动失败: {self.error}")
+        logger.info(f"节点农场已启动: {len(self.servers)} 个监听节点，共 {len(self.specs)} 个节点"
+                    f"{'（TLS）' if self.ssl_context else ''}")
+
+    def stop(self):
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=5)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "connections": sum(n.connections for n in self.nodes),
+            "bytes_sent": sum(n.bytes_sent for n in self.nodes) + (self.speed_node.bytes_sent if self.speed_node else 0),
+        }
+
+def make_ssl_context(workdir: str) -> ssl.SSLContext:
+    """用 openssl 生成 speed.cloudflare.com 的自签名证书"""
+    openssl = shutil.which("openssl")
+    if not openssl:
+        raise RuntimeError("未找到 openssl，无法生成 TLS 证书，请去掉 --tls")
+    cert = os.path.join(workdir, "farm-cert.pem")
+    key = os.path.join(workdir, "farm-key.pem")
+    subprocess.run([openssl, "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=speed.cloudflare.com", "-keyout", key, "-out", cert],
+                   check=True, capture_output=True)
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+def write_input_csv(path: str, specs: List[NodeSpec]):
+    """写出与 input.csv 相同格式的节点列表"""
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["ip", "port", "Region", "Country", "City"])
+        for spec in specs:
+            _, region, city, _, _ = COUNTRY_PROFILES[spec.country]
+            writer.writerow([spec.ip, spec.port, region, spec.country, city])
+    logger.info(f"已写出 {path}，{len(specs)} 个节点")
+
+def write_country_cache(path: str, specs: List[NodeSpec]):
+    """回环地址在 GeoIP 数据库中没有国家信息，预先写入国家缓存供 generate_ips_file 使用"""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({spec.ip: spec.country for spec in specs}, f, ensure_ascii=False, indent=2)
+
+def default_spread_ips() -> bool:
+    return platform.system().lower() == "linux"
+
+def write_farm_speedtest_script(path: str, iptest: str, tls: bool, download_bytes: int, speed_limit: float):
+    """生成指向节点农场的 iptest 调用脚本（参数与 iptest.sh 一致）"""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("#!/bin/bash\n")
+        f.write(f'"{iptest}" -file="ip.txt" -tls={str(tls).lower()} -speedtest=3 -speedlimit={speed_limit} '
+                f'-url="speed.cloudflare.com/__down?bytes={download_bytes}" -max=100 -outfile="ip.csv"\n')
+    os.chmod(path, 0o755)
+
+def run_pipeline_benchmark(args, extra_args: List[str]) -> Dict:
+    """在临时目录中对节点农场运行 main() 的完整流程，返回运行报告
+
+    虚拟环境、GeoIP 数据库初始化、Git 配置和推送依赖外部环境，基准中替换为空操作；
+    其余阶段（解析、国家筛选、测速、去重、生成 ips.txt）与正常运行完全相同。
+    """
+    from benchmark import load_script_module
+
+    # 内置探测引擎不需要 iptest，测速脚本只用于传递 -tls 等参数
+    native = args.probe_engine == "native"
+    iptest = args.iptest or shutil.which("iptest") or os.path.join(SCRIPT_DIR, "iptest")
+    if not os.path.exists(iptest) and not native:
+        raise RuntimeError("未找到 iptest 可执行文件，请通过 --iptest 指定，或使用 --probe-engine native")
+    iptest = os.path.abspath(iptest)
+
+    workdir = tempfile.mkdtemp(prefix="iptest-farm-")
+    cwd = os.getcwd()
+    saved_argv = sys.argv[:]
+    farm = None
+    try:
+        os.chdir(workdir)
+        specs = generate_specs(args.nodes, args.seed, args.spread_ips, args.fail_rate)
+        ssl_context = make_ssl_context(workdir) if args.tls else None
+        farm = NodeFarm(specs, args.seed, ssl_context)
+        farm.start()
+        write_input_csv("input.csv", specs)
+        module = load_script_module("ip_filter_speedtest_api", MAIN_SCRIPT, workdir)
+        write_country_cache(module.COUNTRY_CACHE_FILE, specs)
+        script_path = os.path.join(workdir, "farm_iptest.sh")
+        write_farm_speedtest_script(script_path, iptest, args.tls, args.download_bytes, args.speed_limit)
+        module.SPEEDTEST_SCRIPT = script_path
+        module.setup_and_activate_venv = lambda *a, **k: None
+        module.check_dependencies = lambda *a, **k: None
+        module.setup_git_config = lambda *a, **k: None
+        module.commit_and_push = lambda *a, **k: None
+
+        sys.argv = [MAIN_SCRIPT, "--offline", "--input-file", "input.csv", "--probe-engine", args.probe_engine,
+                    "--metrics-report", "", "--metrics-textfile", ""] + extra_args
+        start = time.perf_counter()
+        try:
+            module.main()
+        except SystemExit as e:
+            logger.warning(f"main() 提前退出，退出码: {e.code}")
+        wall = time.perf_counter() - start
+
+        report = module.build_run_report()
+        report["farm"] = {
+            "nodes": len(specs),
+            "seed": args.seed,
+            "wall_seconds": round(wall, 3),
+            "nodes_per_second": round(len(specs) / wall, 2) if wall > 0 else None,
+            **farm.stats(),
+        }
+        if os.path.exists(module.IPS_FILE):
+            with open(module.IPS_FILE, "r", encoding="utf-8-sig") as f:
+                report["farm"]["ips_nodes"] = sum(1 for line in f if line.strip())
+        return report
+    finally:
+        if farm:
+            farm.stop()
+        sys.argv = saved_argv
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def serve(args):
+    specs = generate_specs(args.nodes, args.seed, args.spread_ips, args.fail_rate)
+    workdir = tempfile.mkdtemp(prefix="iptest-farm-")
+    ssl_context = make_ssl_context(workdir) if args.tls else None
+    farm = NodeFarm(specs, args.seed, ssl_context, speed_port=args.speed_port, speed_bandwidth_mbps=args.speed_bandwidth)
+    farm.start()
+    write_input_csv(args.input_out, specs)
+    if args.country_cache_out:
+        write_country_cache(args.country_cache_out, specs)
+    if args.speed_port:
+        scheme = "https" if args.tls else "http"
+        logger.info(f"speed.cloudflare.com 替身: {scheme}://127.0.0.1:{args.speed_port}/__down?bytes=N")
+    logger.info("按 Ctrl+C 停止")
+    try:
+        while True:
+            time.sleep(3600)
+    finally:
+        farm.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟节点农场，用于离线端到端吞吐基准")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("serve", "bench"):
+        p = sub.add_parser(name)
+        p.add_argument("--nodes", type=int, default=200, help="节点数量 (默认: 200)")
+        p.add_argument("--seed", type=int, default=1, help="随机种子，相同种子生成相同节点 (默认: 1)")
+        p.add_argument("--fail-rate", type=float, default=0.2, help="带故障模式的节点比例 (默认: 0.2)")
+        p.add_argument("--tls", action="store_true", help="节点使用自签名 TLS（需要 openssl）")
+        p.add_argument("--single-ip", dest="spread_ips", action="store_false", default=default_spread_ips(),
+                       help="所有节点都监听 127.0.0.1 的不同端口（非 Linux 平台默认如此）")
+    serve_parser = sub.choices["serve"]
+    serve_parser.add_argument("--input-out", type=str, default="input.csv", help="写出的节点列表 (默认: input.csv)")
+    serve_parser.add_argument("--country-cache-out", type=str, default="", help="同时写出回环地址的国家缓存")
+    serve_parser.add_argument("--speed-port", type=int, default=0, help="在该端口提供 speed.cloudflare.com/__down 替身")
+    serve_parser.add_argument("--speed-bandwidth", type=float, default=50.0, help="替身的下载带宽 MB/s (默认: 50)")
+    bench_parser = sub.choices["bench"]
+    bench_parser.add_argument("--iptest", type=str, default="", help="iptest 可执行文件路径")
+    bench_parser.add_argument("--probe-engine", choices=["iptest", "native"], default="iptest",
+                              help="主脚本使用的探测引擎，native 时不需要 iptest (默认: iptest)")
+    bench_parser.add_argument("--download-bytes", type=int, default=2000000, help="每个节点的下载字节数 (默认: 2000000)")
+    bench_parser.add_argument("--speed-limit", type=float, default=1.0, help="下载速度下限 MB/s (默认: 1)")
+    bench_parser.add_argument("--report", type=str, default="farm_report.json", help="基准报告输出路径 (默认: farm_report.json)")
+
+    argv = sys.argv[1:]
+    extra_args = []
+    if "--" in argv:
+        idx = argv.index("--")
+        argv, extra_args = argv[:idx], argv[idx + 1:]
+    args = parser.parse_args(argv)
+    if any(arg == "--probe-engine" or arg.startswith("--probe-engine=") for arg in extra_args):
+        parser.error("探测引擎请使用 bench 的 --probe-engine 参数指定，不要放在 -- 之后")
+
+    if args.command == "serve":
+        serve(args)
+        return
+    report = run_pipeline_benchmark(args, extra_args)
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    farm_stats = report["farm"]
+    logger.info(f"端到端耗时 {farm_stats['wall_seconds']} 秒，{farm_stats['nodes_per_second']} 节点/秒，"
+                f"ips.txt 节点数 {farm_stats.get('ips_nodes', 0)}，报告: {args.report}")
+    logger.info(f"阶段耗时: {report['stages']}")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        logger.info("用户中断")
+        sys.exit(1)